@@ -10,46 +10,75 @@ It seems somewhat specific to the type of comparisons a user may wish to do, so
 
 
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LogNorm
 from matplotlib.ticker import ScalarFormatter
 import itertools
+import json
 import numpy as np
-import re
-from astropy.time import Time
 from astropy.table import Table
 import argparse
+import concurrent.futures
 import os
-import glob
 import logging
 
+import flux_engine
+import models
+import product_index
 import read_output
+import tracing
 import utils
+import header_index
 
 import matplotlib as mpl
 mpl.rcParams['axes.formatter.useoffset'] = False
 
 
-# These must match the directory names specified in xspec_models/*sh
-MODELS = ["powlaw_tbabs", "logpar_tbabs", "powlaw_ztbabs_tbabs"]
+# Names of the output directories of the models in the registry
+MODELS = models.MODELS
+
+# Appended to the name of the lightcurve table for the file with the state of the incremental lightcurve
+LIGHTCURVE_STATE_SUFFIX = ".state.json"
+
+# Flux of the lightcurve points read from param_tbl.dat, i.e. XSpec's `flux` (see `lightcurve_tbl()`)
+PARAM_TBL_FLUX = "photon flux 2-10 keV (param_tbl.dat)"
+
+# Global SED plot parameters
+SED_RCPARAMS = {'font.size': 18, 'figure.figsize': (14, 10), 'axes.grid.which': 'both',
+                'grid.color': 'lightgrey', 'grid.linestyle': 'dotted', 'axes.grid': True, 'axes.labelsize': 18,
+                'legend.fontsize': 11}
+
+# Views of the SEDs of all ObsIDs for one model: every ObsID's points, the percentiles of all ObsIDs on a common energy grid, or the density of
+# all points; see `plot_sed_all_obsids()`
+SED_VIEWS = ("obsids", "percentiles", "density")
+
+# With more ObsIDs than this, the "auto" view of the SEDs of all ObsIDs is "percentiles" instead of "obsids"
+MAX_OBSIDS_OVERPLOT = 30
+
+# Log-spaced energy bins over the noticed energies (models.E_NOTICE) of the aggregated views of the SEDs of all ObsIDs
+SED_GRID_BINS = 50
+
+# Number of groups of ObsIDs, in order of MJD, whose median SED is plotted in the "percentiles" view colored by MJD
+SED_MJD_GROUPS = 8
+
+# Percentiles of the SEDs of all ObsIDs in each energy bin: the 95% band, the 68% band and the median
+SED_PERCENTILES = (2.5, 16., 50., 84., 97.5)
+
+# Chi-squared above the minimum that bounds the confidence regions of two parameters (68.3%, 95.4% and 99.73%, i.e. 1, 2 and 3 sigma)
+CONTOUR_LEVELS = (2.30, 6.18, 11.83)
+
+# MJD of 1970-01-01, the epoch of the day counts in `_days_from_civil()`
+MJD_UNIX_EPOCH = 40587
+
+# Figure that a rendering worker draws every one of its ObsIDs on, and the product index it finds them in, see `_init_render_worker()`
+_RENDER_FIG = None
+_RENDER_PRODUCTS = None
 
 # This is for plot legends e.g. Galactic absorbed powerlaw will display instead of powlaw_tbabs
-MODELS_PLOT_DICT = {
-                    "powlaw_tbabs": "Galactic absorbed powerlaw",
-                    "logpar_tbabs": "Galactic absorbed logparabola",
-                    "powlaw_ztbabs_tbabs": "Galactic + intrinsic absorbed powerlaw",
-                    }
+MODELS_PLOT_DICT = {name: model.description for name, model in models.REGISTRY.items()}
 
 # These error messages are directly from the XSpec Users’ Guide for version 12.12.1: Section 5.3.12 tclout
-ERR_STR_DICT = {
-                0: "new minimum found",
-                1: "non-monotonicity detected",
-                2:" minimization may have run into problem",
-                3:"hit hard lower limit",
-                4:"hit hard upper limit",
-                5: "parameter was frozen",
-                6: "search failed in -ve direction",
-                7: "search failed in +ve direction",
-                8: "reduced chi-squared too high",
-                }
+ERR_STR_DICT = read_output.ERR_STR_DICT
 
 
 def check_fit_success_using_error_string(fn_param):
@@ -59,7 +88,7 @@ def check_fit_success_using_error_string(fn_param):
     Parameters
     ----------
     fn_param : str
-        Path to param_tbl.dat created by the bash files in xspec_models/
+        Path to param_tbl.dat written by the XSpec fit (see models.py)
         e.g. ../output/00032646038/USERPROD_223833/powlaw_tbabs/param_tbl.dat
 
     Returns
@@ -69,53 +98,36 @@ def check_fit_success_using_error_string(fn_param):
         False if there is one or more error(s); details are logged and also printed to terminal
     """
 
-    # This is the error string if there were NO errors in the parameter calculation 
-    fit_success_msg = 'FFFFFFFFF'
-
-    # True for elements/parameters where there is no error
-    fit_succes = []
-
-    # Get the error strings for each parameter in `fn_param` (parameters depend on the model)
+    # Get the error strings for each parameter in `fn_param` (parameters depend on the model), decoded to error bitmasks
     param_names, _, _, _, err_strs = read_output.read_param_tbl(fn_param)
-    
-    # Loop over multiple parameters
-    for i, err_str in enumerate(err_strs):
-        # 0 is a placeholder for quantities with no error strings e.g. flux
-        if fit_success_msg in err_str or '0' in err_str:
-            fit_succes.append(True)
-        else:
-            fit_succes.append(False)
+    err_masks = read_output.error_bitmasks(err_strs)
 
     # If everything has no errors, return True
-    if np.all(fit_succes):
-        total_fit_succes = True
-    if False in fit_succes:
-        total_fit_succes = False
+    total_fit_succes = not np.any(err_masks)
 
     # If there were errors, get more details
-    if total_fit_succes is False or total_fit_succes == False:
-        idx = np.where(total_fit_succes is False)[0]
-        msg1 = f"There is an issue in the calculation of the parameter(s) error: {param_names[idx]} in {fn_param}."
+    if not total_fit_succes:
+        idx = np.flatnonzero(err_masks)
+        msg1 = f"There is an issue in the calculation of the parameter(s) error: {', '.join(param_names[idx])} in {fn_param}."
         print(msg1)
         logging.warning(msg1)
         msg2 = "HOWEVER, the parameter may still have a reported best fit value and bounds. Consider refitting or treat these values carefully?"
         print(msg2)
         logging.warning(msg2)
         for i in idx:
-            # Find all occurrences of 'T' 
-            t_idx = [match.start() for match in re.finditer('T', err_strs[i])]
-            for t in t_idx:
-                msg = f"\tFor parameter {param_names[i]}, the fit failed because: {ERR_STR_DICT[t]}"
+            for err in read_output.error_messages(err_masks[i]):
+                msg = f"\tFor parameter {param_names[i]}, the fit failed because: {err}"
                 print(msg)
                 logging.error(msg)
 
     return total_fit_succes
 
 
-def overplot_all_obsids_for_model(base_data_dir, obsid_list, spec_stem, model):
+def overplot_all_obsids_for_model(base_data_dir, obsid_list, spec_stem, model, products=None):
     """Plot data points (which are model dependent) of ObsIDs in `obsid_list` for one `model` on the same plot.
     Plot is saved as `base_data_dir`/spec_`model`_all_obsids.png
     This is done as one check of variability.
+    The spectra are found in `products` (a product_index.ProductIndex); by default, the index cached in `base_data_dir`.
 
     Parameters
     ----------
@@ -128,21 +140,19 @@ def overplot_all_obsids_for_model(base_data_dir, obsid_list, spec_stem, model):
         MODELS = ["powlaw_tbabs", "logpar_tbabs", "powlaw_ztbabs_tbabs"]
     """
 
-    # Global SED plot parameters
-    plt.rcParams.update(
-        {'font.size': 18, 'figure.figsize': (14, 10), 'axes.grid.which': 'both',
-            'grid.color': 'lightgrey', 'grid.linestyle': 'dotted', 'axes.grid': True, 'axes.labelsize': 18,
-            'legend.fontsize': 11})
+    plt.rcParams.update(SED_RCPARAMS)
     plt.style.use('tableau-colorblind10')
     marker_cycle = itertools.cycle(['o', '^', 's', 'D', '*', 'v', 'p', 'x'])
 
     plt.figure()
+    if products is None:
+        products = product_index.load(base_data_dir, obsid_list)
 
     for obsid in obsid_list:
 
         # Get name of file that contains the spectrum
         spec_dir = os.path.join(base_data_dir, obsid, "USERPROD*", spec_stem, model, "spec_default_bin.dat")
-        spec_fn = glob.glob(spec_dir)
+        spec_fn = products.glob(obsid, spec_stem, model, "spec_default_bin.dat")
 
         # There is expected to be only one file in the lsit `spec_fn`. Check that this is the case. Proceed only if it is.
         if len(spec_fn) != 1:
@@ -167,49 +177,258 @@ def overplot_all_obsids_for_model(base_data_dir, obsid_list, spec_stem, model):
     return None
 
 
-def lightcurve_tbl(base_data_dir, fn_tbl):
+def sed_grid(energy, eflux, offsets, edges):
+    """Mean `eflux` of each ObsID in each energy bin of `edges`, from the points of all ObsIDs in one array (as from
+    read_output.load_model_spectra(), the points of ObsID i being elements offsets[i] to offsets[i+1]), with one call to np.bincount().
+
+    Returns
+    -------
+    grid : np.ndarray
+        Shape (number of ObsIDs, len(edges) - 1); NaN where an ObsID has no point in a bin
+    """
+
+    n_oids, n_bins = len(offsets) - 1, len(edges) - 1
+    row = np.repeat(np.arange(n_oids), np.diff(offsets))
+    col = np.searchsorted(edges, energy, side="right") - 1
+    ok = (col >= 0) & (col < n_bins) & np.isfinite(eflux)
+    cell = row[ok] * n_bins + col[ok]
+    sums = np.bincount(cell, weights=eflux[ok], minlength=n_oids * n_bins)
+    counts = np.bincount(cell, minlength=n_oids * n_bins)
+    with np.errstate(invalid="ignore"):
+        return (sums / counts).reshape(n_oids, n_bins)
+
+
+def _nanmedian_columns(a):
+    """np.nanmedian() of each column of `a`, NaN for columns without a finite value (without the warning of np.nanmedian())"""
+    median = np.full(a.shape[1], np.nan)
+    cols = np.isfinite(a).any(axis=0)
+    median[cols] = np.nanmedian(a[:, cols], axis=0)
+    return median
+
+
+def obsid_mjds(base_data_dir, obsid_list, spec_stem, products):
+    """Observation start date (MJD) of each ObsID in `obsid_list`, from the header index cached in `base_data_dir`, NaN if it has no spectrum"""
+    fn_pis = {}
+    for obsid in obsid_list:
+        ddir = products.data_dir(obsid, spec_stem)
+        fns = products.files(ddir, "*source.pi") if ddir is not None else []
+        if fns:
+            fn_pis[obsid] = fns[0]
+    mjds = dict(zip(fn_pis, header_index.HeaderIndex.for_base_data_dir(base_data_dir).mjds(list(fn_pis.values()))))
+    return np.array([mjds.get(obsid, np.nan) for obsid in obsid_list], dtype=float)
+
+
+def plot_sed_aggregate(base_data_dir, obsid_list, spec_stem, model, view="percentiles", color_by_mjd=False, n_bins=SED_GRID_BINS, products=None):
+    """Plot the data points of ObsIDs in `obsid_list` for one `model` as a whole, with a fixed number of artists whatever the number of ObsIDs,
+    saved as `base_data_dir`/spec_`model`_all_obsids.png like `overplot_all_obsids_for_model()`. The spec_default_bin.dat of every ObsID are
+    read at once by read_output.load_model_spectra(), from `products` (a product_index.ProductIndex; by default, the index cached in
+    `base_data_dir`), onto `n_bins` log-spaced energy bins.
+
+    Parameters
+    ----------
+    view : str
+        "percentiles": the median and the 68% and 95% bands (SED_PERCENTILES) of the mean energy flux of every ObsID in each energy bin;
+        "density": the number of points of all ObsIDs in each bin of energy and energy flux
+    color_by_mjd : bool
+        "percentiles": also the median SED of each of SED_MJD_GROUPS groups of ObsIDs in order of MJD, colored by their mean MJD;
+        "density": the mean MJD of the points in each bin instead of their number
+
+    Returns
+    -------
+    plot_path : str or None
+        The plot, or None if no ObsID has a spectrum for `model`
+    """
+
+    if products is None:
+        products = product_index.load(base_data_dir, obsid_list)
+    oids, offsets, energy, energy_half_bin_width, eflux, eflux_err, mdl_eflux = read_output.load_model_spectra(base_data_dir, model, spec_stem,
+                                                                                                                products=products)
+    # Only the ObsIDs asked for
+    keep = np.isin(oids, obsid_list)
+    counts = np.diff(offsets)[keep]
+    points = np.repeat(keep, np.diff(offsets))
+    oids, energy, eflux = oids[keep], energy[points], eflux[points]
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    if len(oids) == 0:
+        msg = f"No spec_default_bin.dat of {model} for the {len(obsid_list)} ObsIDs; no plot of them all"
+        print(msg)
+        logging.warning(msg)
+        return None
+    mjds = obsid_mjds(base_data_dir, oids, spec_stem, products) if color_by_mjd else None
+
+    plt.rcParams.update(SED_RCPARAMS)
+    plt.style.use('tableau-colorblind10')
+    fig, ax = plt.subplots()
+    edges = np.geomspace(*models.E_NOTICE, n_bins + 1)
+    if view == "percentiles":
+        grid = sed_grid(energy, eflux, offsets, edges)
+        centers = np.sqrt(edges[:-1] * edges[1:])
+        if color_by_mjd:
+            # ObsIDs in order of MJD, in groups of about the same number of ObsIDs; those without an MJD are left out
+            order = np.argsort(mjds)[:np.isfinite(mjds).sum()]
+            groups = [group for group in np.array_split(order, min(SED_MJD_GROUPS, len(order))) if len(group)]
+            medians = np.array([_nanmedian_columns(grid[group]) for group in groups])
+            # NaN (bins without points) breaks the line of a group
+            lines = LineCollection(np.stack([np.broadcast_to(centers, medians.shape), medians], axis=-1),
+                                   array=np.array([mjds[group].mean() for group in groups]), cmap="viridis", lw=1.5)
+            ax.add_collection(lines)
+            fig.colorbar(lines, ax=ax, label="Mean MJD of each group of ObsIDs")
+        # Bins where no ObsID has a point are left out
+        cols = np.isfinite(grid).any(axis=0)
+        lo95, lo68, median, hi68, hi95 = np.nanpercentile(grid[:, cols], SED_PERCENTILES, axis=0)
+        ax.fill_between(centers[cols], lo95, hi95, color="tab:blue", alpha=0.2, lw=0, label="95% of ObsIDs")
+        ax.fill_between(centers[cols], lo68, hi68, color="tab:blue", alpha=0.4, lw=0, label="68% of ObsIDs")
+        ax.plot(centers[cols], median, color="k", label="Median")
+        ax.legend()
+    elif view == "density":
+        positive = np.isfinite(eflux) & (eflux > 0)
+        flux_min, flux_max = eflux[positive].min(), eflux[positive].max()
+        if flux_max <= flux_min:
+            # All points at one flux
+            flux_min, flux_max = flux_min / 2, flux_max * 2
+        flux_edges = np.geomspace(flux_min, flux_max, n_bins + 1)
+        n_points, _, _ = np.histogram2d(energy[positive], eflux[positive], bins=[edges, flux_edges])
+        if color_by_mjd:
+            sum_mjd, _, _ = np.histogram2d(energy[positive], eflux[positive], bins=[edges, flux_edges],
+                                           weights=np.repeat(mjds, np.diff(offsets))[positive])
+            with np.errstate(invalid="ignore"):
+                image = ax.pcolormesh(edges, flux_edges, (sum_mjd / n_points).T, cmap="viridis", vmin=np.nanmin(mjds),
+                                      vmax=np.nanmax(mjds), rasterized=True)
+            fig.colorbar(image, ax=ax, label="Mean MJD")
+        else:
+            image = ax.pcolormesh(edges, flux_edges, np.ma.masked_equal(n_points, 0).T, norm=LogNorm(), cmap="viridis", rasterized=True)
+            fig.colorbar(image, ax=ax, label="Spectral points")
+    else:
+        raise ValueError(f"Unknown view of the SEDs of all ObsIDs: {view}; expected one of {SED_VIEWS[1:]}")
+    ax.set_title(f"{MODELS_PLOT_DICT[model]}: {len(oids)} ObsIDs")
+    ax.set_xlabel("Energy [keV]")
+    ax.set_ylabel(r"Flux(2-10 keV) [keV/cm$^2$/s]")
+    ax.set_xscale("log")
+    ax.set_yscale("log")
+    plot_path = os.path.join(base_data_dir, f"spec_{model}_all_obsids.png")
+    fig.savefig(plot_path)
+    plt.close(fig)
+    msg = f"Wrote {plot_path}"
+    print(msg)
+    logging.info(msg)
+
+    return plot_path
+
+
+def plot_sed_all_obsids(base_data_dir, obsid_list, spec_stem, model, view="auto", color_by_mjd=False, products=None):
+    """Plot the data points of ObsIDs in `obsid_list` for one `model` in view `view`, one of SED_VIEWS or "auto": "obsids" for
+    `overplot_all_obsids_for_model()`, with one marker and legend entry per ObsID, or one of the views of `plot_sed_aggregate()`.
+    "auto" is "obsids" for at most MAX_OBSIDS_OVERPLOT ObsIDs and "percentiles" for more."""
+    if view == "auto":
+        view = "obsids" if len(obsid_list) <= MAX_OBSIDS_OVERPLOT else "percentiles"
+    if view == "obsids":
+        return overplot_all_obsids_for_model(base_data_dir, obsid_list, spec_stem, model, products)
+    return plot_sed_aggregate(base_data_dir, obsid_list, spec_stem, model, view, color_by_mjd, products=products)
+
+
+def lightcurve_tbl(base_data_dir, fn_tbl, incremental=False, engine=None, products=None):
     """Write lightcurve info to astropy Table saved as comma-separated file named `base_data_dir`/`fn_tbl`.
-    The file has explicit header: mjd,flux,flux_errn,flux_errp,model
+    The file has explicit header: mjd,flux,flux_errn,flux_errp,model, and is sorted by MJD.
     The lightcurve is made with one point per ObsID using the integral flux from the ObsID's SED.
-    This function will recursively search for *all* parameter files (param_tbl.dat) within `base_data_dir` that also include a subdirectory /USERPROD*/.
+    This function uses *all* parameter files (param_tbl.dat) in `base_data_dir`, at the depth they are written to,
+    {OID}/USERPROD*/{SPEC_STEM}/{model}/param_tbl.dat, as found in `products` (a product_index.ProductIndex; by default, the index cached in
+    `base_data_dir`, refreshed).
+
+    The (ObsID, model, modification time) of every parameter file read, and its lightcurve point, are saved next to the table in
+    `fn_tbl`.state.json. If `incremental`, only the parameter files that are new or changed since are read, and merged with the points
+    already there.
+
+    The flux is the 2-10 keV photon flux in param_tbl.dat, unless `engine` (a flux_engine.FluxEngine) is given: then it is the engine's flux,
+    computed for all the new fits of each model at once. Points of another flux than the one asked for are read again.
 
     Returns
     -------
     The astropy Table object with lightcurve data, so it is ready for plotting
     """
 
-    # Dict to store all data to be saved to table `fn_tbl`
-    data = {}
-
-    # Array/list to save all data to
-    flux_arr, flux_errn_arr, flux_errp_arr, mjd_arr, models = [], [], [], [], []
-
+    state_fn = os.path.join(base_data_dir, f"{fn_tbl}{LIGHTCURVE_STATE_SUFFIX}")
+    state = {}
+    if incremental and os.path.exists(state_fn):
+        with open(state_fn, 'r') as f:
+            state = json.load(f)
+    if products is None:
+        products = product_index.load(base_data_dir)
     # Find all instances where param_tbl.dat could be written
     # This will of course not include cases where the fit failed such that this file could not be written for certain models. This may happen in some cases
-    files = glob.glob(f"{base_data_dir}/**/USERPROD*/**/param_tbl.dat", recursive=True)
+    files = products.glob("*", "*", "*", "param_tbl.dat")
+
+    # Lightcurve point of each parameter file, keyed by its path relative to `base_data_dir`. Parameter files that no longer exist are dropped
+    entries = {}
+    to_read = []
+    flux_def = engine.label if engine is not None else PARAM_TBL_FLUX
     for f in files:
-        # Photon flux
-        flux, flux_errn, flux_errp = read_output.get_integral_phflux(f)
-        flux_arr.append(flux)
-        flux_errn_arr.append(flux_errn)
-        flux_errp_arr.append(flux_errp)
+        key = os.path.relpath(f, base_data_dir)
+        mtime_ns = os.stat(f).st_mtime_ns
+        if key in state and state[key]["mtime_ns"] == mtime_ns and state[key].get("flux_def", PARAM_TBL_FLUX) == flux_def:
+            entries[key] = state[key]
+        else:
+            to_read.append((key, f, mtime_ns))
+
+    # Source spectrum of each directory with fit results. Several models share one spectrum, so only look for it once per directory
+    pi_fns = {}
+    fn_pis = []
+    fluxes = {}
+    if engine is None:
+        for key, f, mtime_ns in to_read:
+            # Photon flux
+            fluxes[key] = read_output.get_integral_phflux(f)
+    else:
+        # One batch per model
+        by_model = {}
+        for key, f, mtime_ns in to_read:
+            by_model.setdefault(os.path.basename(os.path.dirname(f)), []).append((key, f))
+        for model, fits in by_model.items():
+            if model not in flux_engine.QUICK_MODELS:
+                msg = f"The flux engine has no spectral model for {model}, so its {len(fits)} fit(s) are left out of the lightcurve"
+                print(msg)
+                logging.warning(msg)
+                continue
+            for (key, _), flux in zip(fits, zip(*engine.fluxes(model, [f for _, f in fits]))):
+                fluxes[key] = flux
+    to_read = [(key, f, mtime_ns) for key, f, mtime_ns in to_read if key in fluxes]
+
+    for key, f, mtime_ns in to_read:
+        flux, flux_errn, flux_errp = fluxes[key]
         # ../output/00032646038/USERPROD_223833/powlaw_tbabs/param_tbl.dat -> ../output/00032646038/USERPROD_223833/
         pi_dir = os.path.dirname(os.path.dirname(f))
-        # This is expected to be a one-element list ... TODO add check of this?
-        fn_pi = glob.glob(f"{pi_dir}/*source.pi")[0]
-        mjd = utils.get_observation_start_date(fn_pi)
-        mjd_arr.append(mjd)
-        # ../output/00032646038/USERPROD_223833/powlaw_ztbabs_tbabs/param_tbl.dat -> powlaw_ztbabs_tbabs
-        models.append(os.path.basename(os.path.dirname(f)))
-
-    data["mjd"] = mjd_arr
-    data["flux"] = flux_arr
-    data["flux_errn"] = flux_errn_arr
-    data["flux_errp"] = flux_errp_arr
-    data["model"] = models
+        if pi_dir not in pi_fns:
+            # This is expected to be a one-element list ... TODO add check of this?
+            pi_fns[pi_dir] = products.files(pi_dir, "*source.pi")[0]
+        fn_pis.append(pi_fns[pi_dir])
+        entries[key] = {
+            "oid": key.split(os.sep)[0],
+            # ../output/00032646038/USERPROD_223833/powlaw_ztbabs_tbabs/param_tbl.dat -> powlaw_ztbabs_tbabs
+            "model": os.path.basename(os.path.dirname(f)),
+            "mtime_ns": mtime_ns,
+            "flux_def": flux_def,
+            "flux": float(flux), "flux_errn": float(flux_errn), "flux_errp": float(flux_errp),
+            }
+
+    # Observation start dates of all new spectra at once, from the cached header index
+    mjds = header_index.HeaderIndex.for_base_data_dir(base_data_dir).mjds(fn_pis)
+    for (key, _, _), mjd in zip(to_read, mjds):
+        entries[key]["mjd"] = mjd
+
+    tmp = f"{state_fn}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(entries, f)
+    os.replace(tmp, state_fn)
+    msg = f"Read {len(to_read)} new or changed parameter file(s); {len(entries) - len(to_read)} unchanged"
+    print(msg)
+    logging.info(msg)
+
+    # Columns of the table `fn_tbl`, merging the new and unchanged points in order of MJD
+    names = ("mjd", "flux", "flux_errn", "flux_errp", "model")
+    rows = sorted(entries.values(), key=lambda e: (e["mjd"], e["model"]))
+    data = [[e[col] for e in rows] for col in names]
 
     # Create table so user can plot it however they want
-    t = Table(data)
+    t = Table(data, names=names, dtype=(float, float, float, float, str))
     t.write(os.path.join(base_data_dir, fn_tbl), format='csv', overwrite=True) 
     msg = f"Wrote {os.path.join(base_data_dir, fn_tbl)}"
     print(msg)
@@ -218,29 +437,34 @@ def lightcurve_tbl(base_data_dir, fn_tbl):
     return t
 
 
-def overplot_all_models_for_obsid(base_data_dir, obsid, spec_stem, model_list):
+def overplot_all_models_for_obsid(base_data_dir, obsid, spec_stem, model_list, fig=None, products=None):
     """Plot data points of all models in `model_list` for one ObsID `obsid` on the same plot. 
     Plot is saved as `base_data_dir`/spec_all_models_`obsid`.png
     The chi-squared and degrees of freedom for each model are included in the plot legend.
     This is to check how much of an impact, if any, the choice of model has on the unfolded spectral points (`ufspec` in XSpec).
     This function will recursively search for *all* parameter files (param_tbl.dat) within `base_data_dir` that also include a subdirectory /USERPROD*/.
+    If `fig` is given, it is cleared and drawn on instead of making a new figure (see `render_obsid_plots()`).
+    The spectra are found in `products` (a product_index.ProductIndex); by default, the directories of `obsid` are listed.
     """
 
-    # Global SED plot parameters
-    plt.rcParams.update(
-        {'font.size': 18, 'figure.figsize': (14, 10), 'axes.grid.which': 'both',
-            'grid.color': 'lightgrey', 'grid.linestyle': 'dotted', 'axes.grid': True, 'axes.labelsize': 18,
-            'legend.fontsize': 11})
-    plt.style.use('tableau-colorblind10')
+    if products is None:
+        products = product_index.for_oid(base_data_dir, obsid)
+
+    if fig is None:
+        plt.rcParams.update(SED_RCPARAMS)
+        plt.style.use('tableau-colorblind10')
+        plt.figure()
+    else:
+        # Reused figure of a rendering worker, whose rcParams and style were set once
+        fig.clf()
+        plt.figure(fig.number)
     marker_cycle = itertools.cycle(['o', '^', 's', 'D', '*', 'v', 'p', 'x'])
 
-    plt.figure()
-
     for model in model_list:
         
         spec_dir = os.path.join(base_data_dir, obsid, "USERPROD*", spec_stem, model, "spec_default_bin.dat")
         # This is expected to be a one-element list
-        spec_fn = glob.glob(spec_dir)
+        spec_fn = products.glob(obsid, spec_stem, model, "spec_default_bin.dat")
 
         if len(spec_fn) != 1:
             msg = f"Error with {spec_fn} attempting to glob {spec_dir} for spec_default_bin.dat. Expected one file from glob search but there are many or 0. Skipping this." 
@@ -277,7 +501,7 @@ def overplot_all_models_for_obsid(base_data_dir, obsid, spec_stem, model_list):
     plt.ylabel(r"Flux [keV/cm$^2$/s]")
     plt.loglog()
     plt.legend()
-    plot_path = os.path.join(base_data_dir, f"spec_all_models_{obsid}.png")
+    plot_path = obsid_plot_path(base_data_dir, obsid)
     plt.savefig(plot_path)
     msg = f"Wrote {plot_path}"
     print(msg)
@@ -286,8 +510,10 @@ def overplot_all_models_for_obsid(base_data_dir, obsid, spec_stem, model_list):
     return None
 
 
-def lightcurve_plt(base_data_dir, fn_plot="lightcurve_phflux.png", fn_tbl="lightcurve.csv", models=["powlaw_tbabs", "logpar_tbabs", "powlaw_ztbabs_tbabs"]):
-    """First make a table of lightcurve values save to `base_data_dir`/`fn_tbl`.
+def lightcurve_plt(base_data_dir, fn_plot="lightcurve_phflux.png", fn_tbl="lightcurve.csv", models=["powlaw_tbabs", "logpar_tbabs", "powlaw_ztbabs_tbabs"],
+                   incremental=False, engine=None, products=None):
+    """First make a table of lightcurve values save to `base_data_dir`/`fn_tbl` (only reading new fits if `incremental`, see `lightcurve_tbl()`;
+    the fluxes are those of `engine`, a flux_engine.FluxEngine, if given).
     Then plot this lightcurve using fluxes from all models in `models` (this can be a one-element list), and save it to `base_data_dir`/`fn_plot`.
     The lightcurve is made with one point per ObsID using the integral flux from the ObsID's SED.
     """
@@ -306,7 +532,7 @@ def lightcurve_plt(base_data_dir, fn_plot="lightcurve_phflux.png", fn_tbl="light
             'legend.fontsize': 11})
     plt.style.use('tableau-colorblind10')
 
-    t = lightcurve_tbl(base_data_dir, fn_tbl)
+    t = lightcurve_tbl(base_data_dir, fn_tbl, incremental, engine, products)
 
     fig, ax1 = plt.subplots()
     # Make a plot separating out the different models
@@ -320,7 +546,10 @@ def lightcurve_plt(base_data_dir, fn_plot="lightcurve_phflux.png", fn_tbl="light
     ax2 = ax1.secondary_xaxis('top', functions=(mjd_to_year, year_to_mjd))
 
     ax1.set_xlabel('MJD')
-    ax1.set_ylabel(r'Photon flux [ph/cm$^2$/s]')
+    if engine is None:
+        ax1.set_ylabel(r'Photon flux [ph/cm$^2$/s]')
+    else:
+        ax1.set_ylabel(f"{engine.label[0].upper()}{engine.label[1:]} [{engine.unit}]")
     plt.legend()
     plt.savefig(os.path.join(base_data_dir, fn_plot))
     msg = f"Wrote {os.path.join(base_data_dir, fn_plot)}"
@@ -330,12 +559,198 @@ def lightcurve_plt(base_data_dir, fn_plot="lightcurve_phflux.png", fn_tbl="light
     return None
 
 
+def delta_stat(stat, stat_best):
+    """Chi-squared above the minimum of each grid in `stat` (shape (..., n_x, n_y), e.g. the grids of many ObsIDs stacked), all at once.
+    The minimum is the lower of the grid's and `stat_best` (chi-squared of the best fit, one per grid), as the grid may find a lower one."""
+    stat = np.asarray(stat, dtype=float)
+    minimum = np.fmin(np.nanmin(stat, axis=(-2, -1)), stat_best)
+    return stat - np.asarray(minimum)[..., None, None]
+
+
+def plot_contour(fn_contour, fn_plot, pair, levels=CONTOUR_LEVELS):
+    """Plot the confidence regions of parameters `pair` in `fn_contour` (contour_{param 1}_{param 2}.npz, from contours.py) at `levels` of
+    chi-squared above the minimum, with the best fit, and save the plot as `fn_plot`."""
+
+    x, y, stat, best, stat_best = read_output.read_contour(fn_contour)
+    fig, ax = plt.subplots(figsize=(10, 8))
+    # contour() takes the first axis of the array as y
+    cs = ax.contour(x, y, delta_stat(stat, stat_best).T, levels=levels, colors=["tab:blue", "tab:orange", "tab:green"])
+    ax.clabel(cs, fmt={level: f"{label}" for level, label in zip(levels, ("68.3%", "95.4%", "99.7%"))})
+    ax.plot(*best, marker="+", color="k", ls=" ", ms=12, label="Best fit")
+    ax.set_xlabel(pair[0])
+    ax.set_ylabel(pair[1])
+    ax.legend()
+    fig.savefig(fn_plot)
+    plt.close(fig)
+    msg = f"Wrote {fn_plot}"
+    print(msg)
+    logging.info(msg)
+
+
+def overplot_contours_all_obsids(base_data_dir, obsid_list, spec_stem, model, pair, level=CONTOUR_LEVELS[0], products=None):
+    """Plot the confidence region at `level` (default 1 sigma) of parameters `pair` of `model` for every ObsID in `obsid_list` that has one
+    (from contours.py) on the same plot, saved as `base_data_dir`/contour_`model`_`pair[0]`_`pair[1]`_all_obsids.png. As a check of
+    variability, like `overplot_all_obsids_for_model()`. Grids of the same shape are read into one array and their chi-squared above the
+    minimum computed at once. The grids are found in `products` (a product_index.ProductIndex); by default, the index cached in `base_data_dir`.
+
+    Returns
+    -------
+    plot_path : str or None
+        The plot, or None if no ObsID has contours of `pair`
+    """
+
+    if products is None:
+        products = product_index.load(base_data_dir, obsid_list)
+    fn_contour = read_output.CONTOUR_TBL.format(*pair)
+    oids, grids = [], []
+    for obsid in obsid_list:
+        for fn in products.glob(obsid, spec_stem, model, fn_contour):
+            oids.append(obsid)
+            grids.append(read_output.read_contour(fn))
+    if not grids:
+        return None
+
+    fig, ax = plt.subplots(figsize=(10, 8))
+    colors = itertools.cycle(plt.rcParams['axes.prop_cycle'].by_key()['color'])
+    shapes = {grid[2].shape for grid in grids}
+    if len(shapes) == 1:
+        delta = delta_stat(np.stack([grid[2] for grid in grids]), np.array([grid[4] for grid in grids]))
+    else:
+        delta = [delta_stat(grid[2], grid[4]) for grid in grids]
+    for obsid, (x, y, stat, best, stat_best), d in zip(oids, grids, delta):
+        color = next(colors)
+        ax.contour(x, y, d.T, levels=[level], colors=[color])
+        ax.plot(*best, marker="+", color=color, ls=" ", ms=10, label=f"ObsID {obsid}")
+    ax.set_title(f"{MODELS_PLOT_DICT[model]}: " + r"$\Delta\chi^2$" + f" = {level:g}")
+    ax.set_xlabel(pair[0])
+    ax.set_ylabel(pair[1])
+    ax.legend()
+    plot_path = os.path.join(base_data_dir, f"contour_{model}_{pair[0]}_{pair[1]}_all_obsids.png")
+    fig.savefig(plot_path)
+    plt.close(fig)
+    msg = f"Wrote {plot_path}"
+    print(msg)
+    logging.info(msg)
+
+    return plot_path
+
+
+def _days_from_civil(year):
+    """Days from 1970-01-01 to 1 January of (Gregorian) `year`, for an array of years held as floats"""
+    # Years counted from 1 March, so the leap day is the last day of the year before
+    y = np.asarray(year, dtype=float) - 1
+    era = np.floor(y / 400)
+    # Infinite years (matplotlib may transform infinite limits) come out as NaN
+    with np.errstate(invalid='ignore'):
+        yoe = y - era * 400
+    # 306 days from 1 March to 1 January
+    doe = yoe * 365 + np.floor(yoe / 4) - np.floor(yoe / 100) + 306
+    return era * 146097 + doe - 719468
+
+
 def mjd_to_year(t):
-    return Time(t, format='mjd').decimalyear
+    """Decimal year of MJD `t` (the fraction of the year that has passed, as astropy's decimalyear but ignoring leap seconds).
+    This is closed-form and works on whole arrays, so it is cheap enough for matplotlib to call on every tick transform."""
+    days = np.asarray(t, dtype=float) - MJD_UNIX_EPOCH
+    year = np.floor(1970 + days / 365.2425)
+    # The estimate can be one year off close to 1 January
+    year = np.where(_days_from_civil(year) > days, year - 1, year)
+    year = np.where(_days_from_civil(year + 1) <= days, year + 1, year)
+    start = _days_from_civil(year)
+    return year + (days - start) / (_days_from_civil(year + 1) - start)
 
 
 def year_to_mjd(t):
-    return Time(t, format='decimalyear').mjd
+    """Inverse of `mjd_to_year()`"""
+    t = np.asarray(t, dtype=float)
+    year = np.floor(t)
+    start = _days_from_civil(year)
+    return MJD_UNIX_EPOCH + start + (t - year) * (_days_from_civil(year + 1) - start)
+
+
+def obsid_plot_path(base_data_dir, obsid):
+    """Plot written by `overplot_all_models_for_obsid()`"""
+    return os.path.join(base_data_dir, f"spec_all_models_{obsid}.png")
+
+
+def plot_is_stale(plot_path, inputs):
+    """True if `plot_path` does not exist or is older than any of the files `inputs` it is made from (missing inputs are ignored)"""
+    if not os.path.exists(plot_path):
+        return True
+    mtime_ns = os.stat(plot_path).st_mtime_ns
+    return any(os.stat(fn).st_mtime_ns > mtime_ns for fn in inputs if os.path.exists(fn))
+
+
+def obsid_plot_inputs(base_data_dir, obsid, spec_stem, model_list, products):
+    """Tables that `overplot_all_models_for_obsid()` reads for ObsID `obsid`, as found in `products` (a product_index.ProductIndex)"""
+    return [fn for model in model_list for basename in ("spec_default_bin.dat", "param_tbl.dat", "stat_tbl.dat")
+            for fn in products.glob(obsid, spec_stem, model, basename)]
+
+
+def _init_render_worker(log_fn=None, products=None):
+    """Set up a rendering process once: the headless Agg backend, the SED plot parameters, the figure reused for all its ObsIDs,
+    and the product index they are found in"""
+    global _RENDER_FIG, _RENDER_PRODUCTS
+    _RENDER_PRODUCTS = products
+    if log_fn is not None and not logging.getLogger().handlers:
+        logging.basicConfig(filename=log_fn, level=logging.INFO, format='%(levelname)s - %(funcName)s - %(message)s')
+    plt.switch_backend("Agg")
+    plt.rcParams.update(SED_RCPARAMS)
+    plt.style.use('tableau-colorblind10')
+    _RENDER_FIG = plt.figure()
+
+
+def _render_obsid(base_data_dir, obsid, spec_stem, model_list):
+    overplot_all_models_for_obsid(base_data_dir, obsid, spec_stem, model_list, fig=_RENDER_FIG, products=_RENDER_PRODUCTS)
+    return obsid
+
+
+def render_obsid_plots(base_data_dir, oids, spec_stem, model_list=MODELS, max_workers=None, changed_only=False, log_fn=None, products=None):
+    """`overplot_all_models_for_obsid()` for every ObsID in `oids`, across a pool of `max_workers` processes (default: number of CPUs).
+    Each process draws with the Agg backend and reuses one figure for all of its ObsIDs.
+
+    Parameters
+    ----------
+    changed_only : bool
+        Only plot the ObsIDs whose plot is missing or older than one of the tables it is made from
+    log_fn : str
+        Log file of the rendering processes, if they do not inherit the logging set up of this one
+    products : product_index.ProductIndex
+        Where to find the tables of each ObsID; by default, the index cached in `base_data_dir`, refreshed for `oids`
+
+    Returns
+    -------
+    plotted : list[str]
+        ObsIDs whose plot was written
+    """
+
+    if products is None:
+        products = product_index.load(base_data_dir, oids)
+    if changed_only:
+        n_all = len(oids)
+        oids = [oid for oid in oids
+                if plot_is_stale(obsid_plot_path(base_data_dir, oid), obsid_plot_inputs(base_data_dir, oid, spec_stem, model_list, products))]
+        msg = f"{n_all - len(oids)} of {n_all} ObsID plot(s) are up to date"
+        print(msg)
+        logging.info(msg)
+    if not oids:
+        return []
+
+    plotted = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_init_render_worker,
+                                                initargs=(log_fn, products)) as pool:
+        futures = {pool.submit(tracing.run_traced, "plot", "analyse", {"oid": oid}, _render_obsid, base_data_dir, oid, spec_stem, model_list): oid
+                   for oid in oids}
+        for future in concurrent.futures.as_completed(futures):
+            # One bad ObsID should not stop the plots of the others
+            try:
+                plotted.append(future.result())
+            except Exception as err:
+                msg = f"Could not plot ObsID {futures[future]}: {err!r}"
+                print(msg)
+                logging.error(msg)
+
+    return plotted
 
 
 if __name__ == "__main__":
@@ -344,19 +759,55 @@ if __name__ == "__main__":
     # *Optional* argument with default
     parser.add_argument(
         "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--incremental", action="store_true", help="Only read the fits that are new or changed since the lightcurve was last made")
+    parser.add_argument(
+        "--changed_only", action="store_true", help="Only make the SED plots whose tables changed since the plot was written")
+    parser.add_argument(
+        "--max_workers", type=int, default=None, help="Number of processes plotting the SED of each ObsID (default: number of CPUs)")
+    parser.add_argument(
+        "--sed_view", choices=("auto",) + SED_VIEWS, default="auto",
+        help=f"Plot of the SEDs of all ObsIDs: one marker per ObsID ('obsids'), or aggregated into percentile bands or a density image; "
+             f"'auto' aggregates past {MAX_OBSIDS_OVERPLOT} ObsIDs")
+    parser.add_argument(
+        "--color_by_mjd", action="store_true", help="Color the aggregated SEDs of all ObsIDs by MJD")
+    parser.add_argument(
+        "--band", type=float, nargs=2, default=None, metavar=("E_LOW", "E_HIGH"),
+        help="Energy band (keV) of the lightcurve, computed from the fits by flux_engine.py (default: the 2-10 keV flux of the fits)")
+    parser.add_argument(
+        "--energy_flux", action="store_true", help="Lightcurve of the energy flux (erg/cm^2/s), computed by flux_engine.py")
     args = parser.parse_args()
     cfg_filename = args.cfg_fn
 
     oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
 
-    logging.basicConfig(filename=os.path.join(base_data_dir, "_analyse_output.log"),
+    log_fn = os.path.join(base_data_dir, "_analyse_output.log")
+    logging.basicConfig(filename=log_fn,
                         level=logging.INFO,
                         format='%(levelname)s - %(funcName)s - %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S'
                         )
-
-    lightcurve_plt(base_data_dir)
-    overplot_all_obsids_for_model(base_data_dir, oids, spec_stem, "powlaw_tbabs")
-    for obsid in oids:
-        overplot_all_models_for_obsid(base_data_dir, obsid, spec_stem, MODELS)
+    # Plots are only written to file
+    plt.switch_backend("Agg")
+
+    tracing.configure(cfg_filename)
+    with tracing.span("analyse", tracing.STAGE):
+        # Every output table of every ObsID is found once
+        products = product_index.load(base_data_dir)
+        with tracing.span("lightcurve", "analyse"):
+            engine = None
+            if args.band or args.energy_flux:
+                engine = flux_engine.engine_from_cfg(cfg_filename, args.band or models.FLUX_BAND, args.energy_flux)
+            fn_plot = "lightcurve_phflux.png" if engine is None else f"lightcurve_{'eflux' if args.energy_flux else 'phflux'}_{engine.band[0]:g}-{engine.band[1]:g}keV.png"
+            lightcurve_plt(base_data_dir, fn_plot=fn_plot, incremental=args.incremental, engine=engine, products=products)
+        all_obsids_inputs = [fn for oid in oids for fn in products.glob(oid, spec_stem, "powlaw_tbabs", "spec_default_bin.dat")]
+        if not args.changed_only or plot_is_stale(os.path.join(base_data_dir, "spec_powlaw_tbabs_all_obsids.png"), all_obsids_inputs):
+            with tracing.span("all ObsIDs plot", "analyse"):
+                plot_sed_all_obsids(base_data_dir, oids, spec_stem, "powlaw_tbabs", args.sed_view, args.color_by_mjd, products)
+        # Confidence regions of every ObsID, if contours.py was run
+        for model_name in MODELS:
+            for pair in models.REGISTRY[model_name].contours:
+                overplot_contours_all_obsids(base_data_dir, oids, spec_stem, model_name, pair, products=products)
+        render_obsid_plots(base_data_dir, oids, spec_stem, MODELS, max_workers=args.max_workers, changed_only=args.changed_only, log_fn=log_fn,
+                           products=products)
         
\ No newline at end of file
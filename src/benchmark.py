@@ -0,0 +1,85 @@
+"""
+Timings of the parts of the workflow that were made faster, on the output in BASE_DATA_DIR, so a speedup (or a regression) can be checked
+on real data. Each benchmark prints the time of the old and the new way of doing the same thing.
+
+    python benchmark.py --cfg_fn default_config.cfg
+
+That the stages of `xrt-workflow` that do not plot start quickly is checked by tests/test_startup.py, and the analysis stages are timed on
+synthetic datasets of many ObsIDs by tests/test_benchmark_stages.py (pytest-benchmark).
+"""
+
+
+from astropy.table import Table
+import argparse
+import glob
+import os
+import time
+
+import models
+import read_output
+import utils
+
+
+def _best_time(func, repeat):
+    """Shortest wall time (s) of `repeat` calls to `func`, which is less noisy than the mean"""
+    best = float("inf")
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t_start)
+    return best
+
+
+def _report(name, t_old, t_new, n):
+    msg = f"{name}: {n} file(s), astropy {t_old * 1e3:.2f} ms, NumPy {t_new * 1e3:.2f} ms ({t_old / t_new:.1f}x)"
+    print(msg)
+    return msg
+
+
+def _astropy_spec(fn):
+    t = Table.read(fn, format='ascii.no_header')
+    return [t[c].data for c in t.colnames]
+
+
+def _astropy_tbl(fn):
+    t = Table.read(fn, format='ascii')
+    return [t[c].data for c in t.colnames]
+
+
+def bench_readers(base_data_dir, spec_stem, repeat=5):
+    """Astropy Table.read (the readers before) against the NumPy readers in read_output, over every output table in `base_data_dir`."""
+
+    pattern = os.path.join(base_data_dir, "*", "USERPROD*", spec_stem, "*", "{}")
+    cases = [("spec_default_bin.dat", _astropy_spec, read_output.read_tcloutr_spec_data),
+             ("param_tbl.dat", _astropy_tbl, read_output.read_param_tbl),
+             ("stat_tbl.dat", _astropy_tbl, read_output.read_stat_tbl)]
+    for basename, old, new in cases:
+        fns = glob.glob(pattern.format(basename))
+        if not fns:
+            continue
+        t_old = _best_time(lambda: [old(fn) for fn in fns], repeat)
+        t_new = _best_time(lambda: [new(fn) for fn in fns], repeat)
+        _report(basename, t_old, t_new, len(fns))
+
+    # All spectra of one model at once, against one astropy read per spectrum
+    for model in models.MODELS:
+        fns = glob.glob(os.path.join(base_data_dir, "*", "USERPROD*", spec_stem, model, "spec_default_bin.dat"))
+        if not fns:
+            continue
+        t_old = _best_time(lambda: [_astropy_spec(fn) for fn in fns], repeat)
+        t_new = _best_time(lambda: read_output.load_model_spectra(base_data_dir, model, spec_stem), repeat)
+        _report(f"load_model_spectra({model})", t_old, t_new, len(fns))
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Times the fast paths of the workflow against the old ones.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Each timing is the shortest of this many runs")
+    args = parser.parse_args()
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(args.cfg_fn)
+    bench_readers(base_data_dir, spec_stem, args.repeat)
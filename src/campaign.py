@@ -0,0 +1,220 @@
+"""
+Campaign mode: the fits of many targets, one config file each (e.g. dozens of monitored blazars), through one pool of workers, instead of one
+copy of the workflow per target each with its own pool.
+
+    python campaign.py --cfg_fns blazar_1.cfg blazar_2.cfg ... [--max_workers N] [--lightcurve]
+
+or `python campaign.py --cfg_fns @campaign.txt`, with the config files listed in campaign.txt, one per line.
+
+The ObsIDs of every target (each an XSpec session fitting every model, as in fit_scheduler.py) go into one queue, run by one pool of
+`--max_workers` workers (default: number of CPUs). Scheduling is fair across targets: a free worker takes the next ObsID of the target with
+the fewest ObsIDs running (then with the fewest started), so the workers are shared evenly among the targets that have ObsIDs left, and a
+target with a few new ObsIDs is not held up behind one with hundreds.
+
+Each target keeps its own outputs, as if fit_scheduler.py had been run with its config file: the fits in its BASE_DATA_DIR, its fit logs in
+{BASE_DATA_DIR}/_fit_logs/, its results store, and, with --lightcurve, its lightcurve, updated once all its ObsIDs are fitted.
+Targets whose fit cache is in the same directory (FIT_CACHE_DIR, or --fit_cache_dir for all of them) share one fit cache and its index of
+file hashes, read once. The other caches are shared through the config files: RESPONSE_CACHE_DIR set to the same directory for every target
+shares the parsed responses (quickfit.py, flux_engine.py).
+
+The campaign's log is _campaign.log in --campaign_dir, and its trace (see tracing.py), if TRACE_FN is set in the first config file,
+is written there too, with the target of every ObsID.
+"""
+
+
+from collections import deque
+from dataclasses import dataclass, field
+import argparse
+import concurrent.futures
+import logging
+import os
+
+import fit_cache
+import fit_scheduler
+import product_index
+import results_store
+import tracing
+import utils
+from models import MODELS
+
+
+LOG_FN = "_campaign.log"
+
+
+@dataclass
+class Target:
+    """One target of the campaign: the ObsIDs of config file `cfg_fn` to fit, and where their outputs go"""
+    cfg_fn: str
+    name: str
+    base_data_dir: str
+    spec_stem: str
+    # Config variables, from utils.read_cfg()
+    variables: dict
+    tasks: list
+    products: product_index.ProductIndex = None
+    cache: fit_cache.FitCache = None
+    # Tasks not started yet
+    pending: deque = field(default_factory=deque)
+    started: int = 0
+    running: int = 0
+
+    @property
+    def log_dir(self):
+        return os.path.join(self.base_data_dir, "_fit_logs")
+
+    @property
+    def finished(self):
+        return not self.pending and self.running == 0
+
+
+def load_targets(cfg_fns, model_names=MODELS, fit_cache_dir=None, use_cache=True):
+    """One `Target` per config file in `cfg_fns`, with a `fit_scheduler.FitTask` per ObsID fitting every model in `model_names`.
+    Targets whose fit cache is in the same directory (`fit_cache_dir` for all of them if given) share one fit_cache.FitCache.
+
+    Returns
+    -------
+    targets : list[Target]
+    """
+
+    caches = {}
+    targets = []
+    # A config file listed twice is one target
+    for cfg_fn in dict.fromkeys(cfg_fns):
+        oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_fn)
+        variables = utils.read_cfg(cfg_fn)
+        modes = variables["MODES"]
+        if isinstance(modes, str):
+            modes = [modes]
+        cache = None
+        if use_cache:
+            cache_dir = fit_cache_dir or variables.get("FIT_CACHE_DIR") or os.path.join(base_data_dir, fit_cache.CACHE_DIRNAME)
+            if os.path.abspath(cache_dir) not in caches:
+                caches[os.path.abspath(cache_dir)] = fit_cache.FitCache(cache_dir, variables)
+            # The keys of the fits of this target depend on its variables (NH_TBABS, REDSHIFT)
+            cache = caches[os.path.abspath(cache_dir)].for_variables(variables)
+        tasks = fit_scheduler.expand_tasks(oids, modes, model_names)
+        # The data directories of all ObsIDs of the target are found once; the workers only read the index
+        targets.append(Target(cfg_fn, targ_name, base_data_dir, spec_stem, variables, tasks, product_index.load(base_data_dir, oids), cache,
+                              deque(tasks)))
+    return targets
+
+
+def next_target(targets):
+    """Target whose next ObsID is fitted next: of the targets with ObsIDs left, the one with the fewest running, then the fewest started,
+    then the first in `targets`. None if no target has ObsIDs left."""
+    return min((t for t in targets if t.pending), key=lambda t: (t.running, t.started), default=None)
+
+
+def update_lightcurve(target):
+    """Add the new fits of `target` to its lightcurve, as `analyse_output.py --incremental` does"""
+    # Only imported if a lightcurve is made: astropy and matplotlib take a while to import
+    import analyse_output
+    analyse_output.plt.switch_backend("Agg")
+    # The lightcurve reads the fits of every ObsID in BASE_DATA_DIR, not only those of the campaign, so it refreshes the whole index itself
+    with tracing.span("lightcurve", "campaign", target=target.name):
+        analyse_output.lightcurve_plt(target.base_data_dir, incremental=True)
+    analyse_output.plt.close("all")
+
+
+def run_campaign(targets, max_workers=None, lightcurve=False):
+    """Fit the ObsIDs of every target in `targets` across one pool of `max_workers` workers (default: number of CPUs), taking them from the
+    targets in turn with `next_target()`. The results of each ObsID are added to the results store of its target as soon as it is fitted,
+    in this thread; if `lightcurve`, the lightcurve of each target is updated once all its ObsIDs are fitted.
+
+    Returns
+    -------
+    targets : list[Target]
+        Same as `targets`, with the outcome of each of their tasks
+    """
+
+    max_workers = max_workers or os.cpu_count()
+    cons = {}
+    for target in targets:
+        os.makedirs(target.log_dir, exist_ok=True)
+        # Old output tables are moved here
+        os.makedirs(utils.get_trash_dir(target.variables, target.base_data_dir), exist_ok=True)
+        cons[target.cfg_fn] = results_store.connect(results_store.store_fn(target.base_data_dir))
+
+    def finish_targets():
+        """Report the targets whose ObsIDs are all fitted, and update their lightcurves"""
+        for target in [t for t in targets if t.finished and t.cfg_fn in cons]:
+            cons.pop(target.cfg_fn).close()
+            msg = fit_scheduler.summary(target.tasks, f"{target.name}: ")
+            print(msg)
+            logging.info(msg)
+            if lightcurve:
+                update_lightcurve(target)
+
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+
+        def submit():
+            """Start ObsIDs until every worker has one or no target has any left"""
+            while len(running) < max_workers:
+                target = next_target(targets)
+                if target is None:
+                    return
+                task = target.pending.popleft()
+                target.started += 1
+                target.running += 1
+                timeout = target.variables.get("FIT_TIMEOUT")
+                future = pool.submit(tracing.run_traced, "ObsID", "fit", {"target": target.name, "oid": task.oid},
+                                     fit_scheduler.run_task, task, target.variables, target.base_data_dir, target.spec_stem, target.log_dir,
+                                     float(timeout) if timeout else None, int(target.variables.get("FIT_RETRIES", 1)), target.products,
+                                     target.cache)
+                running[future] = target, task
+
+        submit()
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                target, task = running.pop(future)
+                target.running -= 1
+                fit_scheduler.store_task(cons[target.cfg_fn], fit_scheduler.task_result(future, task, f"{target.name}: "),
+                                         target.base_data_dir, target.spec_stem, target.products, f"{target.name}: ")
+            # The workers are kept busy while the lightcurves are made
+            submit()
+            finish_targets()
+    # Targets without ObsIDs
+    finish_targets()
+
+    return targets
+
+
+if __name__ == "__main__":
+    # The arguments are the names of the config files, or @ a file that lists them one per line
+    parser = argparse.ArgumentParser(description="Fits the ObsIDs of many targets, one config file each, through one pool of workers.",
+                                     fromfile_prefix_chars="@")
+    parser.add_argument(
+        "--cfg_fns", type=str, nargs="+", required=True, help="Config filenames, one per target, formatted as in the default; see that file for example.")
+    # *Optional* arguments with default
+    parser.add_argument(
+        "--models", nargs="+", default=MODELS, help="Models to fit, from the registry in models.py")
+    parser.add_argument(
+        "--max_workers", type=int, default=None, help="Number of XSpec sessions run at once across all targets (default: number of CPUs)")
+    parser.add_argument(
+        "--fit_cache_dir", type=str, default=None, help="Fit cache shared by every target, instead of the FIT_CACHE_DIR of each config file")
+    parser.add_argument(
+        "--no_cache", action="store_true", help="Fit every model again, even if its inputs did not change since it was last fitted")
+    parser.add_argument(
+        "--lightcurve", action="store_true", help="Update the lightcurve of each target once its ObsIDs are fitted")
+    parser.add_argument(
+        "--campaign_dir", type=str, default=".", help="Directory of the campaign's log and trace")
+    args = parser.parse_args()
+
+    os.makedirs(args.campaign_dir, exist_ok=True)
+    logging.basicConfig(filename=os.path.join(args.campaign_dir, LOG_FN),
+                        level=logging.INFO,
+                        format='%(levelname)s - %(funcName)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S'
+                        )
+
+    trace_fn = utils.read_cfg(args.cfg_fns[0]).get("TRACE_FN", tracing.TRACE_FN)
+    if trace_fn:
+        os.environ[tracing.ENV_VAR] = os.path.join(args.campaign_dir, trace_fn)
+    targets = load_targets(args.cfg_fns, args.models, args.fit_cache_dir, not args.no_cache)
+    msg = f"{sum(len(t.tasks) for t in targets)} ObsIDs of {len(targets)} targets: " + ", ".join(f"{t.name} ({len(t.tasks)})" for t in targets)
+    print(msg)
+    logging.info(msg)
+    with tracing.span("campaign", tracing.STAGE):
+        run_campaign(targets, args.max_workers, args.lightcurve)
@@ -0,0 +1,258 @@
+"""
+Confidence contours of pairs of parameters of each fit (e.g. PhoIndex vs norm, alpha vs beta), from chi-squared on a grid of the two
+parameters, as XSpec's `steppar` computes it: at each grid point the two parameters are frozen and the others fitted again.
+
+A single `steppar` over the whole grid in one XSpec process is slow, so the grid is split into chunks of rows (values of the first
+parameter), and each chunk is an XSpec process of its own that restores the best fit (fit.xcm, saved by the fit) and runs `steppar` over its
+rows only. The chunks of every ObsID, model and pair of parameters run across a pool of CONTOUR_WORKERS workers; the chi-squared of the
+chunks are then stitched into one array, saved next to param_tbl.dat as contour_{param 1}_{param 2}.npz
+(see read_output.read_contour()), and plotted to contour_{param 1}_{param 2}.png by analyse_output.plot_contour().
+
+The pairs of parameters of each model are `contours` in the model registry (models.py). The grid spans CONTOUR_SIGMA times the 1 sigma
+bounds in param_tbl.dat on either side of the best fit, within the limits of the parameters, with CONTOUR_STEPS values per parameter.
+
+Unlike one `steppar` over the whole grid, where each point starts from the fit of the point before, each chunk starts from the best fit,
+so fits that depend on the starting point can differ slightly at the edges of the chunks.
+
+    python contours.py --cfg_fn default_config.cfg
+"""
+
+
+import numpy as np
+import argparse
+import concurrent.futures
+import logging
+import os
+import subprocess
+
+import analyse_output
+import models
+import product_index
+import quickfit
+import read_output
+import tracing
+import utils
+
+
+# Values of each parameter in the grid
+STEPS = 30
+
+# Half width of the grid, in units of the 1 sigma bounds on either side of the best fit
+SIGMA = 3.
+
+# Number of chunks the grid of each pair of parameters is split into
+CHUNKS = 4
+
+# Script, table and log of each chunk, formatted with the names of the two parameters and the chunk number; removed once stitched
+_CHUNK_STEM = "_contour_{}_{}_{}"
+
+
+def grid_axes(fn_param, model, pair, steps=STEPS, sigma=SIGMA):
+    """Values of the two parameters `pair` of `model` (an XspecModel) in the grid: `steps` values each, evenly spaced over `sigma` times
+    the 1 sigma bounds in `fn_param` on either side of the best fit, within the limits of the parameters in quickfit.QUICK_MODELS.
+
+    Returns
+    -------
+    axes : list[np.ndarray]
+        Values of each parameter of `pair`
+    best : np.ndarray
+        Best fit of each parameter of `pair`
+    """
+
+    param_names, params, params_low, params_high, _ = read_output.read_param_tbl(fn_param)
+    quick = quickfit.QUICK_MODELS.get(model.name)
+    axes, best = [], []
+    for name in pair:
+        row = list(param_names).index(name)
+        p, low, high = float(params[row]), float(params_low[row]), float(params_high[row])
+        low, high = p - sigma * (p - low), p + sigma * (high - p)
+        if quick is not None and name in quick.param_names:
+            i = quick.param_names.index(name)
+            low, high = max(low, quick.lower[i]), min(high, quick.upper[i])
+        axes.append(np.linspace(low, high, steps))
+        best.append(p)
+    return axes, np.array(best)
+
+
+def chunk_rows(n_rows, n_chunks=CHUNKS):
+    """First and last row of each chunk. `steppar` needs at least one step, so every chunk has at least 2 rows."""
+    n_chunks = max(1, min(n_chunks, n_rows // 2))
+    edges = np.linspace(0, n_rows, n_chunks + 1).round().astype(int)
+    return [(int(start), int(end) - 1) for start, end in zip(edges[:-1], edges[1:])]
+
+
+def chunk_script(fn_xcm, model, pair, axes, rows, fn_out):
+    """XSpec commands that restore the best fit in `fn_xcm` and write chi-squared over rows `rows` (first, last) of the grid `axes` of the
+    parameters `pair` of `model` to `fn_out`: the values of the first parameter, of the second, and chi-squared, one line each"""
+
+    index = [[p.name for p in model.params].index(name) + 1 for name in pair]
+    (first, last), (x, y) = rows, axes
+    cmds = ["query yes",
+            f"@{fn_xcm}",
+            "cpd /null",
+            # steps is the number of intervals, so steps + 1 values
+            f"steppar best nolog {index[0]} {float(x[first])!r} {float(x[last])!r} {last - first} "
+            f"{index[1]} {float(y[0])!r} {float(y[-1])!r} {len(y) - 1}",
+            "set statValues [tcloutr steppar statistic]",
+            f"set xValues [tcloutr steppar {index[0]}]",
+            f"set yValues [tcloutr steppar {index[1]}]",
+            f"set stepTable [open {fn_out} w+]",
+            'puts $stepTable "$xValues"',
+            'puts $stepTable "$yValues"',
+            'puts $stepTable "$statValues"',
+            "close $stepTable",
+            "quit",
+            "y"]
+    return "\n".join(cmds) + "\n"
+
+
+def stitch(axes, fns_chunk):
+    """Chi-squared on the grid `axes` from the tables of the chunks `fns_chunk`. Each value is put at the grid point nearest to the
+    parameter values it was computed at, whatever order `steppar` went through them in. Points of missing chunks are NaN.
+
+    Returns
+    -------
+    stat : np.ndarray
+        Shape (len(axes[0]), len(axes[1]))
+    """
+
+    x, y = axes
+    stat = np.full((len(x), len(y)), np.nan)
+    for fn in fns_chunk:
+        if not os.path.exists(fn):
+            continue
+        with open(fn, 'r') as f:
+            x_values, y_values, stat_values = (np.array(line.split(), dtype=float) for line in f.read().splitlines()[:3])
+        # Nearest grid point of every value at once
+        i = np.abs(x_values[:, None] - x[None, :]).argmin(axis=1)
+        j = np.abs(y_values[:, None] - y[None, :]).argmin(axis=1)
+        stat[i, j] = stat_values
+    return stat
+
+
+def _run_chunk(fn_script, fn_log, data_dir, timeout):
+    """Run one chunk in XSpec. Returns its exit code, or None if it timed out."""
+    with open(fn_script, 'r') as stdin, open(fn_log, 'w') as log:
+        try:
+            return subprocess.run(["xspec"], stdin=stdin, stdout=log, stderr=subprocess.STDOUT, cwd=data_dir, timeout=timeout).returncode
+        except subprocess.TimeoutExpired:
+            return None
+
+
+def contour_jobs(outdir, model, steps=STEPS, sigma=SIGMA, n_chunks=CHUNKS):
+    """The grid of every pair of parameters of `model` (an XspecModel) fitted in `outdir`, and the XSpec scripts of its chunks.
+
+    Returns
+    -------
+    jobs : list[dict]
+        One per pair of parameters: "pair", "axes", "best", "chunks" (the script, table and log of each chunk) and "fn_out"
+    """
+
+    fn_param, fn_xcm = os.path.join(outdir, "param_tbl.dat"), os.path.join(outdir, "fit.xcm")
+    if not (os.path.exists(fn_param) and os.path.exists(fn_xcm)):
+        return []
+    jobs = []
+    for pair in model.contours:
+        try:
+            axes, best = grid_axes(fn_param, model, pair, steps, sigma)
+        except ValueError:
+            msg = f"{fn_param} has no row for {pair}; no contours"
+            print(msg)
+            logging.warning(msg)
+            continue
+        chunks = []
+        for k, rows in enumerate(chunk_rows(len(axes[0]), n_chunks)):
+            stem = os.path.join(outdir, _CHUNK_STEM.format(*pair, k))
+            with open(f"{stem}.xcm", 'w') as f:
+                f.write(chunk_script(fn_xcm, model, pair, axes, rows, f"{stem}.dat"))
+            chunks.append((f"{stem}.xcm", f"{stem}.dat", f"{stem}.log"))
+        jobs.append({"pair": pair, "axes": axes, "best": best, "chunks": chunks, "fn_out": os.path.join(outdir, read_output.CONTOUR_TBL.format(*pair))})
+    return jobs
+
+
+def run_contours(outdirs, max_workers=None, steps=STEPS, sigma=SIGMA, n_chunks=CHUNKS, timeout=None):
+    """Contours of every pair of parameters of every fit in `outdirs` ((ObsID, model name, output directory) of each fit). The chunks of all
+    of them run across one pool of `max_workers` workers (default: number of CPUs); each worker only waits on its XSpec process.
+    Chunks that failed leave NaN in the stitched array; their logs are kept.
+
+    Returns
+    -------
+    written : list[tuple]
+        Each contour_*.npz file written, and its pair of parameters
+    """
+
+    jobs = []
+    for oid, model_name, outdir in outdirs:
+        for job in contour_jobs(outdir, models.REGISTRY[model_name], steps, sigma, n_chunks):
+            jobs.append({**job, "oid": oid, "model": model_name, "outdir": outdir})
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        futures = {pool.submit(tracing.run_traced, "chunk", "contours", {"oid": job["oid"], "model": job["model"], "chunk": k},
+                               _run_chunk, fn_script, fn_log, os.path.dirname(job["outdir"]), timeout): (job, k)
+                   for job in jobs for k, (fn_script, _, fn_log) in enumerate(job["chunks"])}
+        for future in concurrent.futures.as_completed(futures):
+            job, k = futures[future]
+            returncode = future.result()
+            if returncode != 0:
+                msg = f"Chunk {k} of the {'/'.join(job['pair'])} grid of ObsID {job['oid']} {job['model']} " + \
+                    ("timed out" if returncode is None else f"exited with {returncode}") + f"; see {job['chunks'][k][2]}"
+                print(msg)
+                logging.error(msg)
+
+    written = []
+    for job in jobs:
+        stat = stitch(job["axes"], [fn_tbl for _, fn_tbl, _ in job["chunks"]])
+        chi_sq, dof, null_hyp_probability = read_output.read_stat_tbl(os.path.join(job["outdir"], "stat_tbl.dat"))
+        np.savez(job["fn_out"], x=job["axes"][0], y=job["axes"][1], stat=stat, best=job["best"], stat_best=chi_sq)
+        written.append((job["fn_out"], job["pair"]))
+        n_missing = int(np.isnan(stat).sum())
+        if n_missing:
+            msg = f"{n_missing} of {stat.size} grid points missing in {job['fn_out']}"
+            print(msg)
+            logging.warning(msg)
+            # The chunks are only kept if one of them failed
+            continue
+        for fn in (fn for chunk in job["chunks"] for fn in chunk):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    return written
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Confidence contours of pairs of parameters of every fit, from XSpec's steppar run in chunks in parallel.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--models", nargs="+", default=models.MODELS, help="Models whose contours are computed, from the registry in models.py")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    variables = utils.read_cfg(cfg_filename)
+    timeout = variables.get("FIT_TIMEOUT")
+    n_workers = variables.get("CONTOUR_WORKERS") or variables.get("FIT_WORKERS") or None
+
+    logging.basicConfig(filename=os.path.join(base_data_dir, "_contours.log"),
+                        level=logging.INFO,
+                        format='%(levelname)s - %(funcName)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S'
+                        )
+    # Plots are only written to file
+    analyse_output.plt.switch_backend("Agg")
+
+    tracing.configure(cfg_filename)
+    products = product_index.load(base_data_dir, oids)
+    outdirs = [(oid, model_name, outdir) for oid in oids for model_name in args.models for outdir in products.data_dirs(oid, spec_stem, model_name)]
+    with tracing.span("contours", tracing.STAGE):
+        written = run_contours(outdirs, int(n_workers) if n_workers else None,
+                               steps=int(variables.get("CONTOUR_STEPS") or STEPS), sigma=float(variables.get("CONTOUR_SIGMA") or SIGMA),
+                               n_chunks=int(variables.get("CONTOUR_CHUNKS") or CHUNKS), timeout=float(timeout) if timeout else None)
+        for fn, pair in written:
+            # contour_{param 1}_{param 2}.png next to it
+            analyse_output.plot_contour(fn, f"{os.path.splitext(fn)[0]}.png", pair)
+    msg = f"Wrote {len(written)} contour(s)"
+    print(msg)
+    logging.info(msg)
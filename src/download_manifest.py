@@ -0,0 +1,141 @@
+"""
+Persistent record of the product requests made by swifttools_ana.py, so a rerun (e.g. after a crash) only requests what is still missing.
+The manifest is a JSON file {BASE_DATA_DIR}/_download_manifest.json with one entry per ObsID:
+    job_id : ID of the job on the product server (USERPROD_{job_id} is the directory name inside the zip file)
+    state : "submitted", "downloaded" or "failed"
+    zip_size : size in bytes of {SPEC_STEM}.zip once downloaded
+    sha256 : checksum of {SPEC_STEM}.zip once downloaded
+"""
+
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import zipfile
+
+
+MANIFEST_FN = "_download_manifest.json"
+
+
+def file_checksum(fn, chunk_size=1 << 20):
+    """SHA-256 hex digest of file `fn`, read in chunks of `chunk_size` bytes."""
+
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def zip_is_complete(fn_zip):
+    """Return True if `fn_zip` exists and is a readable zip file whose members all pass their CRC check.
+    A truncated download fails this because the zip central directory is at the end of the file.
+    """
+
+    if not zipfile.is_zipfile(fn_zip):
+        return False
+    try:
+        with zipfile.ZipFile(fn_zip) as zf:
+            return zf.testzip() is None
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+
+class DownloadManifest:
+    """The manifest for one `base_data_dir`. Every change is written to disk straight away."""
+
+    def __init__(self, base_data_dir, spec_stem):
+        self.base_data_dir = base_data_dir
+        self.spec_stem = spec_stem
+        self.path = os.path.join(base_data_dir, MANIFEST_FN)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+
+    def zip_path(self, oid):
+        return os.path.join(self.base_data_dir, oid, f"{self.spec_stem}.zip")
+
+    def save(self):
+        # Write to a temporary file first so a crash never leaves a half-written manifest
+        os.makedirs(self.base_data_dir, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def record(self, oid, **fields):
+        """Update the entry of ObsID `oid` with `fields` (e.g. state="submitted", job_id=...) and save the manifest."""
+        with self._lock:
+            self.entries.setdefault(oid, {}).update(fields)
+            self.save()
+
+    def record_download(self, oid):
+        """Record that the products of `oid` were downloaded, with the size and checksum of the zip file."""
+        fn_zip = self.zip_path(oid)
+        if zip_is_complete(fn_zip):
+            self.record(oid, state="downloaded", zip_size=os.path.getsize(fn_zip), sha256=file_checksum(fn_zip))
+            return True
+        msg = f"Downloaded products for ObsID {oid} are incomplete or corrupt: {fn_zip}"
+        print(msg)
+        logging.error(msg)
+        self.record(oid, state="failed", zip_size=None, sha256=None)
+        return False
+
+    def is_downloaded(self, oid):
+        """Return True if `oid` was downloaded and {SPEC_STEM}.zip is still exactly what was downloaded.
+        A zip file that was never recorded as downloaded is accepted, and recorded, if it is complete.
+        """
+        fn_zip = self.zip_path(oid)
+        if not os.path.exists(fn_zip):
+            return False
+        entry = self.entries.get(oid, {})
+        if entry.get("state") in (None, "submitted"):
+            # Downloaded before the manifest existed, or the run stopped between the download and recording it
+            return zip_is_complete(fn_zip) and self.record_download(oid)
+        if entry.get("state") != "downloaded":
+            return False
+        # Size first, because it is free
+        if os.path.getsize(fn_zip) != entry.get("zip_size"):
+            msg = f"{fn_zip} is {os.path.getsize(fn_zip)} bytes but {entry.get('zip_size')} bytes were downloaded. It will be downloaded again"
+            print(msg)
+            logging.warning(msg)
+            return False
+        if file_checksum(fn_zip) != entry.get("sha256"):
+            msg = f"Checksum of {fn_zip} does not match the one recorded at download. It will be downloaded again"
+            print(msg)
+            logging.warning(msg)
+            return False
+
+        return True
+
+    def resume_plan(self, oids):
+        """Split `oids` into what still needs to be done.
+
+        Returns
+        -------
+        to_submit : list[str]
+            ObsIDs with no usable job: never submitted, failed, or with a missing/truncated zip file
+        in_flight : dict
+            ObsID is the key, job ID of the job already submitted on the server is the value
+        """
+
+        to_submit, in_flight = [], {}
+        for oid in oids:
+            entry = self.entries.get(oid, {})
+            if self.is_downloaded(oid):
+                continue
+            if entry.get("state") == "submitted" and entry.get("job_id") is not None:
+                in_flight[oid] = entry["job_id"]
+            else:
+                to_submit.append(oid)
+
+        msg = f"{len(oids) - len(to_submit) - len(in_flight)} ObsID(s) already downloaded, {len(in_flight)} still in flight, {len(to_submit)} to submit"
+        print(msg)
+        logging.info(msg)
+
+        return to_submit, in_flight
@@ -3,23 +3,33 @@
 # One and only command line argument is the config filename
 CFG_FN=$1
 
+# Start a new trace of the time spent in each stage (tracing.py)
+python3 tracing.py --cfg_fn ${CFG_FN} --clear
+
 # Get data products
 python3 swifttools_ana.py --cfg_fn ${CFG_FN}
 
 # Unzip and untar data products
-./unpack_swifttools_output.sh ${CFG_FN}
+python3 unpack.py --cfg_fn ${CFG_FN}
+
+# Index the products of every ObsID (the later stages only refresh it), and export their directories for the shell scripts
+python3 product_index.py --cfg_fn ${CFG_FN}
 
 # Get exposure time of each observation
 python3 utils.py --cfg_fn ${CFG_FN}
 
-# Use grappha to re-group the data for chi-squared statistics. YOU NEED TO KNOW THE MODE (PC or WT) for each ObsID; this info is in the filenames.
+# Re-group the data for chi-squared statistics (as grppha does in run_grppha.sh). YOU NEED TO KNOW THE MODE (PC or WT) for each ObsID; this info is in the filenames.
 # If there is more than one mode per ObsID, you need to set the mode by hand
-./run_grppha.sh ${CFG_FN}
+python3 grouping.py --cfg_fn ${CFG_FN}
 
-# XSpec to fit the data to multiple models
-./xspec_models/powlaw_tbabs.sh ${CFG_FN}
-./xspec_models/powlaw_ztbabs_tbabs.sh ${CFG_FN}
-./xspec_models/logpar_tbabs.sh ${CFG_FN}
+# XSpec to fit the data to multiple models (models.py); one XSpec session per ObsID, and the ObsIDs run in parallel
+python3 fit_scheduler.py --cfg_fn ${CFG_FN}
+
+# Plots of each fit from its tables, if XSpec did not make them (FIT_PLOTS in the config file); only the missing plots are made
+python3 xspec_plots.py --cfg_fn ${CFG_FN}
 
 # Compare the tested models
 python3 analyse_output.py --cfg_fn ${CFG_FN}
+
+# Time spent in each stage, and the slowest ObsIDs and models
+python3 tracing.py --cfg_fn ${CFG_FN}
@@ -0,0 +1,309 @@
+"""
+Content-addressed cache of the XSpec fits, so that fitting again what has not changed takes no time.
+
+The key of the fit of one model to one ObsID is the sha256 of everything the fit depends on:
+    * the contents of the grouped spectrum, but for its header keywords naming the files next to it (PATH_KEYWORDS), which grouping.py
+      writes with the path of the data directory, and its CHECKSUM/DATASUM; and the contents of those files, the background spectrum, RMF and ARF
+    * the XSpec commands of the session (models.session_script() and models.model_commands()), with the data directory left out; these hold
+      the model, its initial and frozen parameter values (NH_TBABS, REDSHIFT), the energies noticed, the flux band and the output filenames
+    * CACHE_VERSION, to be increased when the outputs of the same commands change (e.g. a new version of XSpec)
+
+The outputs of every fit are copied to {FIT_CACHE_DIR}/{key[:2]}/{key}/ (default FIT_CACHE_DIR: {BASE_DATA_DIR}/_fit_cache), and the key of
+the outputs in a model's directory is written next to them in _fit_key.json with the size and modification time of each output.
+Before a model is fitted:
+    * if _fit_key.json has the key, and the outputs were not changed since (e.g. by hand), there is nothing to do;
+    * otherwise, if the key is in the cache, the outputs are copied from there (e.g. after a change of NH_TBABS was undone);
+    * otherwise the model is fitted.
+Files are hashed once per size and modification time; the hashes are kept in {FIT_CACHE_DIR}/_hashes.json.
+"""
+
+
+import argparse
+import copy
+import hashlib
+import json
+import math
+import os
+import shutil
+import threading
+
+import models
+import utils
+
+
+CACHE_DIRNAME = "_fit_cache"
+
+# Index of the sha256 of every input file, keyed by path, size and modification time, so files are only hashed again if they changed
+HASH_INDEX_FN = "_hashes.json"
+
+# Written to the output directory of each model: the key of the fit whose outputs are there
+KEY_FN = "_fit_key.json"
+
+# Part of every key; increase to invalidate every cached fit
+CACHE_VERSION = 2
+
+# Keywords of the grouped spectrum left out of its hash: the paths of the files that input_files() hashes, which depend on where the data is
+PATH_KEYWORDS = ("BACKFILE", "RESPFILE", "ANCRFILE")
+
+# Also left out: the checksums (grppha writes them), as the header one covers those paths and refreshing them restamps their comments.
+# The data is hashed directly
+_HASH_EXCLUDED_KEYWORDS = PATH_KEYWORDS + ("CHECKSUM", "DATASUM")
+
+# FITS files are made of blocks of this many bytes, and their headers of cards of CARD_SIZE bytes
+_FITS_BLOCK = 2880
+_CARD_SIZE = 80
+
+# Stands in for the data directory in the XSpec commands that are hashed, so the key does not depend on where the data is
+_DDIR = "{DDIR}"
+
+# Written by `save all` in models.model_commands()
+_SAVED_XCM = "fit.xcm"
+
+
+def _stat_key(fn):
+    st = os.stat(fn)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def input_files(data_dir, oid, mode):
+    """Files a fit of ObsID `oid` in `mode` reads: its grouped spectrum (first), background spectrum and responses, as named in grouping.py"""
+    stem = os.path.join(data_dir, f"Obs_{oid}{mode}")
+    return [f"{stem}_chi2_grp.pi", f"{stem}back.pi", f"{stem}.rmf", f"{stem}.arf"]
+
+
+def _card_int(card):
+    return int(card[10:].split(b"/")[0])
+
+
+def _fits_hash(fn, exclude=()):
+    """sha256 of FITS file `fn` without the header cards of the keywords in `exclude` (and the CONTINUE cards of their long values).
+    Raises ValueError if `fn` is not a FITS file."""
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        while True:
+            block = f.read(_FITS_BLOCK)
+            if not block:
+                return h.hexdigest()
+            # Header of the HDU: the cards up to END, and the keywords giving the size of its data
+            sizes = {"BITPIX": 8, "NAXIS": 0, "PCOUNT": 0, "GCOUNT": 1}
+            naxes = []
+            skip = False
+            end = False
+            while not end:
+                if len(block) != _FITS_BLOCK:
+                    raise ValueError(f"{fn} is not a FITS file")
+                for i in range(0, _FITS_BLOCK, _CARD_SIZE):
+                    card = block[i:i + _CARD_SIZE]
+                    keyword = card[:8].decode("ascii", "replace").strip()
+                    if keyword == "END":
+                        end = True
+                        break
+                    skip = keyword in exclude or (skip and keyword == "CONTINUE")
+                    if not skip:
+                        h.update(card)
+                    if keyword in sizes:
+                        sizes[keyword] = _card_int(card)
+                    elif keyword.startswith("NAXIS"):
+                        naxes.append(_card_int(card))
+                if not end:
+                    block = f.read(_FITS_BLOCK)
+            n_data = 0
+            if sizes["NAXIS"]:
+                n_data = abs(sizes["BITPIX"]) // 8 * sizes["GCOUNT"] * (sizes["PCOUNT"] + math.prod(naxes[:sizes["NAXIS"]]))
+            # Data with its padding to whole blocks
+            n_data = -(-n_data // _FITS_BLOCK) * _FITS_BLOCK
+            while n_data:
+                chunk = f.read(min(n_data, 1 << 20))
+                if not chunk:
+                    raise ValueError(f"{fn} is not a FITS file")
+                h.update(chunk)
+                n_data -= len(chunk)
+
+
+class FitCache:
+    """Outputs of the fits saved in `cache_dir`, keyed by the hash of their inputs. `variables` are the config variables (utils.read_cfg)."""
+
+    def __init__(self, cache_dir, variables):
+        self.cache_dir = cache_dir
+        self.variables = variables
+        os.makedirs(cache_dir, exist_ok=True)
+        self._hash_index_fn = os.path.join(cache_dir, HASH_INDEX_FN)
+        self._hashes = {}
+        if os.path.exists(self._hash_index_fn):
+            with open(self._hash_index_fn, 'r') as f:
+                self._hashes = json.load(f)
+        self._lock = threading.Lock()
+        self._changed = False
+
+    @classmethod
+    def for_base_data_dir(cls, base_data_dir, variables):
+        """Cache in FIT_CACHE_DIR if set in `variables` (e.g. to share it between targets), otherwise in {base_data_dir}/_fit_cache"""
+        return cls(variables.get("FIT_CACHE_DIR") or os.path.join(base_data_dir, CACHE_DIRNAME), variables)
+
+    def for_variables(self, variables):
+        """The same cache, sharing its index of file hashes, for the fits of another config with config variables `variables`
+        (e.g. another target of a campaign, see campaign.py)"""
+        view = copy.copy(self)
+        view.variables = variables
+        return view
+
+    def _file_hash(self, fn, exclude=()):
+        """sha256 of the contents of `fn`, or '' if it does not exist. If `exclude` is given, `fn` is a FITS file hashed without the
+        header keywords in `exclude` (see _fits_hash())."""
+        key = os.path.abspath(fn)
+        try:
+            stat = _stat_key(key)
+        except FileNotFoundError:
+            return ""
+        entry = self._hashes.get(key)
+        if entry is not None and entry["stat"] == stat and entry.get("exclude", []) == list(exclude):
+            return entry["sha256"]
+        if exclude:
+            sha256 = _fits_hash(key, exclude)
+        else:
+            h = hashlib.sha256()
+            with open(key, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            sha256 = h.hexdigest()
+        with self._lock:
+            self._hashes[key] = {"stat": stat, "sha256": sha256, "exclude": list(exclude)}
+            self._changed = True
+        return sha256
+
+    def save_hashes(self):
+        """Save the hashes of the files hashed since the cache was opened"""
+        with self._lock:
+            if not self._changed:
+                return
+            tmp = f"{self._hash_index_fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self._hashes, f)
+            os.replace(tmp, self._hash_index_fn)
+            self._changed = False
+
+    def keys(self, data_dir, oid, mode, model_names):
+        """Key of the fit of each model in `model_names` to ObsID `oid` observed in `mode`; model name is the key"""
+        h = hashlib.sha256(f"{CACHE_VERSION}\n".encode())
+        fns = input_files(data_dir, oid, mode)
+        # The grouped spectrum names the other files with their paths, which are left out: their contents are hashed instead
+        h.update(f"{os.path.basename(fns[0])} {self._file_hash(fns[0], _HASH_EXCLUDED_KEYWORDS)}\n".encode())
+        for fn in fns[1:]:
+            h.update(f"{os.path.basename(fn)} {self._file_hash(fn)}\n".encode())
+        h.update(models.session_script(os.path.basename(input_files(data_dir, oid, mode)[0]), _DDIR, [], self.variables).encode())
+        keys = {}
+        for name in model_names:
+            h_model = h.copy()
+            h_model.update("\n".join(models.model_commands(models.REGISTRY[name], _DDIR, self.variables)).encode())
+            keys[name] = h_model.hexdigest()
+        return keys
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _outputs(self, outdir, model_name):
+        """Outputs of `model_name` that exist in `outdir`"""
+        paths = list(models.output_paths(os.path.dirname(outdir), model_name, self.variables).values()) + [os.path.join(outdir, _SAVED_XCM)]
+        return [fn for fn in paths if os.path.exists(fn)]
+
+    def _write_key(self, outdir, key, outputs):
+        with open(os.path.join(outdir, KEY_FN), 'w') as f:
+            json.dump({"key": key, "outputs": {os.path.basename(fn): _stat_key(fn) for fn in outputs}}, f)
+
+    def is_current(self, outdir, key):
+        """Whether the outputs in `outdir` are those of the fit with `key`, unchanged since"""
+        try:
+            with open(os.path.join(outdir, KEY_FN), 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if entry.get("key") != key:
+            return False
+        try:
+            return all(_stat_key(os.path.join(outdir, name)) == stat for name, stat in entry["outputs"].items())
+        except FileNotFoundError:
+            return False
+
+    def restore(self, outdir, model_name, key):
+        """Copy the outputs of the fit with `key` from the cache to `outdir`. Returns False if the fit is not in the cache."""
+        cached = self.path(key)
+        if not os.path.isdir(cached):
+            return False
+        os.makedirs(outdir, exist_ok=True)
+        outputs = []
+        for name in os.listdir(cached):
+            # New modification times, so the stages after the fit see new outputs
+            shutil.copyfile(os.path.join(cached, name), os.path.join(outdir, name))
+            outputs.append(os.path.join(outdir, name))
+        self._write_key(outdir, key, outputs)
+        return True
+
+    def store(self, outdir, model_name, key):
+        """Copy the outputs of `model_name` in `outdir`, the fit with `key`, to the cache"""
+        outputs = self._outputs(outdir, model_name)
+        cached = self.path(key)
+        if not os.path.isdir(cached):
+            tmp = f"{cached}.{os.getpid()}.{threading.get_ident()}.tmp"
+            os.makedirs(tmp, exist_ok=True)
+            for fn in outputs:
+                shutil.copyfile(fn, os.path.join(tmp, os.path.basename(fn)))
+            try:
+                os.rename(tmp, cached)
+            except OSError:
+                # Stored by another worker in the meantime
+                shutil.rmtree(tmp, ignore_errors=True)
+        self._write_key(outdir, key, outputs)
+
+    def lookup(self, data_dir, oid, mode, model_names):
+        """Bring the outputs of every model in `model_names` up to date from the cache where possible.
+
+        Returns
+        -------
+        keys : dict
+            Key of the fit of each model
+        to_fit : list[str]
+            Models whose fit is neither current nor in the cache, and must be fitted
+        """
+
+        keys = self.keys(data_dir, oid, mode, model_names)
+        to_fit = []
+        for name in model_names:
+            outdir = os.path.join(data_dir, name)
+            if not self.is_current(outdir, keys[name]) and not self.restore(outdir, name, keys[name]):
+                to_fit.append(name)
+        self.save_hashes()
+        return keys, to_fit
+
+    def size(self):
+        """Number of fits in the cache, and their size in bytes"""
+        n, n_bytes = 0, 0
+        with os.scandir(self.cache_dir) as prefixes:
+            for prefix in prefixes:
+                if not prefix.is_dir():
+                    continue
+                with os.scandir(prefix.path) as fits:
+                    for fit in fits:
+                        n += 1
+                        n_bytes += sum(entry.stat().st_size for entry in os.scandir(fit.path))
+        return n, n_bytes
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Size of the cache of XSpec fits, and clearing it.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--clear", action="store_true", help="Delete every fit in the cache, e.g. after updating XSpec")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    cache = FitCache.for_base_data_dir(base_data_dir, utils.read_cfg(cfg_filename))
+    n, n_bytes = cache.size()
+    if args.clear:
+        shutil.rmtree(cache.cache_dir)
+        print(f"Deleted {n} fit(s) ({n_bytes / 2**20:.1f} MiB) from {cache.cache_dir}")
+    else:
+        print(f"{n} fit(s) ({n_bytes / 2**20:.1f} MiB) in {cache.cache_dir}")
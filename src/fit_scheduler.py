@@ -0,0 +1,292 @@
+"""
+Run the XSpec fits of every ObsID in parallel. Each ObsID is an independent task: one XSpec session, generated from the model registry in
+models.py, loads its grouped spectrum once and fits every model back-to-back. Each task has its own log file, a timeout, and a number of retries;
+a retry only fits the models whose output is missing. Failed tasks are reported at the end rather than stopping the other fits.
+Models whose inputs did not change since they were last fitted are not fitted again: their outputs are kept, or restored from the fit cache
+(fit_cache.py).
+"""
+
+
+from dataclasses import dataclass, field
+import argparse
+import concurrent.futures
+import logging
+import os
+import subprocess
+import time
+
+import fit_cache
+import models
+import product_index
+import results_store
+import tracing
+import utils
+from models import MODELS
+
+
+# Tables written for every model. A fit is only successful if all of them were written
+EXPECTED_OUTPUTS = ("param_tbl.dat", "stat_tbl.dat")
+
+
+@dataclass
+class FitTask:
+    """The fits of one ObsID (one row of the ObsID x model matrix), and the outcome of running them"""
+    oid: str
+    mode: str
+    models: list
+    status: str = "pending"
+    attempts: int = 0
+    wall_time: float = 0.
+    log_fn: str = None
+    # Models whose output is missing after the last attempt
+    failed_models: list = field(default_factory=list)
+    # Models not fitted because their outputs were current, or restored from the fit cache
+    cached_models: list = field(default_factory=list)
+
+
+def expand_tasks(oids, modes, model_names=MODELS):
+    """One `FitTask` per ObsID, fitting every model in `model_names`. `modes` holds the mode of each ObsID in `oids`."""
+    return [FitTask(oid, mode, list(model_names)) for oid, mode in zip(oids, modes)]
+
+
+def data_dir_for_oid(base_data_dir, spec_stem, oid, products=None):
+    """{base_data_dir}/{oid}/USERPROD_*/{spec_stem}, or None if there is no (single) USERPROD* directory for `oid`.
+    The directory is looked up in `products` (a product_index.ProductIndex); by default, the directories of `oid` are listed."""
+    if products is None:
+        products = product_index.for_oid(base_data_dir, oid)
+    return products.data_dir(oid, spec_stem)
+
+
+def model_outdir(base_data_dir, spec_stem, oid, model, products=None):
+    """Directory that the fit of `model` writes to, or None if there is no (single) USERPROD* directory for `oid`."""
+    data_dir = data_dir_for_oid(base_data_dir, spec_stem, oid, products)
+    return None if data_dir is None else os.path.join(data_dir, model)
+
+
+def run_task(task, variables, base_data_dir, spec_stem, log_dir, timeout=None, retries=1, products=None, cache=None):
+    """Fit the models of `task` to ObsID `task.oid` in one XSpec session, retrying (only the models that failed) up to `retries` times
+    if it fails or times out. XSpec's output is written to {data_dir}/{LOG_XSPEC}; what this function did to {log_dir}/{oid}.log.
+
+    Parameters
+    ----------
+    variables : dict
+        Config variables, from utils.read_cfg()
+    products : product_index.ProductIndex
+        Where to find the data directory of the ObsID; by default, the directories of the ObsID are listed
+    cache : fit_cache.FitCache
+        If given, the models whose inputs did not change are taken from it rather than fitted, and the new fits are added to it
+
+    Returns
+    -------
+    task : FitTask
+        `task`, with status "done", "failed" or "timeout"
+    """
+
+    task.log_fn = os.path.join(log_dir, f"{task.oid}.log")
+    t_start = time.monotonic()
+    data_dir = data_dir_for_oid(base_data_dir, spec_stem, task.oid, products)
+    if data_dir is None:
+        task.status, task.failed_models = "failed", list(task.models)
+        with open(task.log_fn, 'a') as log:
+            log.write(f"# Expected one USERPROD*/{spec_stem} directory for ObsID {task.oid}\n")
+        return task
+
+    # `CHI2_GRP_SPEC` name must match what was written by grouping.py/grppha
+    fn_grp = os.path.join(data_dir, f"Obs_{task.oid}{task.mode}_chi2_grp.pi")
+    trash_dir = utils.get_trash_dir(variables, base_data_dir)
+    to_fit = list(task.models)
+    if cache is not None:
+        with tracing.span("cache lookup", "fit", oid=task.oid):
+            keys, to_fit = cache.lookup(data_dir, task.oid, task.mode, to_fit)
+        task.cached_models = [m for m in task.models if m not in to_fit]
+        if task.cached_models:
+            with open(task.log_fn, 'a') as log:
+                log.write(f"# Inputs unchanged, not fitted again: {task.cached_models}\n")
+
+    while task.attempts <= retries and to_fit:
+        task.attempts += 1
+        script = models.write_session_script(fn_grp, data_dir, to_fit, variables)
+        fn_xspec_log = os.path.join(data_dir, variables.get("LOG_XSPEC", "_xspec.log"))
+        # The log of a retry is appended to that of the attempts before it; the fit times are read from this attempt's part
+        xspec_log_start = os.path.getsize(fn_xspec_log) if task.attempts > 1 and os.path.exists(fn_xspec_log) else 0
+        with open(task.log_fn, 'a') as log, open(script, 'r') as stdin, open(fn_xspec_log, 'w' if task.attempts == 1 else 'a') as xspec_log, \
+                tracing.span("xspec session", "fit", oid=task.oid, attempt=task.attempts) as trace_args:
+            log.write(f"# Attempt {task.attempts}: xspec < {script} ({', '.join(to_fit)})\n")
+            log.flush()
+            if task.attempts > 1:
+                xspec_log.write(f"# Attempt {task.attempts}\n")
+                xspec_log.flush()
+            try:
+                proc = subprocess.Popen(["xspec"], stdin=subprocess.PIPE, stdout=xspec_log, stderr=log, text=True)
+            except OSError as err:
+                log.write(f"# Could not start XSpec: {err}\n")
+                proc, task.status = None, "failed"
+                trace_args["status"] = "not started"
+            else:
+                # XSpec only writes the output tables once it reads the script, so the old ones are moved now that it has started:
+                # if it cannot be started, they are left in place
+                models.move_old_outputs(data_dir, to_fit, trash_dir, variables)
+                try:
+                    proc.communicate(stdin.read(), timeout=timeout)
+                    returncode = proc.returncode
+                    task.status = "failed"
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.communicate()
+                    log.write(f"# Timed out after {timeout} seconds\n")
+                    returncode, task.status = None, "timeout"
+                trace_args["status"] = "timeout" if returncode is None else f"exit code {returncode}"
+        if proc is None:
+            # Trying again would fail the same way
+            break
+        # Time of each model in the session, from the timestamps that the session printed
+        for model, (t_model_start, t_model_end) in models.model_times(fn_xspec_log, xspec_log_start).items():
+            tracing.add_span("model", "fit", t_model_start, t_model_end, oid=task.oid, model=model, attempt=task.attempts)
+
+        fitted = [m for m in to_fit if all(os.path.exists(os.path.join(data_dir, m, fn)) for fn in EXPECTED_OUTPUTS)]
+        if cache is not None:
+            for m in fitted:
+                cache.store(os.path.join(data_dir, m), m, keys[m])
+        to_fit = [m for m in to_fit if m not in fitted]
+        if not to_fit:
+            break
+        with open(task.log_fn, 'a') as log:
+            log.write(f"# Exit code {returncode}; missing outputs of: {to_fit}\n")
+
+    if not to_fit:
+        task.status = "done"
+    task.failed_models = to_fit
+    task.wall_time = time.monotonic() - t_start
+
+    return task
+
+
+def task_result(future, task, label=""):
+    """`task`, as returned by the `future` that ran it, or marked as failed if that raised an exception, which is reported prefixed with
+    `label`, so that the other tasks keep going"""
+    try:
+        return future.result()
+    except Exception as err:
+        task.status, task.failed_models = "failed", [m for m in task.models if m not in task.cached_models]
+        msg = f"{label}ObsID {task.oid}: {type(err).__name__}: {err}"
+        print(msg)
+        logging.exception(msg)
+        if task.log_fn is not None:
+            with open(task.log_fn, 'a') as log:
+                log.write(f"# {type(err).__name__}: {err}\n")
+        return task
+
+
+def store_task(con, task, base_data_dir, spec_stem, products=None, label=""):
+    """Add the results of the finished `task` to the results store `con`, and report its outcome, prefixed with `label`"""
+    # Also the models that were fitted if others failed
+    try:
+        results_store.ingest_oid(con, base_data_dir, task.oid, spec_stem, task.models, clobber=True, products=products)
+    except (ValueError, IndexError) as err:
+        msg = f"Could not add the results of {label}ObsID {task.oid} to the results store: {err}"
+        print(msg)
+        logging.warning(msg)
+    msg = f"{label}ObsID {task.oid}: {task.status} after {task.attempts} attempt(s), {task.wall_time:.1f} s"
+    if task.cached_models:
+        msg += f" ({len(task.cached_models)} model(s) unchanged)"
+    print(msg)
+    if task.status == "done":
+        logging.info(msg)
+    else:
+        logging.error(f"{msg}. Models not fitted: {task.failed_models}. See {task.log_fn}")
+
+
+def summary(tasks, label=""):
+    """Outcome of all `tasks`, prefixed with `label`: the ObsIDs that were not fitted with every model, and the fits not run again"""
+    failed = [t for t in tasks if t.status != "done"]
+    if failed:
+        msg = f"{label}{len(failed)} of {len(tasks)} ObsIDs were not fitted with every model:\n" + \
+            "\n".join(f"\t{t.oid} {t.failed_models} ({t.status}): {t.log_fn}" for t in failed)
+    else:
+        msg = f"{label}All {len(tasks)} ObsIDs were fitted with every model"
+    n_cached = sum(len(t.cached_models) for t in tasks)
+    if n_cached:
+        msg += f"; {n_cached} of {sum(len(t.models) for t in tasks)} fits had unchanged inputs and were not run again"
+    return msg
+
+
+def run_all(tasks, variables, base_data_dir, spec_stem, max_workers=None, timeout=None, retries=1, cache=None):
+    """Run every task in `tasks` across a pool of `max_workers` workers (default: number of CPUs).
+    Each worker only waits on its XSpec process, so threads are enough.
+    The results of each ObsID are added to the results store ({base_data_dir}/_results.sqlite) as soon as its task finishes.
+    Models whose inputs did not change are taken from `cache` (a fit_cache.FitCache), if given, rather than fitted.
+
+    Returns
+    -------
+    tasks : list[FitTask]
+        Same as `tasks`, with the outcome of each
+    """
+
+    log_dir = os.path.join(base_data_dir, "_fit_logs")
+    os.makedirs(log_dir, exist_ok=True)
+    # Old output tables are moved here
+    os.makedirs(utils.get_trash_dir(variables, base_data_dir), exist_ok=True)
+    max_workers = max_workers or os.cpu_count()
+    con = results_store.connect(results_store.store_fn(base_data_dir))
+    # The data directories of all ObsIDs are found once; the workers only read the index
+    products = product_index.load(base_data_dir, [task.oid for task in tasks])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(tracing.run_traced, "ObsID", "fit", {"oid": task.oid},
+                               run_task, task, variables, base_data_dir, spec_stem, log_dir, timeout, retries, products, cache): task for task in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            store_task(con, task_result(future, futures[future]), base_data_dir, spec_stem, products)
+
+    con.close()
+    msg = summary(tasks)
+    print(msg)
+    logging.info(msg)
+
+    return tasks
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Fits every ObsID with every XSpec model in parallel.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--models", nargs="+", default=MODELS, help="Models to fit, from the registry in models.py")
+    parser.add_argument(
+        "--write_only", action="store_true", help=f"Only write the XSpec script of each ObsID ({models.SESSION_SCRIPT_FN}), without running it")
+    parser.add_argument(
+        "--no_cache", action="store_true", help="Fit every model again, even if its inputs did not change since it was last fitted")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    variables = utils.read_cfg(cfg_filename)
+    modes = variables["MODES"]
+    if isinstance(modes, str):
+        modes = [modes]
+    timeout = variables.get("FIT_TIMEOUT")
+
+    if args.write_only:
+        products = product_index.load(base_data_dir, oids)
+        for oid, mode in zip(oids, modes):
+            data_dir = data_dir_for_oid(base_data_dir, spec_stem, oid, products)
+            if data_dir is not None:
+                fn_grp = os.path.join(data_dir, f"Obs_{oid}{mode}_chi2_grp.pi")
+                print(f"Wrote {models.write_session_script(fn_grp, data_dir, args.models, variables)}")
+        raise SystemExit
+
+    logging.basicConfig(filename=os.path.join(base_data_dir, "_fit_scheduler.log"),
+                        level=logging.INFO,
+                        format='%(levelname)s - %(funcName)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S'
+                        )
+
+    tracing.configure(cfg_filename)
+    tasks = expand_tasks(oids, modes, args.models)
+    with tracing.span("fit", tracing.STAGE):
+        run_all(tasks, variables, base_data_dir, spec_stem,
+                max_workers=int(variables["FIT_WORKERS"]) if variables.get("FIT_WORKERS") else None,
+                timeout=float(timeout) if timeout else None,
+                retries=int(variables.get("FIT_RETRIES", 1)),
+                cache=None if args.no_cache else fit_cache.FitCache.for_base_data_dir(base_data_dir, variables))
@@ -0,0 +1,198 @@
+"""
+Fluxes in any energy band from the fits already done, without fitting again. The spectral model of each fit (quickfit.QUICK_MODELS) is integrated
+over the band at the best-fit parameters, and its errors are the 16th and 84th percentiles of the fluxes of parameter sets drawn from the
+covariance matrix of the fit (covar_tbl.dat, written by the XSpec session and by quickfit.py). All the ObsIDs of a model are done at once:
+the parameter sets of every ObsID are drawn together, and the model is evaluated on one energy grid for all of them with array operations.
+
+Fits from before covar_tbl.dat was written only have the bounds in param_tbl.dat; their parameters are drawn independently, with standard
+deviation half the width of the bounds. This leaves out the correlations of the parameters (e.g. PhoIndex and norm), which usually makes the
+flux errors larger than XSpec's, so a warning says how many fits of each batch are done this way.
+
+Differences with XSpec's `flux` to be aware of:
+    * Absorption uses quickfit.absorption(), i.e. XSpec's wabs rather than tbabs, so absorbed fluxes below ~2 keV are only approximately XSpec's.
+    * The errors are from the covariance matrix, i.e. a Gaussian approximation, rather than from `flux err`.
+
+    python flux_engine.py --cfg_fn default_config.cfg --band 0.3 2 --energy_flux
+"""
+
+
+import numpy as np
+import argparse
+import logging
+import os
+
+import models
+import product_index
+import quickfit
+import read_output
+import utils
+
+
+# Spectral model of each model the fluxes can be computed for
+QUICK_MODELS = quickfit.QUICK_MODELS
+
+# erg per keV
+KEV_TO_ERG = 1.602176634e-9
+
+# Number of energies the band is integrated over, evenly spaced in log(energy)
+N_ENERGIES = 256
+
+# Number of parameter sets drawn for each fit
+N_SAMPLES = 1000
+
+# Largest number of (parameter set, energy) values evaluated at once, to bound the memory used (8 bytes each)
+MAX_CHUNK = 2**22
+
+# Percentiles of the sampled fluxes that give the lower and upper 1 sigma bounds
+PERCENTILES = (15.865525393145708, 84.13447460685429)
+
+# Name of the row in param_tbl.dat and in the covariance table of the intrinsic column density, which is zeroed for unabsorbed fluxes
+INTRINSIC_NH = "ztbabs_nh"
+
+
+def covar_fn(fn_param):
+    """covar_tbl.dat next to param_tbl.dat `fn_param`"""
+    return os.path.join(os.path.dirname(fn_param), models.OUTPUT_TBLS["COVAR_TBL"])
+
+
+def read_fit(fn_param, model):
+    """Best-fit parameters of `model` (a quickfit.QuickModel) in `fn_param`, and their covariance matrix from covar_tbl.dat next to it.
+    Without covar_tbl.dat, the covariance is diagonal with standard deviation half the width of the bounds in `fn_param`.
+    The rows and columns of frozen parameters are 0.
+
+    Returns
+    -------
+    params : np.ndarray
+        Parameters, in the order of model.param_names
+    covar : np.ndarray
+        Covariance matrix, of shape (number of parameters, number of parameters)
+    """
+
+    param_names, params, params_low, params_high, _ = read_output.read_param_tbl(fn_param)
+    rows = [list(param_names).index(name) for name in model.param_names]
+    params = np.asarray(params, dtype=float)[rows]
+    covar = np.zeros((len(rows), len(rows)))
+
+    fn_covar = covar_fn(fn_param)
+    if os.path.exists(fn_covar):
+        names, fit_covar = read_output.read_covar_tbl(fn_covar)
+        i = [model.param_names.index(name) for name in names]
+        covar[np.ix_(i, i)] = fit_covar
+    else:
+        sigma = (np.asarray(params_high, dtype=float)[rows] - np.asarray(params_low, dtype=float)[rows]) / 2
+        free = np.array([name not in model.frozen for name in model.param_names])
+        covar[np.diag_indices(len(rows))] = np.where(free, sigma, 0.) ** 2
+
+    return params, covar
+
+
+class FluxEngine:
+    """Photon flux (ph/cm^2/s), or energy flux (erg/cm^2/s) if `energy_flux`, in `band` keV, with absorption unless `unabsorbed`.
+    `nh_tbabs` (10^22 atoms/cm^2) and `redshift` are the values frozen in the fits, NH_TBABS and REDSHIFT in the config file.
+    Fluxes are computed from `n_samples` parameter sets per fit, drawn with seed `seed`."""
+
+    def __init__(self, band=models.FLUX_BAND, energy_flux=False, nh_tbabs=0., redshift=0., unabsorbed=False, n_samples=N_SAMPLES, seed=0):
+        self.band, self.energy_flux, self.unabsorbed = tuple(band), energy_flux, unabsorbed
+        self.nh_tbabs = 0. if unabsorbed else nh_tbabs
+        self.redshift, self.n_samples, self.seed = redshift, n_samples, seed
+        edges = np.geomspace(self.band[0], self.band[1], N_ENERGIES + 1)
+        self.energy = 0.5 * (edges[1:] + edges[:-1])
+        # Integrating the model times these weights gives the flux
+        self.weights = np.diff(edges) * (self.energy * KEV_TO_ERG if energy_flux else 1.)
+
+    @property
+    def label(self):
+        """What is computed, e.g. 'unabsorbed energy flux 0.3-2 keV'; saved with the lightcurve so that a change of band is noticed"""
+        kind = "energy flux" if self.energy_flux else "photon flux"
+        return f"{'unabsorbed ' if self.unabsorbed else ''}{kind} {self.band[0]:g}-{self.band[1]:g} keV"
+
+    @property
+    def unit(self):
+        return r"erg/cm$^2$/s" if self.energy_flux else r"ph/cm$^2$/s"
+
+    def integrate(self, model, p):
+        """Flux of `model` (a quickfit.QuickModel) for parameter sets `p` of shape (number of sets, number of parameters)"""
+        if self.unabsorbed and INTRINSIC_NH in model.param_names:
+            p = p.copy()
+            p[:, model.param_names.index(INTRINSIC_NH)] = 0.
+        fluxes = np.empty(len(p))
+        step = max(1, MAX_CHUNK // len(self.energy))
+        with np.errstate(over='ignore', invalid='ignore'):
+            for start in range(0, len(p), step):
+                fluxes[start:start + step] = model.function(self.energy, p[start:start + step], self.nh_tbabs, self.redshift) @ self.weights
+        return fluxes
+
+    def fluxes(self, model_name, fns_param):
+        """Flux of every fit of `model_name` in `fns_param` (its param_tbl.dat files), at the best fit and from the covariance of each.
+
+        Returns
+        -------
+        flux, flux_errn, flux_errp : np.ndarray
+            Flux at the best fit, and its distance to the lower and upper 1 sigma bounds, one value per file in `fns_param`
+        """
+
+        model = QUICK_MODELS[model_name]
+        no_covar = [fn for fn in fns_param if not os.path.exists(covar_fn(fn))]
+        if no_covar:
+            msg = (f"{len(no_covar)} of {len(fns_param)} fit(s) of {model_name} have no {models.OUTPUT_TBLS['COVAR_TBL']} (e.g. {no_covar[0]}): "
+                   "their parameters are drawn independently, without their correlations, so their flux errors are only approximate "
+                   "(usually too large)")
+            print(msg)
+            logging.warning(msg)
+        fits = [read_fit(fn, model) for fn in fns_param]
+        params = np.array([p for p, _ in fits]).reshape(len(fits), len(model.param_names))
+        covar = np.array([c for _, c in fits]).reshape(len(fits), len(model.param_names), len(model.param_names))
+
+        # Draw from N(params, covar) through the eigendecomposition of each matrix, which allows the zero rows of frozen parameters
+        w, v = np.linalg.eigh(covar)
+        scale = v * np.sqrt(np.clip(w, 0., None))[:, None, :]
+        z = np.random.default_rng(self.seed).standard_normal((len(fits), self.n_samples, len(model.param_names)))
+        samples = params[:, None, :] + z @ scale.transpose(0, 2, 1)
+        samples = np.clip(samples, model.lower, model.upper)
+
+        flux = self.integrate(model, params)
+        sampled = self.integrate(model, samples.reshape(-1, len(model.param_names))).reshape(len(fits), self.n_samples)
+        low, high = np.nanpercentile(sampled, PERCENTILES, axis=1) if len(fits) else (flux, flux)
+
+        return flux, np.clip(flux - low, 0., None), np.clip(high - flux, 0., None)
+
+
+def engine_from_cfg(cfg_filename, band=models.FLUX_BAND, energy_flux=False, unabsorbed=False, n_samples=N_SAMPLES):
+    """FluxEngine with the NH_TBABS and REDSHIFT of config file `cfg_filename`"""
+    variables = utils.read_cfg(cfg_filename)
+    return FluxEngine(band, energy_flux, float(variables["NH_TBABS"]), float(variables["REDSHIFT"]), unabsorbed, n_samples)
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Fluxes of every ObsID and model in another energy band, from the fits already done.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--band", type=float, nargs=2, default=models.FLUX_BAND, metavar=("E_LOW", "E_HIGH"), help="Energy band (keV)")
+    parser.add_argument(
+        "--energy_flux", action="store_true", help="Energy flux (erg/cm^2/s) instead of photon flux (ph/cm^2/s)")
+    parser.add_argument(
+        "--unabsorbed", action="store_true", help="Flux without the Galactic and intrinsic absorption")
+    parser.add_argument(
+        "--n_samples", type=int, default=N_SAMPLES, help="Number of parameter sets drawn for the errors of each fit")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    engine = engine_from_cfg(cfg_filename, args.band, args.energy_flux, args.unabsorbed, args.n_samples)
+
+    products = product_index.load(base_data_dir, oids)
+    lines = ["oid,model,flux,flux_errn,flux_errp"]
+    for model_name in QUICK_MODELS:
+        fns = [fn for oid in oids for fn in products.glob(oid, spec_stem, model_name, "param_tbl.dat")]
+        for fn, flux, errn, errp in zip(fns, *engine.fluxes(model_name, fns)):
+            oid = os.path.relpath(fn, base_data_dir).split(os.sep)[0]
+            lines.append(f"{oid},{model_name},{flux:.6g},{errn:.6g},{errp:.6g}")
+
+    kind = "eflux" if args.energy_flux else "phflux"
+    fn_out = os.path.join(base_data_dir, f"{'unabs_' if args.unabsorbed else ''}{kind}_{args.band[0]:g}-{args.band[1]:g}keV.csv")
+    with open(fn_out, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"Wrote the {engine.label} of {len(lines) - 1} fit(s) to {fn_out}")
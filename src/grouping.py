@@ -0,0 +1,220 @@
+"""
+Group spectra with a minimum number of counts per bin, as was done with grppha in run_grppha.sh:
+    chkey backfile/respfile/ANCRFILE, bad 0-29, group min 20
+The GROUPING and QUALITY columns are computed with NumPy from the COUNTS column of the source spectrum (no grppha process is started)
+and written to {DDIR}/Obs_{OID}{mode}_{name}_grp.pi, e.g. Obs_00032646038wt_chi2_grp.pi for the 20 counts minimum used with chi-squared statistics.
+Several groupings (`variants`) are written in one pass over the source spectrum.
+"""
+
+
+import numpy as np
+import argparse
+import concurrent.futures
+import logging
+import os
+
+import product_index
+import tracing
+import utils
+
+
+# grppha `bad 0-29`: first and last channel (inclusive) flagged as bad
+BAD_CHANNELS = (0, 29)
+
+# Name of the grouping is the key (used in the filename), minimum counts per group is the value
+DEFAULT_VARIANTS = {"chi2": 20}
+
+# QUALITY values as written by grppha
+QUALITY_GOOD = 0
+# Channels of the final group that does not reach the minimum counts
+QUALITY_BAD_GROUP = 2
+QUALITY_BAD = 5
+
+
+def group_min_counts(channels, counts, min_counts, bad_channels=BAD_CHANNELS):
+    """Same as grppha `bad {first}-{last}` followed by `group min {min_counts}`.
+    Working up from the lowest good channel, a group is closed as soon as its counts reach `min_counts`.
+    Bad channels are not grouped. The channels left over at the end, which do not reach `min_counts`, are flagged as bad (QUALITY=2).
+
+    Group ends are found with a cumulative sum of the counts: the end of the group starting after cumulative count `c` is the first channel
+    where the cumulative sum reaches `c + min_counts`, i.e. one `searchsorted` per group rather than a Python step per channel.
+
+    Parameters
+    ----------
+    channels, counts : array_like[int]
+        CHANNEL and COUNTS columns of the source spectrum
+    min_counts : int
+        Minimum counts per group
+    bad_channels : tuple(int, int) or None
+        First and last channel (inclusive) to flag as bad
+
+    Returns
+    -------
+    grouping, quality : numpy.ndarray[int16]
+        GROUPING (1 starts a group, -1 continues it) and QUALITY columns
+    """
+
+    if min_counts < 1:
+        raise ValueError(f"Minimum counts per group must be at least 1, not {min_counts}")
+
+    channels = np.asarray(channels)
+    counts = np.asarray(counts)
+    grouping = np.ones(len(counts), dtype=np.int16)
+    quality = np.zeros(len(counts), dtype=np.int16)
+    if bad_channels is not None:
+        quality[(channels >= bad_channels[0]) & (channels <= bad_channels[1])] = QUALITY_BAD
+
+    good = np.flatnonzero(quality == QUALITY_GOOD)
+    cumsum = np.cumsum(counts[good])
+
+    starts = []
+    start, base = 0, 0
+    while start < len(good):
+        end = int(np.searchsorted(cumsum, base + min_counts))
+        if end >= len(good):
+            break
+        starts.append(start)
+        start, base = end + 1, cumsum[end]
+
+    grouping[good[:start]] = -1
+    grouping[good[starts]] = 1
+    # Left over channels that could not make a full group
+    quality[good[start:]] = QUALITY_BAD_GROUP
+
+    return grouping, quality
+
+
+def grouped_spec_fn(ddir, oid, mode, name):
+    """e.g. {ddir}/Obs_00032646038wt_chi2_grp.pi; `name`='chi2' matches what is loaded in the XSpec session (fit_scheduler.py)"""
+    return os.path.join(ddir, f"Obs_{oid}{mode}_{name}_grp.pi")
+
+
+def group_spectrum(ddir, oid, mode, variants=DEFAULT_VARIANTS, bad_channels=BAD_CHANNELS):
+    """Write one grouped spectrum per entry of `variants` for ObsID `oid` observed in `mode`, from {ddir}/Obs_{oid}{mode}source.pi.
+    BACKFILE, RESPFILE and ANCRFILE are set to the background spectrum, RMF and ARF in `ddir`. Existing files are overwritten.
+
+    Parameters
+    ----------
+    ddir : str
+        Directory with the downloaded data products, {BASE_DATA_DIR}/{OID}/USERPROD_*/{SPEC_STEM}
+    oid, mode : str
+        ObsID and its mode, 'pc' or 'wt'
+    variants : dict
+        Name of the grouping is the key, minimum counts per group is the value
+
+    Returns
+    -------
+    written : list[str]
+        Grouped spectra written
+    """
+
+    src_spec = os.path.join(ddir, f"Obs_{oid}{mode}source.pi")
+    keywords = {
+        "BACKFILE": os.path.join(ddir, f"Obs_{oid}{mode}back.pi"),
+        "RESPFILE": os.path.join(ddir, f"Obs_{oid}{mode}.rmf"),
+        "ANCRFILE": os.path.join(ddir, f"Obs_{oid}{mode}.arf"),
+        }
+
+    from astropy.io import fits
+
+    written = []
+    with fits.open(src_spec) as hdul:
+        spec = hdul["SPECTRUM"]
+        channels, counts = spec.data["CHANNEL"], spec.data["COUNTS"]
+        for name, min_counts in variants.items():
+            grouping, quality = group_min_counts(channels, counts, min_counts, bad_channels)
+            cols = [c for c in spec.columns if c.name not in ("QUALITY", "GROUPING")]
+            cols += [fits.Column(name="QUALITY", format="I", array=quality),
+                     fits.Column(name="GROUPING", format="I", array=grouping)]
+            grp = fits.BinTableHDU.from_columns(cols, header=spec.header)
+            # grppha removes the QUALITY=0 and GROUPING=0 keywords (no quality or grouping defined), which would contradict the columns,
+            # and the blank cards the extractor leaves for later keywords
+            for k in ("QUALITY", "GROUPING", ""):
+                grp.header.remove(k, ignore_missing=True, remove_all=True)
+            for k, v in keywords.items():
+                grp.header[k] = v
+            # Short enough for the card to fit in 80 characters
+            grp.header["LONGSTRN"] = ("OGIP 1.0", "The OGIP Long String Convention may be used.")
+            # grppha writes these in single precision
+            for k in ("EXPOSURE", "BACKSCAL"):
+                if k in grp.header:
+                    grp.header[k] = float(f"{np.float32(grp.header[k]):.7g}")
+            out = fits.HDUList([hdu if hdu is not spec else grp for hdu in hdul])
+            fn = grouped_spec_fn(ddir, oid, mode, name)
+            # The checksums copied from the source spectrum are computed again for the grouped one
+            out.writeto(fn, overwrite=True, checksum=True)
+            written.append(fn)
+
+    return written
+
+
+def group_all(base_data_dir, oids, modes, spec_stem, variants=DEFAULT_VARIANTS, max_workers=None):
+    """Run `group_spectrum()` for every ObsID in `oids` (observed in the corresponding mode in `modes`) across a process pool.
+
+    Returns
+    -------
+    written : dict
+        ObsID is the key, list of grouped spectra is the value. ObsIDs that could not be grouped are not included.
+    """
+
+    written = {}
+    products = product_index.load(base_data_dir, oids)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for oid, mode in zip(oids, modes):
+            # This is expected to be a one element list
+            ddirs = products.data_dirs(oid, spec_stem)
+            if len(ddirs) != 1:
+                msg = f"Expected one USERPROD*/{spec_stem} directory for ObsID {oid} but found {ddirs}. Skipping"
+                print(msg)
+                logging.error(msg)
+                continue
+            futures[pool.submit(tracing.run_traced, "ObsID", "group", {"oid": oid}, group_spectrum, ddirs[0], oid, mode, variants)] = oid
+        for future in concurrent.futures.as_completed(futures):
+            oid = futures[future]
+            try:
+                written[oid] = future.result()
+            except (OSError, KeyError) as err:
+                msg = f"Could not group ObsID {oid}: {err}"
+                print(msg)
+                logging.error(msg)
+                continue
+            msg = f"Wrote {written[oid]}"
+            print(msg)
+            logging.info(msg)
+
+    return written
+
+
+def parse_variants(variants):
+    """['chi2=20', 'cstat=1'] -> {'chi2': 20, 'cstat': 1}"""
+    if isinstance(variants, str):
+        variants = [variants]
+    parsed = {name: int(n) for name, n in (v.split('=') for v in variants)}
+    for name, n in parsed.items():
+        if n < 1:
+            raise ValueError(f"GROUPING_VARIANTS: minimum counts of '{name}' must be at least 1, not {n}")
+    return parsed
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Groups the spectra for chi-squared statistics, replacing run_grppha.sh.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--max_workers", type=int, default=None, help="Number of ObsIDs grouped at once. Default is the number of CPUs.")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    variables = utils.read_cfg(cfg_filename)
+    modes = variables["MODES"]
+    if isinstance(modes, str):
+        modes = [modes]
+    variants = parse_variants(variables["GROUPING_VARIANTS"]) if "GROUPING_VARIANTS" in variables else DEFAULT_VARIANTS
+
+    tracing.configure(cfg_filename)
+    with tracing.span("group", tracing.STAGE):
+        group_all(base_data_dir, oids, modes, spec_stem, variants=variants, max_workers=args.max_workers)
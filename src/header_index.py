@@ -0,0 +1,112 @@
+"""
+Index of the spectrum (.pi) header keywords used in this workflow: livetime, observation start date and mode.
+Only the primary header of each spectrum is read (the data are never loaded) and the file is closed straight away.
+The values are kept in an on-disk cache, {BASE_DATA_DIR}/_header_index.json, keyed by the path of the spectrum and
+its modification time, so a spectrum is only read again if it changed.
+astropy is only imported when a spectrum has to be read, so looking up a cached index does not pay for importing it.
+"""
+
+
+import json
+import logging
+import os
+import threading
+
+
+INDEX_FN = "_header_index.json"
+
+# Primary header keywords stored in the index
+HEADER_KEYS = ("LIVETIME", "DATE-OBS", "DATAMODE", "OBS_ID")
+
+
+def read_primary_header(fn_pi):
+    """Read only the primary header of FITS file `fn_pi`, stopping at its END card, and close the file."""
+
+    from astropy.io import fits
+
+    with open(fn_pi, 'rb') as f:
+        return fits.Header.fromfile(f)
+
+
+def _stat_key(fn):
+    st = os.stat(fn)
+    return [st.st_mtime_ns, st.st_size]
+
+
+class HeaderIndex:
+    """Header keywords of spectra, cached in `cache_fn` (if None, the index only lives in memory).
+    Each entry is keyed by the absolute path of the spectrum and holds HEADER_KEYS plus 'MJD' (from DATE-OBS).
+    """
+
+    def __init__(self, cache_fn=None):
+        self.cache_fn = cache_fn
+        self.entries = {}
+        if cache_fn is not None and os.path.exists(cache_fn):
+            try:
+                with open(cache_fn, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                # e.g. truncated by a crash: the spectra are read again
+                logging.warning(f"Unreadable header index {cache_fn} ({e}); starting from an empty index.")
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_base_data_dir(cls, base_data_dir):
+        return cls(os.path.join(base_data_dir, INDEX_FN))
+
+    def save(self):
+        if self.cache_fn is None:
+            return
+        # A temporary file of its own per process and thread, so that indexes saved at once (e.g. by the workers of watch.py) never write
+        # into the same file; the last one replaced wins
+        with self._lock:
+            tmp = f"{self.cache_fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.cache_fn)
+
+    def scan(self, fns):
+        """Make sure every spectrum in `fns` is indexed and up to date. New and changed spectra are read, and their DATE-OBS
+        are converted to MJD in a single call to astropy Time. The cache is saved once, if anything changed.
+
+        Returns
+        -------
+        entries : list[dict]
+            Index entry of each spectrum in `fns`, in the same order
+        """
+
+        keys = [os.path.abspath(fn) for fn in fns]
+        stale = []
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is None or entry["stat"] != _stat_key(key):
+                stale.append(key)
+
+        if stale:
+            from astropy.time import Time
+
+            new = {}
+            for key in stale:
+                hdr = read_primary_header(key)
+                new[key] = {k: hdr.get(k) for k in HEADER_KEYS}
+                new[key]["stat"] = _stat_key(key)
+            # YYYY-MM-DDThh:mm:ss
+            mjds = Time([new[key]["DATE-OBS"] for key in stale], format='isot').mjd
+            for key, mjd in zip(stale, mjds):
+                new[key]["MJD"] = float(mjd)
+            with self._lock:
+                self.entries.update(new)
+            self.save()
+
+        return [self.entries[key] for key in keys]
+
+    def get(self, fn):
+        return self.scan([fn])[0]
+
+    def livetimes(self, fns):
+        """Deadtime corrected livetime in seconds of each spectrum in `fns`."""
+        return [float(entry["LIVETIME"]) for entry in self.scan(fns)]
+
+    def mjds(self, fns):
+        """Observation start date (MJD) of each spectrum in `fns`."""
+        return [entry["MJD"] for entry in self.scan(fns)]
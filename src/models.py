@@ -0,0 +1,370 @@
+"""
+Registry of the XSpec models fitted in this workflow, and the XSpec session that fits them.
+Each model is described once here: its XSpec expression, the answer to XSpec's prompt for each parameter, which parameters are frozen,
+and which are written to param_tbl.dat. From this one XSpec script per ObsID is generated, which loads the grouped spectrum once and fits
+every model back-to-back (with `model clear` in between), writing the output tables and plots of each model to {DDIR}/{model name}/.
+read_output.py and analyse_output.py take the model names and parameter names from here too.
+
+To add a model, `register()` an `XspecModel`; no new script is needed.
+"""
+
+
+from dataclasses import dataclass
+import os
+import shutil
+
+
+# Energies (keV) outside of which channels are ignored, and the band (keV) of the integral flux
+E_NOTICE = (0.3, 10.)
+FLUX_BAND = (2., 10.)
+
+# Output files of each model, as named in the config file (config variable is the key, default is the value)
+OUTPUT_TBLS = {
+    "PARAM_TBL": "param_tbl.dat",
+    "STAT_TBL": "stat_tbl.dat",
+    "DATA_TBL": "spec_binned.dat",
+    "UNBINNED_DATA_TBL": "spec_default_bin.dat",
+    "COVAR_TBL": "covar_tbl.dat",
+    "RESID_TBL": "resid_tbl.dat",
+    }
+OUTPUT_PLTS = {
+    "PLT_RESID": "resid.png",
+    "PLT_PHFLUX": "phflux.png",
+    "PLT_EFLUX": "eflux.png",
+    }
+
+# Name of the generated script, written to {DDIR}
+SESSION_SCRIPT_FN = "_xspec_session.xcm"
+
+# FIT_PLOTS in the config file: who makes eflux.png, phflux.png and resid.png. With 'python' or 'none', XSpec only writes the tables
+# (on the null plot device, so no X display is needed); xspec_plots.py makes the plots from them with 'python'
+FIT_PLOTS = ("xspec", "python", "none")
+
+# Start of the lines printed to XSpec's log when the fit of a model starts and ends, followed by start/end, the model and the time (ms)
+TIMESTAMP_TAG = "XRT_WORKFLOW_MODEL"
+
+
+@dataclass
+class ModelParam:
+    """One parameter of an XSpec model, in the order XSpec prompts for them"""
+    name: str
+    # Answer to XSpec's prompt for this parameter; '' keeps XSpec's default. Config variables can be used, e.g. '{NH_TBABS}'
+    initial: str = ""
+    frozen: bool = False
+    # Whether the parameter gets a row in param_tbl.dat
+    tabulate: bool = True
+
+
+@dataclass
+class XspecModel:
+    """A model fitted in XSpec. `name` is also the name of the output directory."""
+    name: str
+    expression: str
+    params: tuple
+    # For plot legends, e.g. 'Galactic absorbed powerlaw' instead of powlaw_tbabs
+    description: str = ""
+    # Name of the count rate row in param_tbl.dat
+    rate_name: str = "countrate"
+    # Pairs of parameters (names) whose confidence contours contours.py computes
+    contours: tuple = ()
+
+    @property
+    def param_names_index(self):
+        """Name of each parameter in param_tbl.dat is the key, its row is the value"""
+        return {p.name: i for i, p in enumerate(p for p in self.params if p.tabulate)}
+
+    def free_indices(self):
+        """XSpec parameter numbers (starting at 1) of the free parameters"""
+        return [i for i, p in enumerate(self.params, start=1) if not p.frozen]
+
+
+REGISTRY = {}
+
+
+def register(model):
+    """Add `model` to the models fitted by the workflow."""
+    REGISTRY[model.name] = model
+    return model
+
+
+register(XspecModel(
+    "powlaw_tbabs", "tbabs(powerlaw)",
+    (ModelParam("nH", "{NH_TBABS}", frozen=True, tabulate=False),
+     ModelParam("PhoIndex"),
+     ModelParam("norm")),
+    description="Galactic absorbed powerlaw",
+    contours=(("PhoIndex", "norm"),)))
+
+register(XspecModel(
+    "logpar_tbabs", "tbabs(logpar)",
+    (ModelParam("nH", "{NH_TBABS}", frozen=True, tabulate=False),
+     ModelParam("alpha"),
+     ModelParam("beta"),
+     ModelParam("pivotE", frozen=True),
+     ModelParam("norm")),
+    description="Galactic absorbed logparabola",
+    contours=(("alpha", "beta"),)))
+
+register(XspecModel(
+    "powlaw_ztbabs_tbabs", "tbabs*ztbabs(powerlaw)",
+    (ModelParam("nH", "{NH_TBABS}", frozen=True, tabulate=False),
+     ModelParam("ztbabs_nh"),
+     ModelParam("Redshift", "{REDSHIFT}", frozen=True, tabulate=False),
+     ModelParam("PhoIndex"),
+     ModelParam("norm")),
+    description="Galactic + intrinsic absorbed powerlaw",
+    rate_name="cRate",
+    contours=(("ztbabs_nh", "PhoIndex"),)))
+
+MODELS = list(REGISTRY)
+
+
+def _ranges(indices):
+    """[2, 3, 5] -> ['2-3', '5'], as the parameter ranges of XSpec's `error`"""
+    ranges, start = [], None
+    for i, idx in enumerate(indices):
+        if start is None:
+            start = idx
+        if i + 1 == len(indices) or indices[i + 1] != idx + 1:
+            ranges.append(f"{start}-{idx}" if idx != start else f"{idx}")
+            start = None
+    return ranges
+
+
+def plots_in_xspec(variables):
+    """Whether the XSpec session makes the plots, as set by FIT_PLOTS in config variables `variables`"""
+    fit_plots = (variables or {}).get("FIT_PLOTS") or FIT_PLOTS[0]
+    if fit_plots not in FIT_PLOTS:
+        raise ValueError(f"FIT_PLOTS is {fit_plots!r}; expected one of {FIT_PLOTS}")
+    return fit_plots == "xspec"
+
+
+def output_paths(data_dir, model_name, variables=None):
+    """Output tables and plots of `model_name` in {data_dir}/{model_name}/; config variable (e.g. PARAM_TBL) is the key, path is the value"""
+    variables = variables or {}
+    outdir = os.path.join(data_dir, model_name)
+    return {k: os.path.join(outdir, variables.get(k, v)) for k, v in {**OUTPUT_TBLS, **OUTPUT_PLTS}.items()}
+
+
+def _write_table(var, fn, x, xerr, y, yerr, model_y):
+    """Tcl to write the eeufspec plot data to `fn`: energy (keV), energy half bin width, eflux (keV/cm^2/s), eflux_error, model_eflux"""
+    return [
+        f"set {x} [tcloutr plot eeufspec x]",
+        f"set {xerr} [tcloutr plot eeufspec xerr]",
+        f"set {y} [tcloutr plot eeufspec y]",
+        f"set {yerr} [tcloutr plot eeufspec yerr]",
+        f"set {model_y} [tcloutr plot eeufspec model]",
+        f"set {var} [open {fn} w+]",
+        f"set len [llength ${x}]",
+        f"for {{set idx 0}} {{$idx < $len}} {{incr idx}} {{puts ${var} \"[lindex ${x} $idx] [lindex ${xerr} $idx] [lindex ${y} $idx] "
+        f"[lindex ${yerr} $idx] [lindex ${model_y} $idx]\"}}",
+        f"close ${var}",
+        ]
+
+
+def _write_resid_table(fn):
+    """Tcl to write the residuals of the last `plot res` to `fn`: energy (keV), energy half bin width, data - model (counts/s/keV), its error"""
+    return [
+        "set xRes [tcloutr plot res x]",
+        "set xResErr [tcloutr plot res xerr]",
+        "set yRes [tcloutr plot res y]",
+        "set yResErr [tcloutr plot res yerr]",
+        f"set residTable [open {fn} w+]",
+        "set len [llength $xRes]",
+        "for {set idx 0} {$idx < $len} {incr idx} {puts $residTable \"[lindex $xRes $idx] [lindex $xResErr $idx] [lindex $yRes $idx] "
+        "[lindex $yResErr $idx]\"}",
+        "close $residTable",
+        ]
+
+
+def model_commands(model, data_dir, variables):
+    """XSpec commands that fit `model` to the loaded spectrum and write its output tables and plots to {data_dir}/{model.name}/
+
+    Parameters
+    ----------
+    model : XspecModel
+    data_dir : str
+        {BASE_DATA_DIR}/{OID}/USERPROD_*/{SPEC_STEM}
+    variables : dict
+        Config variables (utils.read_cfg), used in the initial parameter values and output filenames
+
+    Returns
+    -------
+    commands : list[str]
+    """
+
+    out = output_paths(data_dir, model.name, variables)
+    outdir = os.path.join(data_dir, model.name)
+    frozen = [i for i, p in enumerate(model.params, start=1) if p.frozen]
+    cmds = [f'puts "{TIMESTAMP_TAG} start {model.name} [clock milliseconds]"',
+            f"model {model.expression}"]
+    # One answer per parameter prompt; a blank line keeps the default
+    cmds += [p.initial.format(**variables) for p in model.params]
+    cmds += [f"freeze {' '.join(map(str, frozen))}"] if frozen else []
+    cmds += ["fit",
+             f"save all {outdir}/fit"]
+
+    # 1 sigma bounds of the free parameters, and the integral flux with its 68% confidence interval (flux with absorption)
+    cmds += [f"error 1. {r}" for r in _ranges(model.free_indices())]
+    # Covariance of the free parameters at the best fit (`error` refits if it finds a new minimum), for fluxes in other bands
+    # (flux_engine.py): the names of the free parameters, then the lower triangle of their covariance matrix, row by row
+    cmds += ["set covar [tcloutr covariance]",
+             f"set covarTable [open {out['COVAR_TBL']} w+]",
+             f'puts $covarTable "{" ".join(p.name for p in model.params if not p.frozen)}"',
+             'puts $covarTable "$covar"',
+             "close $covarTable"]
+    cmds += [f"flux {FLUX_BAND[0]:g} {FLUX_BAND[1]:g} err",
+             # 6 values: val errLow errHigh (in ergs/cm2/s) val errLow errHigh (in photons/cm2/s)
+             "set parFlux [tcloutr flux]"]
+    for i, p in enumerate(model.params, start=1):
+        if p.tabulate:
+            # value, delta, min, low, high, max
+            cmds.append(f"set par{i} [tcloutr param {i}]")
+            if not p.frozen:
+                # Lower bound, upper bound, error string
+                cmds.append(f"set par{i}Err [tcloutr error {i}]")
+    cmds += ["set rateEtc [tcloutr rate all]",
+             "set cRate [lindex $rateEtc 0]",
+             "set cRateErr [lindex $rateEtc 1]",
+             "set cRateLow [expr {$cRate - $cRateErr}]",
+             "set cRateHigh [expr {$cRate + $cRateErr}]",
+             f"set paramTable [open {out['PARAM_TBL']} w+]",
+             'puts $paramTable "name param param_low param_high error_string"']
+    for i, p in enumerate(model.params, start=1):
+        if not p.tabulate:
+            continue
+        if p.frozen:
+            cmds.append(f'puts $paramTable "{p.name} [lindex $par{i} 0] 0 0 0"')
+        else:
+            cmds.append(f'puts $paramTable "{p.name} [lindex $par{i} 0] [lindex $par{i}Err 0] [lindex $par{i}Err 1] [lindex $par{i}Err 2]"')
+    cmds += ['puts $paramTable "flux [lindex $parFlux 3] [lindex $parFlux 4] [lindex $parFlux 5] 0"',
+             f'puts $paramTable "{model.rate_name} $cRate $cRateLow $cRateHigh 0"',
+             "close $paramTable",
+             "set nullProb [tcloutr nullhyp]",
+             "set chiSq [tcloutr stat]",
+             "set dof [tcloutr dof]",
+             f"set statTable [open {out['STAT_TBL']} w+]",
+             'puts $statTable "chi_squared deg_freedom null_hyp_probability"',
+             'puts $statTable "[lindex $chiSq 0] [lindex $dof 0] [lindex $nullProb 0]"',
+             "close $statTable",
+             ""]
+
+    if not plots_in_xspec(variables):
+        # Only the tables the plots are made from, each extracted once: the unfolded spectrum and model, and the residuals
+        cmds += ["plot eemodel eeufspec"]
+        cmds += _write_table("unbinDataTable", out['UNBINNED_DATA_TBL'], "xDataEnergy", "xDataEnergyErr", "yDataEFlux", "yDataEFluxErr",
+                             "modelDataEFlux")
+        cmds += ["plot res"]
+        cmds += _write_resid_table(out['RESID_TBL'])
+        cmds += ["",
+                 f'puts "{TIMESTAMP_TAG} end {model.name} [clock milliseconds]"',
+                 "model clear",
+                 ""]
+        return cmds
+
+    # Residuals with the default binning
+    e_lo, e_hi = f"{E_NOTICE[0]:g}", f"{E_NOTICE[1]:g}"
+    cmds += ["plot res",
+             f"setplot command rescale {e_lo} {e_hi}",
+             "iplot",
+             f"hard {out['PLT_RESID']}/png",
+             "clear",
+             "q",
+             ""]
+    cmds += _write_resid_table(out['RESID_TBL'])
+    # E^2 dN/dE of the model and of the unfolded spectrum, with the default binning
+    cmds += ["plot eemodel eeufspec",
+             f"setplot command rescale {e_lo} {e_hi}",
+             "plot eemodel eeufspec"]
+    cmds += _write_table("unbinDataTable", out['UNBINNED_DATA_TBL'], "xDataEnergy", "xDataEnergyErr", "yDataEFlux", "yDataEFluxErr",
+                         "modelDataEFlux")
+    cmds += [""]
+    # Same, with 5 bins combined into one (or signal:noise=100000)
+    cmds += ["cpd /xw",
+             "plot eemodel eeufspec",
+             f"setplot command rescale {e_lo} {e_hi}",
+             "setplot rebin 100000 5",
+             "plot eemodel eeufspec",
+             "iplot",
+             f"hard {out['PLT_EFLUX']}/png",
+             "clear",
+             "q",
+             "cpd /xw",
+             "plot ufspec",
+             f"setplot command rescale {e_lo} {e_hi}",
+             "setplot rebin 100000 5",
+             "plot ufspec",
+             "iplot",
+             f"hard {out['PLT_PHFLUX']}/png",
+             "clear",
+             "q",
+             ""]
+    cmds += _write_table("datatable", out['DATA_TBL'], "xDataEnergy", "xDataEnergyErr", "yDataEFlux", "yDataEFluxErr", "modelDataEFlux")
+    cmds += ["",
+             f'puts "{TIMESTAMP_TAG} end {model.name} [clock milliseconds]"',
+             # Plot settings would otherwise carry over to the next model
+             "model clear",
+             "setplot rebin 0 1",
+             "setplot delete all",
+             ""]
+
+    return cmds
+
+
+def model_times(fn_log, start=0):
+    """Start and end (seconds since the epoch) of the fit of each model in XSpec log `fn_log`, from the lines printed by `model_commands()`,
+    read from byte `start` on (e.g. where a retry started appending). Models whose fit did not end are left out."""
+
+    starts, times = {}, {}
+    with open(fn_log, 'r', errors='replace') as f:
+        f.seek(start)
+        for line in f:
+            words = line.split()
+            if len(words) == 4 and words[0] == TIMESTAMP_TAG and words[3].isdigit():
+                if words[1] == "start":
+                    starts[words[2]] = int(words[3]) / 1e3
+                elif words[2] in starts:
+                    times[words[2]] = (starts[words[2]], int(words[3]) / 1e3)
+    return times
+
+
+def session_script(fn_grp, data_dir, model_names, variables):
+    """XSpec commands (with Tcl) that load grouped spectrum `fn_grp` once and fit every model in `model_names`.
+    The commands are read from XSpec's standard input, so blank lines answer parameter prompts with the default."""
+
+    cmds = [f"data {fn_grp}",
+            "ignore bad",
+            f"ignore **-{E_NOTICE[0]:g}",
+            f"ignore {E_NOTICE[1]:.1f}-**",
+            # The null device needs no X display
+            "cpd /xw" if plots_in_xspec(variables) else "cpd /null",
+            "setplot energy keV",
+            "abund wilm",
+            ""]
+    for name in model_names:
+        cmds += model_commands(REGISTRY[name], data_dir, variables)
+    cmds += ["cpd none",
+             "quit",
+             "y"]
+
+    return "\n".join(cmds) + "\n"
+
+
+def move_old_outputs(data_dir, model_names, trash_dir, variables=None):
+    """Move already existing output tables of `model_names` to `trash_dir`, so they are written afresh by XSpec.
+    A file with the same name in `trash_dir` is overwritten."""
+
+    for name in model_names:
+        os.makedirs(os.path.join(data_dir, name), exist_ok=True)
+        out = output_paths(data_dir, name, variables)
+        for k in OUTPUT_TBLS:
+            if os.path.exists(out[k]):
+                shutil.move(out[k], os.path.join(trash_dir, os.path.basename(out[k])))
+
+
+def write_session_script(fn_grp, data_dir, model_names, variables):
+    """Write `session_script()` to {data_dir}/_xspec_session.xcm and return its path."""
+    fn = os.path.join(data_dir, SESSION_SCRIPT_FN)
+    with open(fn, 'w') as f:
+        f.write(session_script(fn_grp, data_dir, model_names, variables))
+    return fn
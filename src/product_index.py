@@ -0,0 +1,243 @@
+"""
+Index of the data products and fit outputs in BASE_DATA_DIR, which are laid out as
+
+    {BASE_DATA_DIR}/{OID}/USERPROD_*/{SPEC_STEM}/    spectra, backgrounds, responses, grouped spectra
+    {BASE_DATA_DIR}/{OID}/USERPROD_*/{SPEC_STEM}/{model}/    tables and plots of each fit
+
+The directory tree is walked once with os.scandir() and kept in an on-disk cache, {BASE_DATA_DIR}/_product_index.json: the subdirectories and
+files of every directory, with its modification time. A refresh only stats the directories already indexed, and lists again those whose
+modification time changed (a file or subdirectory was added, removed or renamed), so on a network filesystem finding the products of
+thousands of ObsIDs costs a stat per directory instead of a listing per glob. Files rewritten in place do not change the index.
+
+`ProductIndex.glob()` stands in for glob.glob() of {BASE_DATA_DIR}/{OID}/USERPROD*/{SPEC_STEM}[/{model}]/{pattern}.
+
+The shell scripts cannot read the index, so `python product_index.py --cfg_fn CFG_FN` also writes {BASE_DATA_DIR}/_product_index.sh, which
+sets DDIR_{OID} to the data directory of each ObsID; see run_grppha.sh.
+"""
+
+
+import argparse
+import fnmatch
+import json
+import logging
+import os
+import threading
+import time
+
+import utils
+
+
+INDEX_FN = "_product_index.json"
+
+# Written for the shell scripts by `write_shell_exports()`
+SHELL_EXPORT_FN = "_product_index.sh"
+
+# Prefix of the product directories inside the directory of each ObsID
+USERPROD_PREFIX = "USERPROD"
+
+# Depth of the deepest directories indexed: {OID} is 1, USERPROD_* 2, {SPEC_STEM} 3, {model} 4
+MAX_DEPTH = 4
+
+# A directory modified this recently (ns) may change again within the resolution of its modification time, so it is listed again next time
+RACY_NS = 2 * 10**9
+
+
+class ProductIndex:
+    """Subdirectories and files of every directory in `base_data_dir` down to MAX_DEPTH, cached in `cache_fn` (if None, the index only
+    lives in memory). Each entry is keyed by the path of the directory relative to `base_data_dir` ('' for `base_data_dir` itself).
+    Call `refresh()` to bring it up to date with the disk.
+    """
+
+    def __init__(self, base_data_dir, cache_fn=None):
+        self.base_data_dir = base_data_dir
+        self.cache_fn = cache_fn
+        self.dirs = {}
+        if cache_fn is not None and os.path.exists(cache_fn):
+            try:
+                with open(cache_fn, 'r') as f:
+                    self.dirs = json.load(f)
+            except (OSError, ValueError) as e:
+                # e.g. truncated by a crash: the directory tree is walked again
+                logging.warning(f"Unreadable product index {cache_fn} ({e}); starting from an empty index.")
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # The index is sent to the workers of the render pools (analyse_output.py, xspec_plots.py); a lock cannot be pickled
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_base_data_dir(cls, base_data_dir):
+        return cls(base_data_dir, os.path.join(base_data_dir, INDEX_FN))
+
+    def save(self):
+        if self.cache_fn is None:
+            return
+        # A temporary file of its own per process and thread, as in header_index.py
+        with self._lock:
+            tmp = f"{self.cache_fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+            # json.dumps() encodes in C, json.dump() does not
+            with open(tmp, 'w') as f:
+                f.write(json.dumps(self.dirs))
+            os.replace(tmp, self.cache_fn)
+
+    def _list(self, rel, depth, mtime_ns):
+        """Entry of directory `rel` from one listing of it"""
+        subdirs, files = [], []
+        with os.scandir(os.path.join(self.base_data_dir, rel)) as it:
+            for entry in it:
+                if entry.is_dir():
+                    # Only the product directories inside the directory of an ObsID
+                    if depth < MAX_DEPTH and (depth != 1 or entry.name.startswith(USERPROD_PREFIX)):
+                        subdirs.append(entry.name)
+                elif depth > 0:
+                    files.append(entry.name)
+        racy = time.time_ns() - mtime_ns < RACY_NS
+        return {"mtime_ns": None if racy else mtime_ns, "dirs": sorted(subdirs), "files": sorted(files)}
+
+    def _refresh_dir(self, rel, depth, seen):
+        """Bring the entry of directory `rel` and of its subdirectories up to date. Returns True if any entry changed."""
+        try:
+            mtime_ns = os.stat(os.path.join(self.base_data_dir, rel)).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        seen.add(rel)
+        changed = False
+        entry = self.dirs.get(rel)
+        if entry is None or entry["mtime_ns"] != mtime_ns:
+            old, entry = entry, self._list(rel, depth, mtime_ns)
+            # Saving the index changes the modification time of BASE_DATA_DIR, so only a change of the listing is a change of the index
+            changed = old is None or (old["dirs"], old["files"]) != (entry["dirs"], entry["files"])
+            self.dirs[rel] = entry
+        for name in entry["dirs"]:
+            changed |= self._refresh_dir(os.path.join(rel, name), depth + 1, seen)
+        return changed
+
+    def refresh(self, oids=None):
+        """Bring the index up to date with the disk: for the ObsIDs in `oids`, or for all of BASE_DATA_DIR if None.
+        Directories that no longer exist are dropped. The cache is saved once, if anything changed.
+
+        Returns
+        -------
+        self : ProductIndex
+        """
+
+        seen = set()
+        roots = [("", 0)] if oids is None else [(oid, 1) for oid in oids]
+        changed = False
+        for rel, depth in roots:
+            changed |= self._refresh_dir(rel, depth, seen)
+        prefixes = tuple(rel + os.sep for rel, _ in roots if rel)
+        for rel in list(self.dirs):
+            # Under the directories refreshed but not found there
+            if rel not in seen and (oids is None or rel in dict(roots) or rel.startswith(prefixes)):
+                del self.dirs[rel]
+                changed = True
+        if changed:
+            self.save()
+
+        return self
+
+    def _match(self, rel, pattern):
+        """Subdirectories of `rel` that match `pattern`"""
+        entry = self.dirs.get(rel)
+        if entry is None:
+            return []
+        return [os.path.join(rel, name) for name in entry["dirs"] if fnmatch.fnmatchcase(name, pattern)]
+
+    def _oids(self):
+        """Names of the ObsID directories in the index: those listed in the entry of `base_data_dir` itself, which only a full refresh
+        brings up to date, and those refreshed on their own (`refresh(oids)`), which may be missing from it"""
+        names = set(self.dirs[""]["dirs"]) if "" in self.dirs else set()
+        names.update(rel for rel in self.dirs if rel and os.sep not in rel)
+        return sorted(names)
+
+    def data_dirs(self, oid="*", spec_stem="*", model=None):
+        """Indexed directories {base_data_dir}/{oid}/USERPROD*/{spec_stem}[/{model}], as from glob.glob(); each argument may be a glob pattern"""
+        rels = [oid] if oid in self.dirs else [name for name in self._oids() if fnmatch.fnmatchcase(name, oid)]
+        for pattern in [f"{USERPROD_PREFIX}*", spec_stem] + ([model] if model is not None else []):
+            rels = [sub for rel in rels for sub in self._match(rel, pattern)]
+        return [os.path.join(self.base_data_dir, rel) for rel in rels]
+
+    def data_dir(self, oid, spec_stem):
+        """{base_data_dir}/{oid}/USERPROD_*/{spec_stem}, or None if there is no (single) USERPROD* directory for `oid`"""
+        ddirs = self.data_dirs(oid, spec_stem)
+        return ddirs[0] if len(ddirs) == 1 else None
+
+    def files(self, ddir, pattern="*"):
+        """Indexed files in directory `ddir` (a path in `base_data_dir`) that match `pattern`"""
+        entry = self.dirs.get(os.path.relpath(ddir, self.base_data_dir))
+        if entry is None:
+            return []
+        return [os.path.join(ddir, name) for name in entry["files"] if fnmatch.fnmatchcase(name, pattern)]
+
+    def glob(self, oid="*", spec_stem="*", model=None, pattern="*"):
+        """Indexed files {base_data_dir}/{oid}/USERPROD*/{spec_stem}[/{model}]/{pattern}, sorted; each argument may be a glob pattern"""
+        return sorted(fn for ddir in self.data_dirs(oid, spec_stem, model) for fn in self.files(ddir, pattern))
+
+    def products(self, oid, spec_stem):
+        """Products of ObsID `oid` in its data directory, by kind and mode, e.g.
+        {"data_dir": ..., "modes": ["wt"], "spectra": {"wt": ...}, "backgrounds": {"wt": ...}, "responses": {"wt": {"rmf": ..., "arf": ...}},
+         "grouped": {"wt": [...]}, "models": {"powlaw_tbabs": [...]}}, or None if there is no (single) data directory"""
+
+        ddir = self.data_dir(oid, spec_stem)
+        if ddir is None:
+            return None
+        rel = os.path.relpath(ddir, self.base_data_dir)
+        files = self.dirs[rel]["files"]
+        stem = f"Obs_{oid}"
+        modes = sorted(name[len(stem):-len("source.pi")] for name in files if name.startswith(stem) and name.endswith("source.pi"))
+        products = {"data_dir": ddir, "modes": modes, "spectra": {}, "backgrounds": {}, "responses": {}, "grouped": {}, "models": {}}
+        for mode in modes:
+            path = os.path.join(ddir, f"{stem}{mode}")
+            products["spectra"][mode] = f"{path}source.pi"
+            if f"{stem}{mode}back.pi" in files:
+                products["backgrounds"][mode] = f"{path}back.pi"
+            products["responses"][mode] = {ext: f"{path}.{ext}" for ext in ("rmf", "arf") if f"{stem}{mode}.{ext}" in files}
+            products["grouped"][mode] = [os.path.join(ddir, name) for name in files if fnmatch.fnmatchcase(name, f"{stem}{mode}_*_grp.pi")]
+        for model in self.dirs[rel]["dirs"]:
+            products["models"][model] = [os.path.join(ddir, model, name) for name in self.dirs[os.path.join(rel, model)]["files"]]
+
+        return products
+
+    def write_shell_exports(self, fn, oids, spec_stem):
+        """Write `fn`, to be sourced by the shell scripts: DDIR_{OID}="{data directory}" for every ObsID in `oids` that has one"""
+        lines = ["# Data directory of each ObsID, written by product_index.py"]
+        for oid in oids:
+            ddir = self.data_dir(oid, spec_stem)
+            if ddir is not None:
+                lines.append(f'DDIR_{oid}="{ddir}"')
+        with open(fn, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def load(base_data_dir, oids=None):
+    """Index cached in `base_data_dir`, refreshed for the ObsIDs in `oids` (all of them if None)"""
+    return ProductIndex.for_base_data_dir(base_data_dir).refresh(oids)
+
+
+def for_oid(base_data_dir, oid):
+    """Index of the directories of ObsID `oid` only, listed now and not cached, for looking up one ObsID without loading the whole index"""
+    return ProductIndex(base_data_dir).refresh([oid])
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Indexes the data products and fit outputs, and writes the data directories for the shell scripts.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    t_start = time.perf_counter()
+    index = load(base_data_dir)
+    fn_sh = os.path.join(base_data_dir, SHELL_EXPORT_FN)
+    index.write_shell_exports(fn_sh, oids, spec_stem)
+    print(f"Indexed {len(index.dirs)} directories of {base_data_dir} in {time.perf_counter() - t_start:.2f} s. Wrote {fn_sh}")
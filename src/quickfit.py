@@ -0,0 +1,382 @@
+"""
+Quick-look fits of the models in models.REGISTRY without XSpec, e.g. to decide whether an ObsID is worth fitting properly.
+Each model is folded through the ObsID's response (RMF x ARF) with matrix products, and chi-squared is minimised on the spectrum grouped by
+grouping.py/grppha with the Levenberg-Marquardt method (as XSpec's `method leven`). The same channels as in the XSpec session (models.py) are used:
+bad channels are ignored, and so are energies below 0.3 keV and above 10 keV.
+The results are written to param_tbl.dat, stat_tbl.dat and covar_tbl.dat, in the same format as the XSpec session, so read_output.py and analyse_output.py work as usual.
+They go to {DDIR}/{model}_quickfit/ rather than to the directory of the XSpec fit, {DDIR}/{model}/, so they are never taken for XSpec's: the
+results store, the fit cache and the XSpec plots only read the latter, and the lightcurve shows them as the model '{model}_quickfit'.
+
+Differences with XSpec to be aware of:
+    * Absorption (tbabs, ztbabs) uses the Morrison & McCammon (1983) cross-sections, i.e. XSpec's wabs, rather than tbabs with wilm abundances.
+      The column densities are therefore only approximately the same as XSpec's, and so are the other parameters: e.g. on the powlaw_tbabs
+      fit of 00032646038 in default_output, PhoIndex is 2.41 against XSpec's 2.29 (see tests/test_quickfit.py).
+    * Parameter bounds and the flux error are 1 sigma from the covariance matrix, not from `error` and `flux err`.
+"""
+
+
+from astropy.io import fits
+from dataclasses import dataclass
+import numpy as np
+import argparse
+import math
+import os
+
+import models
+import product_index
+import response
+import utils
+
+
+# Energies (keV) of the noticed channels, as `ignore **-0.3` and `ignore 10.0-**` in the XSpec session
+E_NOTICE = models.E_NOTICE
+
+# Band (keV) of the integral flux, as `flux 2 10 err` in the XSpec session
+FLUX_BAND = models.FLUX_BAND
+
+# Added to the model name for the directory of its quick-look fit, next to that of the XSpec fit
+OUTDIR_SUFFIX = "_quickfit"
+
+# Morrison & McCammon (1983) photoelectric cross-section: lower edge of each energy range (keV) and polynomial coefficients c0, c1, c2
+# sigma(E) = (c0 + c1 E + c2 E^2) E^-3 * 1e-24 cm^2 per hydrogen atom
+_MM83_EDGES = np.array([0.030, 0.100, 0.284, 0.400, 0.532, 0.707, 0.867, 1.303, 1.840, 2.471, 3.210, 4.038, 7.111, 8.331])
+_MM83_COEFFS = np.array([
+    [17.3, 608.1, -2150.],
+    [34.6, 267.9, -476.1],
+    [78.1, 18.8, 4.3],
+    [71.4, 66.8, -51.4],
+    [95.5, 145.8, -61.1],
+    [308.9, -380.6, 294.0],
+    [120.6, 169.3, -47.7],
+    [141.3, 146.8, -31.5],
+    [202.7, 104.7, -17.0],
+    [342.7, 18.7, 0.],
+    [352.2, 18.7, 0.],
+    [433.9, -2.4, 0.75],
+    [629.0, 30.9, 0.],
+    [701.2, 25.2, 0.],
+    ])
+
+
+def absorption(energy, nh):
+    """Photoelectric absorption exp(-nH sigma(E)) with nH in 10^22 atoms/cm^2. `nh` may be an array that broadcasts against `energy`."""
+    energy = np.asarray(energy, dtype=float)
+    i = np.clip(np.searchsorted(_MM83_EDGES, energy, side='right') - 1, 0, len(_MM83_EDGES) - 1)
+    c = _MM83_COEFFS[i]
+    # In units of 1e-22 cm^2, so that it multiplies nH in 10^22 atoms/cm^2
+    with np.errstate(over='ignore', divide='ignore'):
+        sigma = (c[..., 0] + c[..., 1] * energy + c[..., 2] * energy ** 2) / energy ** 3 * 1e-2
+        return np.exp(-nh * sigma)
+
+
+def _powlaw_tbabs(energy, p, nh_tbabs, redshift):
+    phoindex, norm = p[:, 0:1], p[:, 1:2]
+    return norm * energy ** -phoindex * absorption(energy, nh_tbabs)
+
+
+def _logpar_tbabs(energy, p, nh_tbabs, redshift):
+    # log base 10, as in XSpec's logpar
+    alpha, beta, pivot_e, norm = p[:, 0:1], p[:, 1:2], p[:, 2:3], p[:, 3:4]
+    x = energy / pivot_e
+    return norm * x ** -(alpha + beta * np.log10(x)) * absorption(energy, nh_tbabs)
+
+
+def _powlaw_ztbabs_tbabs(energy, p, nh_tbabs, redshift):
+    nh_z, phoindex, norm = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    return norm * energy ** -phoindex * absorption(energy, nh_tbabs) * absorption(energy * (1 + redshift), nh_z)
+
+
+@dataclass
+class QuickModel:
+    """Photon flux model (ph/cm^2/s/keV) and its parameters, named and ordered as in the param_tbl.dat written by the XSpec script"""
+    function: object
+    param_names: tuple
+    start: tuple
+    lower: tuple
+    upper: tuple
+    # Parameters fixed at their start value
+    frozen: tuple = ()
+    # Name of the count rate row in param_tbl.dat
+    rate_name: str = "countrate"
+
+
+QUICK_MODELS = {
+    "powlaw_tbabs": QuickModel(_powlaw_tbabs, ("PhoIndex", "norm"), (2., 1.), (-3., 0.), (10., 1e24)),
+    "logpar_tbabs": QuickModel(_logpar_tbabs, ("alpha", "beta", "pivotE", "norm"), (2., 0., 1., 1.), (0., -4., 0., 0.), (4., 4., 1e6, 1e24),
+                               frozen=("pivotE",)),
+    "powlaw_ztbabs_tbabs": QuickModel(_powlaw_ztbabs_tbabs, ("ztbabs_nh", "PhoIndex", "norm"), (0.1, 2., 1.), (0., -3., 0.), (1e5, 10., 1e24),
+                                      rate_name="cRate"),
+    }
+
+
+def _sibling(fn, ddir):
+    """Path of `fn` as written in a spectrum header; relative paths in headers are relative to where grppha was run, so fall back to `ddir`."""
+    return fn if os.path.exists(fn) else os.path.join(ddir, os.path.basename(fn))
+
+
+@dataclass
+class GroupedSpectrum:
+    """Background-subtracted, grouped spectrum restricted to the noticed groups"""
+    net_counts: np.ndarray
+    variance: np.ndarray
+    exposure: float
+    # Index of the first channel of each group, and which groups are noticed
+    group_starts: np.ndarray
+    noticed: np.ndarray
+
+
+def load_grouped_spectrum(fn_grp, e_min, e_max, e_notice=E_NOTICE):
+    """Read grouped spectrum `fn_grp` (GROUPING/QUALITY columns) and its background (BACKFILE).
+    A group is noticed if all of its channels are good and within `e_notice` keV."""
+
+    ddir = os.path.dirname(fn_grp)
+    with fits.open(fn_grp) as hdul:
+        spec = hdul["SPECTRUM"]
+        counts = np.array(spec.data["COUNTS"], dtype=float)
+        quality = np.array(spec.data["QUALITY"])
+        grouping = np.array(spec.data["GROUPING"])
+        exposure, backscal = spec.header["EXPOSURE"], spec.header["BACKSCAL"]
+        fn_bkg = _sibling(spec.header["BACKFILE"], ddir)
+    with fits.open(fn_bkg) as hdul:
+        bkg = hdul["SPECTRUM"]
+        bkg_counts = np.array(bkg.data["COUNTS"], dtype=float)
+        bkg_scale = (backscal * exposure) / (bkg.header["BACKSCAL"] * bkg.header["EXPOSURE"])
+
+    group_starts = np.flatnonzero(grouping == 1)
+    src = np.add.reduceat(counts, group_starts)
+    bkg = np.add.reduceat(bkg_counts, group_starts)
+    bad = np.add.reduceat((quality != 0).astype(int), group_starts) > 0
+    lo = e_min[group_starts]
+    hi = e_max[np.append(group_starts[1:], len(counts)) - 1]
+    noticed = ~bad & (lo >= e_notice[0]) & (hi <= e_notice[1])
+
+    return GroupedSpectrum(net_counts=(src - bkg_scale * bkg)[noticed], variance=(src + bkg_scale ** 2 * bkg)[noticed], exposure=exposure,
+                           group_starts=group_starts, noticed=noticed)
+
+
+def chi2_null_probability(chi_sq, dof):
+    """Probability of a chi-squared at least `chi_sq` for `dof` degrees of freedom: the regularised upper incomplete gamma function Q(dof/2, chi_sq/2)."""
+
+    a, x = dof / 2., chi_sq / 2.
+    if x <= 0:
+        return 1.
+    log_prefactor = -x + a * math.log(x) - math.lgamma(a)
+    if x < a + 1:
+        # Series for P(a, x)
+        term = total = 1. / a
+        n = a
+        while abs(term) > abs(total) * 1e-15:
+            n += 1
+            term *= x / n
+            total += term
+        return 1. - total * math.exp(log_prefactor)
+    # Continued fraction for Q(a, x) (modified Lentz)
+    tiny = 1e-300
+    b = x + 1. - a
+    c, d = 1. / tiny, 1. / b
+    h = d
+    for i in range(1, 1000):
+        an = -i * (i - a)
+        b += 2.
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1. / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.) < 1e-15:
+            break
+    return math.exp(log_prefactor) * h
+
+
+class QuickFitter:
+    """Fold and fit the models in QUICK_MODELS for one grouped spectrum.
+    The response is read from `cache` (a response.ResponseCache) if given, otherwise it is parsed from the RMF and ARF."""
+
+    def __init__(self, fn_grp, nh_tbabs, redshift, cache=None):
+        ddir = os.path.dirname(fn_grp)
+        with fits.open(fn_grp) as hdul:
+            header = hdul["SPECTRUM"].header
+            fn_rmf, fn_arf = _sibling(header["RESPFILE"], ddir), _sibling(header["ANCRFILE"], ddir)
+        resp = cache.load(fn_rmf, fn_arf) if cache is not None else response.read_response(fn_rmf, fn_arf)
+        self.spec = load_grouped_spectrum(fn_grp, resp.e_min, resp.e_max)
+        self.energy = 0.5 * (resp.energ_lo + resp.energ_hi)
+        self.de = resp.energ_hi - resp.energ_lo
+        # Response summed over the channels of each noticed group: shape (energy bins, noticed groups)
+        self.group_response = resp.group(self.spec.group_starts, self.spec.noticed) * self.spec.exposure
+        self.nh_tbabs, self.redshift = nh_tbabs, redshift
+
+    def folded_counts(self, model, p):
+        """Predicted counts in the noticed groups for parameter sets `p` of shape (number of sets, number of parameters)."""
+        with np.errstate(over='ignore', invalid='ignore'):
+            photons = np.nan_to_num(model.function(self.energy, p, self.nh_tbabs, self.redshift) * self.de)
+        return photons @ self.group_response
+
+    def chi_residuals(self, model, p):
+        return (self.spec.net_counts - self.folded_counts(model, p)) / np.sqrt(self.spec.variance)
+
+    def fit(self, model, max_iter=200, tol=1e-6):
+        """Minimise chi-squared with Levenberg-Marquardt. The Jacobian is computed by folding all perturbed parameter sets in one matrix product.
+
+        Returns
+        -------
+        p : numpy.ndarray
+            Best fit parameters
+        cov : numpy.ndarray
+            Covariance matrix of the free parameters
+        free : numpy.ndarray[bool]
+            Which parameters are free
+        chi_sq : float
+        """
+
+        p = np.array(model.start, dtype=float)
+        lower, upper = np.array(model.lower), np.array(model.upper)
+        free = np.array([name not in model.frozen for name in model.param_names])
+        i_free = np.flatnonzero(free)
+        # Start the normalisation close to the data, since XSpec's default of 1 is far off
+        i_norm = model.param_names.index("norm")
+        p[i_norm] *= self.spec.net_counts.sum() / self.folded_counts(model, p[None, :]).sum()
+
+        lam = 1e-3
+        r = self.chi_residuals(model, p[None, :])[0]
+        chi_sq = r @ r
+        for _ in range(max_iter):
+            h = 1e-6 * np.maximum(np.abs(p[i_free]), 1e-8)
+            trial = np.repeat(p[None, :], len(i_free), axis=0)
+            trial[np.arange(len(i_free)), i_free] += h
+            jac = ((self.chi_residuals(model, trial) - r) / h[:, None]).T
+            jtj, jtr = jac.T @ jac, jac.T @ r
+            while True:
+                step = np.linalg.solve(jtj + lam * np.diag(np.diag(jtj)), -jtr)
+                p_new = p.copy()
+                p_new[i_free] = np.clip(p[i_free] + step, lower[i_free], upper[i_free])
+                r_new = self.chi_residuals(model, p_new[None, :])[0]
+                chi_sq_new = r_new @ r_new
+                if chi_sq_new <= chi_sq or lam > 1e10:
+                    break
+                lam *= 10
+            converged = chi_sq - chi_sq_new < tol * max(chi_sq, 1.)
+            if chi_sq_new <= chi_sq:
+                p, r, chi_sq, lam = p_new, r_new, chi_sq_new, lam / 10
+            if converged:
+                break
+
+        # Covariance from the final Jacobian: (J^T J)^-1
+        h = 1e-6 * np.maximum(np.abs(p[i_free]), 1e-8)
+        trial = np.repeat(p[None, :], len(i_free), axis=0)
+        trial[np.arange(len(i_free)), i_free] += h
+        jac = ((self.chi_residuals(model, trial) - r) / h[:, None]).T
+        cov = np.linalg.pinv(jac.T @ jac)
+
+        return p, cov, free, chi_sq
+
+    def photon_flux(self, model, p, band=FLUX_BAND, n=1000):
+        """Integral photon flux (ph/cm^2/s) in `band` keV, for parameter sets `p` of shape (number of sets, number of parameters)."""
+        edges = np.geomspace(band[0], band[1], n + 1)
+        energy, de = 0.5 * (edges[1:] + edges[:-1]), np.diff(edges)
+        return model.function(energy, p, self.nh_tbabs, self.redshift) @ de
+
+
+def error_string(value, lower, upper, frozen=False):
+    """XSpec-style 9 character error string (see read_output.ERR_STR_DICT); only 'parameter was frozen' and 'hit hard lower/upper limit' are set."""
+    flags = ["F"] * 9
+    flags[3] = "T" if value <= lower else "F"
+    flags[4] = "T" if value >= upper else "F"
+    flags[5] = "T" if frozen else "F"
+    return "".join(flags)
+
+
+def quickfit_outdir(data_dir, model_name):
+    """Directory of the quick-look fit of `model_name`, {data_dir}/{model_name}_quickfit"""
+    return os.path.join(data_dir, f"{model_name}{OUTDIR_SUFFIX}")
+
+
+def quickfit(fn_grp, model_name, outdir, nh_tbabs, redshift, fitter=None, cache=None):
+    """Fit `model_name` to grouped spectrum `fn_grp` and write {outdir}/param_tbl.dat and {outdir}/stat_tbl.dat.
+    `fitter` (a QuickFitter for `fn_grp`) can be given to fit several models without reading the response again.
+    Otherwise the response is taken from `cache` (a response.ResponseCache), if given.
+
+    Returns
+    -------
+    fitter : QuickFitter
+    """
+
+    fitter = fitter or QuickFitter(fn_grp, nh_tbabs, redshift, cache)
+    model = QUICK_MODELS[model_name]
+    p, cov, free, chi_sq = fitter.fit(model)
+    sigma = np.zeros(len(p))
+    sigma[free] = np.sqrt(np.diag(cov))
+
+    # Flux error from the covariance, propagating the gradient of the flux
+    i_free = np.flatnonzero(free)
+    h = 1e-6 * np.maximum(np.abs(p[i_free]), 1e-8)
+    trial = np.repeat(p[None, :], len(i_free) + 1, axis=0)
+    trial[np.arange(1, len(i_free) + 1), i_free] += h
+    fluxes = fitter.photon_flux(model, trial)
+    grad = (fluxes[1:] - fluxes[0]) / h
+    flux, flux_err = fluxes[0], np.sqrt(grad @ cov @ grad)
+
+    rate = fitter.spec.net_counts.sum() / fitter.spec.exposure
+    rate_err = np.sqrt(fitter.spec.variance.sum()) / fitter.spec.exposure
+    dof = len(fitter.spec.net_counts) - len(i_free)
+
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, "param_tbl.dat"), 'w') as f:
+        f.write("name param param_low param_high error_string\n")
+        for name, value, err, is_free, lo, hi in zip(model.param_names, p, sigma, free, model.lower, model.upper):
+            if is_free:
+                # Bounds do not go past the hard limits, as in XSpec
+                f.write(f"{name} {value:.10g} {max(value - err, lo):.10g} {min(value + err, hi):.10g} {error_string(value, lo, hi)}\n")
+            else:
+                # As the XSpec session does for the frozen pivotE
+                f.write(f"{name} {value:.10g} 0 0 0\n")
+        f.write(f"flux {flux:.10g} {flux - flux_err:.10g} {flux + flux_err:.10g} 0\n")
+        f.write(f"{model.rate_name} {rate:.10g} {rate - rate_err:.10g} {rate + rate_err:.10g} 0\n")
+    with open(os.path.join(outdir, "stat_tbl.dat"), 'w') as f:
+        f.write("chi_squared deg_freedom null_hyp_probability\n")
+        f.write(f"{chi_sq:.10g} {dof} {chi2_null_probability(chi_sq, dof):.10g}\n")
+    # As the XSpec session writes it: names of the free parameters, then the lower triangle of their covariance matrix
+    with open(os.path.join(outdir, "covar_tbl.dat"), 'w') as f:
+        f.write(" ".join(name for name, is_free in zip(model.param_names, free) if is_free) + "\n")
+        f.write(" ".join(f"{c:.10g}" for c in cov[np.tril_indices(len(i_free))]) + "\n")
+
+    return fitter
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Quick-look fits of every ObsID without XSpec.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--models", nargs="+", default=list(QUICK_MODELS), help="Models to fit")
+    parser.add_argument(
+        "--clobber", action="store_true", help="Overwrite the tables of earlier quick-look fits")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    variables = utils.read_cfg(cfg_filename)
+    modes = variables["MODES"]
+    if isinstance(modes, str):
+        modes = [modes]
+    nh_tbabs, redshift = float(variables["NH_TBABS"]), float(variables["REDSHIFT"])
+    cache = response.ResponseCache.for_base_data_dir(base_data_dir, variables.get("RESPONSE_CACHE_DIR") or None)
+
+    products = product_index.load(base_data_dir, oids)
+    for oid, mode in zip(oids, modes):
+        # This is expected to be a one element list
+        fn_grp = products.glob(oid, spec_stem, None, f"Obs_{oid}{mode}_chi2_grp.pi")
+        if len(fn_grp) != 1:
+            print(f"Expected one grouped spectrum for ObsID {oid} but found {fn_grp}. Skipping")
+            continue
+        fitter = None
+        for model_name in args.models:
+            outdir = quickfit_outdir(os.path.dirname(fn_grp[0]), model_name)
+            if os.path.exists(os.path.join(outdir, "param_tbl.dat")) and not args.clobber:
+                print(f"{outdir}/param_tbl.dat exists. Skipping (use --clobber to overwrite)")
+                continue
+            fitter = quickfit(fn_grp[0], model_name, outdir, nh_tbabs, redshift, fitter=fitter, cache=cache)
+            print(f"Wrote {outdir}/param_tbl.dat and {outdir}/stat_tbl.dat")
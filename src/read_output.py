@@ -7,12 +7,45 @@ If no changes were made to the XSpec bash scripts, they were saved with basename
 """
 
 
-from astropy.table import Table
 from dataclasses import dataclass
+import sqlite3
 import sys
 import os
 import numpy as np
 
+import models
+import product_index
+
+
+# Columns of spec_default_bin.dat and spec_binned.dat, in order (no header is written)
+SPEC_COLUMNS = ("energy", "energy_half_bin_width", "eflux", "eflux_err", "mdl_eflux")
+
+# Chi-squared on a grid of two parameters, written next to param_tbl.dat by contours.py; formatted with the names of the two parameters
+CONTOUR_TBL = "contour_{}_{}.npz"
+
+# Columns of param_tbl.dat. The error string is '0' for rows that are not model parameters (flux, count rate)
+PARAM_DTYPE = np.dtype([("name", "U32"), ("param", "f8"), ("param_low", "f8"), ("param_high", "f8"), ("error_string", "U16")])
+
+# These error messages are directly from the XSpec Users’ Guide for version 12.12.1: Section 5.3.12 tclout
+ERR_STR_DICT = {
+                0: "new minimum found",
+                1: "non-monotonicity detected",
+                2:" minimization may have run into problem",
+                3:"hit hard lower limit",
+                4:"hit hard upper limit",
+                5: "parameter was frozen",
+                6: "search failed in -ve direction",
+                7: "search failed in +ve direction",
+                8: "reduced chi-squared too high",
+                }
+
+# Error bitmasks: bit i is set if character i of the error string is 'T', i.e. if the error ERR_STR_DICT[i] occurred
+ERR_NONE = 0
+ERR_HARD_LIMIT = 1 << 3 | 1 << 4
+ERR_SEARCH_FAILED = 1 << 6 | 1 << 7
+# Any of the errors; a fit with none of them succeeded
+ERR_ANY = (1 << len(ERR_STR_DICT)) - 1
+
 
 def read_tcloutr_spec_data(fn_sed):
     """Read data file `fn_sed` created by user in XSpec **using `tcloutr`** (not `wd`). This plot has an implicit header.
@@ -49,17 +82,68 @@ def read_tcloutr_spec_data(fn_sed):
         Energy flux in keV/cm^2/s from model e.g. logpar*tbabs
     """
 
-    t = Table.read(fn_sed, format='ascii.no_header')
-    # In keV
-    energy = t[t.colnames[0]].data
-    energy_half_bin_width = t[t.colnames[1]].data
-    # This is an energy flux (in keV/cm^2/s) if `eeufspec` was used to write this file
-    eflux = t[t.colnames[2]].data
-    eflux_err = t[t.colnames[3]].data
-    mdl_eflux = t[t.colnames[4]].data
+    # One row per column: energy (keV), half bin width (keV), energy flux (keV/cm^2/s if `eeufspec` was used to write this file), its error, model
+    energy, energy_half_bin_width, eflux, eflux_err, mdl_eflux = np.ascontiguousarray(_read_spec_array(fn_sed).T)
 
     return energy, energy_half_bin_width, eflux, eflux_err, mdl_eflux
-    
+
+
+def _split_tokens(fn):
+    with open(fn, 'rb') as f:
+        return f.read().split()
+
+
+def _read_spec_array(fn_sed):
+    """Spectral points in `fn_sed` as an array of shape (number of points, 5). The file is split on whitespace and converted in one go,
+    which is much faster than astropy's format guessing."""
+    return np.array(_split_tokens(fn_sed), dtype=float).reshape(-1, len(SPEC_COLUMNS))
+
+
+def read_spec_data_bulk(fns_sed):
+    """Read every spectral point table in `fns_sed` (e.g. all spec_default_bin.dat of one model) into one array.
+    The tokens of all files are converted to floats in a single call.
+
+    Returns
+    -------
+    data : numpy.ndarray
+        Shape (total number of points, 5); the columns are as returned by `read_tcloutr_spec_data()`
+    offsets : numpy.ndarray[int]
+        The points of fns_sed[i] are rows offsets[i] to offsets[i+1] of `data`
+    """
+
+    tokens = [_split_tokens(fn) for fn in fns_sed]
+    offsets = np.concatenate([[0], np.cumsum([len(t) // len(SPEC_COLUMNS) for t in tokens], dtype=int)])
+    data = np.array([tok for t in tokens for tok in t], dtype=float).reshape(-1, len(SPEC_COLUMNS))
+
+    return data, offsets
+
+
+def load_model_spectra(base_data_dir, model, spec_stem="spec", fn_sed="spec_default_bin.dat", products=None):
+    """`read_spec_data_bulk()` of every {base_data_dir}/{OID}/USERPROD*/{spec_stem}/{model}/`fn_sed`, as found in `products`
+    (a product_index.ProductIndex); by default, the index cached in `base_data_dir`.
+
+    Returns
+    -------
+    oids : numpy.ndarray[str]
+    offsets : numpy.ndarray[int]
+        The points of oids[i] are elements offsets[i] to offsets[i+1] of each column
+    energy, energy_half_bin_width, eflux, eflux_err, mdl_eflux : numpy.ndarray[float]
+        As in `read_tcloutr_spec_data()`
+    """
+
+    if products is None:
+        products = product_index.load(base_data_dir)
+    fns = products.glob("*", spec_stem, model, fn_sed)
+    oids = np.array([os.path.relpath(fn, base_data_dir).split(os.sep)[0] for fn in fns], dtype=str)
+    data, offsets = read_spec_data_bulk(fns)
+
+    return (oids, offsets, *np.ascontiguousarray(data.T))
+
+
+def read_param_array(fn_param):
+    """param_tbl.dat `fn_param` as a structured array with dtype PARAM_DTYPE, one element per row."""
+    return np.loadtxt(fn_param, dtype=PARAM_DTYPE, skiprows=1, ndmin=1)
+
 
 def read_param_tbl(fn_param):
     """Read parameter table param_tbl.dat.
@@ -83,16 +167,37 @@ def read_param_tbl(fn_param):
         Error strings reported by XSpec; one error string per parameter 
     """
 
-    t = Table.read(fn_param, format='ascii')
-    param_names = t[t.colnames[0]].data
-    params = t[t.colnames[1]].data
-    params_low = t[t.colnames[2]].data
-    params_high = t[t.colnames[3]].data
-    err_str = t[t.colnames[4]].data
+    t = read_param_array(fn_param)
+    param_names = t["name"]
+    params = t["param"]
+    params_low = t["param_low"]
+    params_high = t["param_high"]
+    err_str = t["error_string"]
 
     return param_names, params, params_low, params_high, err_str
 
 
+def error_bitmasks(err_strs):
+    """Error bitmask (see ERR_STR_DICT) of each error string in `err_strs`, all at once.
+    The placeholder '0' of the rows that are not model parameters has no error.
+
+    Returns
+    -------
+    masks : numpy.ndarray[int]
+        One bitmask per error string
+    """
+
+    # One row of character codes per error string; shorter strings (e.g. '0') are padded with NUL
+    codes = np.ascontiguousarray(err_strs, dtype=f"U{len(ERR_STR_DICT)}").reshape(-1)
+    is_true = codes.view(np.uint32).reshape(-1, len(ERR_STR_DICT)) == ord("T")
+    return is_true.astype(np.int64) @ (1 << np.arange(len(ERR_STR_DICT), dtype=np.int64))
+
+
+def error_messages(mask):
+    """Messages in ERR_STR_DICT of the errors in bitmask `mask`"""
+    return [msg for i, msg in ERR_STR_DICT.items() if int(mask) >> i & 1]
+
+
 def read_stat_tbl(fn_stats):
     """Read statistics table stat_tbl.dat.
     The explicit header is: chi_squared deg_freedom null_hyp_probability
@@ -112,16 +217,76 @@ def read_stat_tbl(fn_stats):
         Null hypothesis probability
     """
 
-    t = Table.read(fn_stats, format='ascii')
-    # First column: chi-sq. Get the 0th element, which is the only element. There is one row of data.
-    chi_sq = t[0][0]
-    # Second column: dof. Get the 0th element, which is the only element. There is one row of data.
-    dof = t[0][1]
-    null_hyp_probability = t[0][2]
+    # The header is followed by one row of data
+    chi_sq, dof, null_hyp_probability = np.array(_split_tokens(fn_stats)[3:6], dtype=float)
+    # Integer, as written by XSpec
+    dof = np.int64(dof) if dof.is_integer() else dof
 
     return chi_sq, dof, null_hyp_probability
 
 
+def read_resid_tbl(fn_resid):
+    """Read the residuals with the default binning, resid_tbl.dat, written from `tcloutr plot res` (no header is written).
+
+    Returns
+    -------
+    energy, energy_half_bin_width : np.ndarray
+        Energy and half bin width (keV)
+    resid, resid_err : np.ndarray
+        Data minus model, and its error (counts/s/keV)
+    """
+
+    energy, energy_half_bin_width, resid, resid_err = np.ascontiguousarray(np.array(_split_tokens(fn_resid), dtype=float).reshape(-1, 4).T)
+
+    return energy, energy_half_bin_width, resid, resid_err
+
+
+def read_contour(fn_contour):
+    """Read contour_{param 1}_{param 2}.npz, written by contours.py
+
+    Returns
+    -------
+    x, y : np.ndarray
+        Values of the first and second parameter in the grid
+    stat : np.ndarray
+        Chi-squared at every grid point, shape (len(x), len(y)); NaN where it could not be computed
+    best : np.ndarray
+        Best fit of the two parameters
+    stat_best : float
+        Chi-squared of the best fit
+    """
+
+    with np.load(fn_contour) as f:
+        return f["x"], f["y"], f["stat"], f["best"], float(f["stat_best"])
+
+
+def read_covar_tbl(fn_covar):
+    """Read covariance table covar_tbl.dat: the names of the free parameters on the first line, then their covariance matrix,
+    either its lower triangle row by row (as XSpec's `tclout covariance` gives it) or in full.
+
+    Returns
+    -------
+    names : list[str]
+        Free parameters, in the order of the rows of `covar`
+    covar : np.ndarray
+        Covariance matrix, of shape (number of free parameters, number of free parameters)
+    """
+
+    with open(fn_covar, 'r') as f:
+        names = f.readline().split()
+        values = np.array(f.read().split(), dtype=float)
+    n = len(names)
+    if len(values) == n * n:
+        return names, values.reshape(n, n)
+    if len(values) != n * (n + 1) // 2:
+        raise ValueError(f"{fn_covar} has {len(values)} values, which is not a covariance matrix of {n} parameters")
+    covar = np.zeros((n, n))
+    covar[np.tril_indices(n)] = values
+    covar = covar + np.tril(covar, -1).T
+
+    return names, covar
+
+
 def get_integral_phflux(fn_param):
     """Integral flux(2-10 keV) in units of ph/cm^2/s
     
@@ -136,10 +301,10 @@ def get_integral_phflux(fn_param):
     """
     # TODO ? add energy flux in erg/cm^2/s to the xspec bash script and then read it here
     param_names, params, params_low, params_high, _ = read_param_tbl(fn_param)
-    # Index for flux
-    i = -2
-    if param_names[i] != "flux":
-        sys.exit("Edit...") # TODO elaborate
+    # Row of the flux, after the model parameters
+    if "flux" not in param_names:
+        sys.exit(f"There is no flux in {fn_param}")
+    i = list(param_names).index("flux")
     flux, flux_low, flux_high = params[i], params_low[i], params_high[i]
     flux_errn = flux - flux_low
     flux_errp = flux_high - flux
@@ -158,17 +323,11 @@ def get_model_parameters(fn_param):
     # Reformat data in a more helpful way (?)
     data = {}
 
-    if model == 'powlaw_tbabs':
-        cls = PowlawTbabs
-    elif model == 'logpar_tbabs':
-        cls = LogparTbabs
-    elif model == 'powlaw_ztbabs_tbabs':
-        cls = PowlawZtbabsTbabs
-    else:
+    if model not in models.REGISTRY:
         sys.exit(f"Unrecognized model {model}")
         # TODO add logger with function name etc
 
-    param_names_index = cls().param_names_index
+    param_names_index = models.REGISTRY[model].param_names_index
     # Names is the key, corresponding index is the value
     for i in list(param_names_index.values()):
         pname = list(param_names_index.keys())[i]
@@ -179,37 +338,121 @@ def get_model_parameters(fn_param):
         p_errp = p_high - p
     
         data[pname] = [p, p_errn, p_errp]
-    # Create table to index a bit more easily
+    # Create table to index a bit more easily. astropy.table is slow to import, and only this function needs it
+    from astropy.table import Table
     t = Table(data)
     
     return t
 
 
+# Bulk queries of the results store written by results_store.py ({BASE_DATA_DIR}/_results.sqlite).
+# Each returns one column per quantity, across all ObsIDs, from a single query.
+
+def query_params(fn_store, model, pname):
+    """Parameter `pname` (e.g. 'PhoIndex', 'flux', 'countrate') of `model` for every ObsID in the results store `fn_store`.
+
+    Returns
+    -------
+    oids : numpy.ndarray[str]
+    params, params_low, params_high : numpy.ndarray[float]
+        Best fit value, lower and upper bounds
+    err_strs : numpy.ndarray[str]
+        Error strings reported by XSpec
+    """
+    with sqlite3.connect(fn_store) as con:
+        rows = con.execute("SELECT oid, value, low, high, error_string FROM params WHERE model=? AND name=? ORDER BY oid",
+                           (model, pname)).fetchall()
+    oids, params, params_low, params_high, err_strs = zip(*rows) if rows else ((),) * 5
+    return np.array(oids, dtype=str), np.array(params, dtype=float), np.array(params_low, dtype=float), \
+        np.array(params_high, dtype=float), np.array(err_strs, dtype=str)
+
+
+def query_error_masks(fn_store, model):
+    """Error bitmask of every fit of `model` in the results store `fn_store`: the errors of any of its parameters (see ERR_STR_DICT).
+    E.g. the ObsIDs where a parameter hit a hard limit are `oids[masks & ERR_HARD_LIMIT != 0]`.
+
+    Returns
+    -------
+    oids : numpy.ndarray[str]
+    masks : numpy.ndarray[int]
+    """
+    with sqlite3.connect(fn_store) as con:
+        rows = con.execute("SELECT oid, err_mask FROM fits WHERE model=? ORDER BY oid", (model,)).fetchall()
+    oids, masks = zip(*rows) if rows else ((),) * 2
+    return np.array(oids, dtype=str), np.array(masks, dtype=np.int64)
+
+
+def query_failed_fits(fn_store, mask=ERR_ANY, model=None):
+    """Fits in the results store `fn_store` where any parameter has one of the errors in bitmask `mask`
+    (e.g. ERR_HARD_LIMIT: a parameter hit a hard limit), for `model` or for every model.
+
+    Returns
+    -------
+    oids, model_names : numpy.ndarray[str]
+    masks : numpy.ndarray[int]
+        All the errors of each fit
+    """
+    query = "SELECT oid, model, err_mask FROM fits WHERE err_mask & ? != 0"
+    query_args = [int(mask)]
+    if model is not None:
+        query += " AND model=?"
+        query_args.append(model)
+    with sqlite3.connect(fn_store) as con:
+        rows = con.execute(query + " ORDER BY oid, model", query_args).fetchall()
+    oids, model_names, masks = zip(*rows) if rows else ((),) * 3
+    return np.array(oids, dtype=str), np.array(model_names, dtype=str), np.array(masks, dtype=np.int64)
+
+
+def query_stats(fn_store, model):
+    """Fit statistics of `model` for every ObsID in the results store `fn_store`.
+
+    Returns
+    -------
+    oids : numpy.ndarray[str]
+    chi_sq, dof, null_hyp_probability : numpy.ndarray
+        As in `read_stat_tbl()`, one element per ObsID
+    """
+    with sqlite3.connect(fn_store) as con:
+        rows = con.execute("SELECT oid, chi_sq, dof, null_hyp_probability FROM fits WHERE model=? ORDER BY oid", (model,)).fetchall()
+    oids, chi_sq, dof, null_hyp_probability = zip(*rows) if rows else ((),) * 4
+    return np.array(oids, dtype=str), np.array(chi_sq, dtype=float), np.array(dof, dtype=int), np.array(null_hyp_probability, dtype=float)
+
+
+def query_spectra(fn_store, model, binning="default"):
+    """Spectral points of `model` for every ObsID in the results store `fn_store`, concatenated.
+    `binning` is 'default' (spec_default_bin.dat) or 'binned' (spec_binned.dat).
+
+    Returns
+    -------
+    oids : numpy.ndarray[str]
+    offsets : numpy.ndarray[int]
+        The points of oids[i] are elements offsets[i] to offsets[i+1] of each column
+    energy, energy_half_bin_width, eflux, eflux_err, mdl_eflux : numpy.ndarray[float]
+        As in `read_tcloutr_spec_data()`
+    """
+    with sqlite3.connect(fn_store) as con:
+        rows = con.execute("SELECT oid, n, energy, energy_half_bin_width, eflux, eflux_err, mdl_eflux FROM spectra "
+                           "WHERE model=? AND binning=? ORDER BY oid", (model, binning)).fetchall()
+    oids = np.array([r[0] for r in rows], dtype=str)
+    offsets = np.concatenate([[0], np.cumsum([r[1] for r in rows], dtype=int)])
+    cols = [np.frombuffer(b"".join(r[i] for r in rows), dtype='<f8') for i in range(2, 7)]
+    return (oids, offsets, *cols)
+
+
+# Parameters of each model in models.REGISTRY
 @dataclass
 class PowlawTbabs:
-    """Store parameters from powlaw_tbabs.sh"""
-    param_names_index = {
-        "PhoIndex": 0,
-        "norm" : 1
-        }
+    """Store parameters from the powlaw_tbabs fit"""
+    param_names_index = models.REGISTRY["powlaw_tbabs"].param_names_index
 
 
 @dataclass
 class PowlawZtbabsTbabs:
-    """Store parameters from powlaw_ztbabs_tbabs.sh"""
-    param_names_index = {
-                "ztbabs_nh" : 0,
-                "PhoIndex": 1,
-                "norm": 2,
-                }
+    """Store parameters from the powlaw_ztbabs_tbabs fit"""
+    param_names_index = models.REGISTRY["powlaw_ztbabs_tbabs"].param_names_index
 
 
 @dataclass
 class LogparTbabs:
-    """Store parameters from logpar_tbabs.sh"""
-    param_names = {
-                "alpha": 0, 
-                "beta": 1, 
-                "pivotE": 2, 
-                "norm": 3
-                }
+    """Store parameters from the logpar_tbabs fit"""
+    param_names_index = models.REGISTRY["logpar_tbabs"].param_names_index
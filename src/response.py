@@ -0,0 +1,252 @@
+"""
+Effective response (RMF x ARF) of a spectrum as a sparse CSR matrix: one row per energy bin, one column per channel, and only the non-zero
+elements stored. Parsing the variable length MATRIX/F_CHAN/N_CHAN rows of an RMF is done once per distinct RMF+ARF pair: the CSR arrays are
+saved to an uncompressed {sha256}.npz in a cache directory, keyed by the sha256 of the contents of the RMF and ARF, so ObsIDs (and targets,
+if they share RESPONSE_CACHE_DIR) with identical responses share one file.
+Cached responses are memory mapped rather than read, so loading is zero-copy and processes using the same response share its pages.
+"""
+
+
+from astropy.io import fits
+from dataclasses import dataclass
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+import threading
+import zipfile
+
+import product_index
+import utils
+
+
+CACHE_DIRNAME = "_response_cache"
+
+# Index of the sha256 of each RMF and ARF, keyed by path and modification time, so files are only hashed again if they changed
+HASH_INDEX_FN = "_hashes.json"
+
+# Arrays saved in each cache file
+_FIELDS = ("energ_lo", "energ_hi", "e_min", "e_max", "indptr", "indices", "data")
+
+
+@dataclass
+class Response:
+    """Effective response in CSR form. Row i holds the effective area (cm^2) times the probability that a photon in energy bin i
+    (energ_lo[i] to energ_hi[i] keV) is detected in channel indices[indptr[i]:indptr[i+1]], i.e. data[indptr[i]:indptr[i+1]].
+    Channel indices start at 0 for the first channel of EBOUNDS, whatever the first channel number is."""
+    energ_lo: np.ndarray
+    energ_hi: np.ndarray
+    e_min: np.ndarray
+    e_max: np.ndarray
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+
+    @property
+    def shape(self):
+        return len(self.energ_lo), len(self.e_min)
+
+    def row_index(self):
+        """Energy bin of each stored element"""
+        return np.repeat(np.arange(len(self.energ_lo)), np.diff(self.indptr))
+
+    def fold(self, photons):
+        """Counts/s in each channel for `photons`, the photon flux (ph/cm^2/s) in each energy bin, of shape (number of energy bins,)
+        or (number of sets, number of energy bins)."""
+        photons = np.atleast_2d(photons)
+        n_sets, n_chan = len(photons), self.shape[1]
+        weights = (photons[:, self.row_index()] * self.data).ravel()
+        # One bincount for all sets: set k uses bins k * n_chan to (k + 1) * n_chan - 1
+        bins = (np.arange(n_sets)[:, None] * n_chan + self.indices).ravel()
+        return np.bincount(bins, weights=weights, minlength=n_sets * n_chan).reshape(n_sets, n_chan)
+
+    def group(self, group_starts, noticed=None):
+        """Dense response summed over the channels of each group, shape (number of energy bins, number of groups).
+        `group_starts` is the index of the first channel of each group; `noticed` (boolean or integer index) selects groups."""
+        n_energ = self.shape[0]
+        n_grp = len(group_starts)
+        group_of_channel = np.repeat(np.arange(n_grp), np.diff(np.append(group_starts, self.shape[1])))
+        # Channels before the first group are not in any group
+        in_group = self.indices >= group_starts[0]
+        rows, grps = self.row_index()[in_group], group_of_channel[self.indices[in_group] - group_starts[0]]
+        dense = np.bincount(rows * n_grp + grps, weights=self.data[in_group], minlength=n_energ * n_grp).reshape(n_energ, n_grp)
+        return dense if noticed is None else dense[:, noticed]
+
+    def todense(self):
+        return self.group(np.arange(self.shape[1]))
+
+
+def read_response(fn_rmf, fn_arf=None):
+    """Parse RMF `fn_rmf` into a `Response`, multiplied by the effective area in ARF `fn_arf` (if not None)."""
+
+    with fits.open(fn_rmf) as rmf:
+        matrix_ext = rmf["MATRIX"] if "MATRIX" in rmf else rmf["SPECRESP MATRIX"]
+        d = matrix_ext.data
+        # First channel number, usually 0 or 1
+        col = matrix_ext.columns.names.index("F_CHAN") + 1
+        tlmin = matrix_ext.header.get(f"TLMIN{col}", 0)
+        ebounds = rmf["EBOUNDS"].data
+        e_min, e_max = np.array(ebounds["E_MIN"], dtype=float), np.array(ebounds["E_MAX"], dtype=float)
+        energ_lo, energ_hi = np.array(d["ENERG_LO"], dtype=float), np.array(d["ENERG_HI"], dtype=float)
+
+        # Elements of each row are the concatenation of N_GRP runs of channels, run j starting at F_CHAN[j] and N_CHAN[j] long
+        indices, data, row_lengths = [], [], np.zeros(len(d), dtype=np.int64)
+        for i, (n_grp, f_chan, n_chan, row) in enumerate(zip(d["N_GRP"], d["F_CHAN"], d["N_CHAN"], d["MATRIX"])):
+            f_chan, n_chan, row = np.atleast_1d(f_chan)[:n_grp], np.atleast_1d(n_chan)[:n_grp], np.atleast_1d(row)
+            n_total = int(n_chan.sum())
+            # Channel of every element: F_CHAN of its run plus its position within the run
+            run_starts = np.repeat(np.cumsum(n_chan) - n_chan, n_chan)
+            indices.append(np.repeat(f_chan - tlmin, n_chan) + np.arange(n_total) - run_starts)
+            data.append(row[:n_total])
+            row_lengths[i] = n_total
+
+    indices = np.concatenate(indices).astype(np.int32) if indices else np.zeros(0, dtype=np.int32)
+    data = np.concatenate(data).astype(float) if data else np.zeros(0)
+    row_index = np.repeat(np.arange(len(d)), row_lengths)
+
+    if fn_arf is not None:
+        with fits.open(fn_arf) as arf:
+            data *= np.array(arf["SPECRESP"].data["SPECRESP"], dtype=float)[row_index]
+
+    # Zeros are not worth storing
+    nonzero = data != 0
+    indptr = np.zeros(len(d) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(row_index[nonzero], minlength=len(d)))
+
+    return Response(energ_lo, energ_hi, e_min, e_max, indptr, indices[nonzero], data[nonzero])
+
+
+def _stat_key(fn):
+    st = os.stat(fn)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _mmap_npz(fn):
+    """Memory map every array in uncompressed .npz file `fn`. np.load(mmap_mode='r') only does this for .npy files,
+    so the offset of each member's data in the zip file is found from its local header."""
+
+    arrays = {}
+    with zipfile.ZipFile(fn) as zf, open(fn, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{fn} is compressed; it can not be memory mapped")
+            # Local file header: 30 bytes, then the file name and extra field, whose lengths are at bytes 26 and 28
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            arrays[os.path.splitext(info.filename)[0]] = np.memmap(f, dtype=dtype, mode='r', shape=shape, offset=f.tell(),
+                                                                   order='F' if fortran_order else 'C')
+    return arrays
+
+
+class ResponseCache:
+    """Responses saved in `cache_dir` as {sha256}.npz, where the sha256 is of the RMF followed by the ARF."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._hash_index_fn = os.path.join(cache_dir, HASH_INDEX_FN)
+        self._hashes = {}
+        if os.path.exists(self._hash_index_fn):
+            with open(self._hash_index_fn, 'r') as f:
+                self._hashes = json.load(f)
+        self._lock = threading.Lock()
+        # Responses already mapped by this process
+        self._loaded = {}
+
+    @classmethod
+    def for_base_data_dir(cls, base_data_dir, cache_dir=None):
+        """Cache in `cache_dir` if given (e.g. RESPONSE_CACHE_DIR, to share it between targets), otherwise in {base_data_dir}/_response_cache"""
+        return cls(cache_dir or os.path.join(base_data_dir, CACHE_DIRNAME))
+
+    def _file_hash(self, fn):
+        key = os.path.abspath(fn)
+        stat = _stat_key(key)
+        entry = self._hashes.get(key)
+        if entry is not None and entry["stat"] == stat:
+            return entry["sha256"]
+        h = hashlib.sha256()
+        with open(key, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        with self._lock:
+            self._hashes[key] = {"stat": stat, "sha256": h.hexdigest()}
+            tmp = f"{self._hash_index_fn}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self._hashes, f)
+            os.replace(tmp, self._hash_index_fn)
+        return h.hexdigest()
+
+    def key(self, fn_rmf, fn_arf=None):
+        """Content hash of the RMF and ARF pair"""
+        h = hashlib.sha256(self._file_hash(fn_rmf).encode())
+        if fn_arf is not None:
+            h.update(self._file_hash(fn_arf).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def load(self, fn_rmf, fn_arf=None):
+        """`Response` of `fn_rmf` times `fn_arf`, parsed and saved to the cache if it is not there yet."""
+
+        key = self.key(fn_rmf, fn_arf)
+        if key in self._loaded:
+            return self._loaded[key]
+        fn = self.path(key)
+        if not os.path.exists(fn):
+            resp = read_response(fn_rmf, fn_arf)
+            # Written under a temporary name first, so other processes never map a partial file
+            tmp = f"{fn}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                np.savez(f, **{name: getattr(resp, name) for name in _FIELDS})
+            os.replace(tmp, fn)
+        resp = Response(**_mmap_npz(fn))
+        self._loaded[key] = resp
+        return resp
+
+
+def build_cache(base_data_dir, oids, modes, spec_stem, cache_dir=None):
+    """Add the response of every ObsID in `oids` (observed in the corresponding mode in `modes`) to the cache.
+
+    Returns
+    -------
+    keys : dict
+        ObsID is the key, cache key of its response is the value
+    """
+
+    cache = ResponseCache.for_base_data_dir(base_data_dir, cache_dir)
+    keys = {}
+    products = product_index.load(base_data_dir, oids)
+    for oid, mode in zip(oids, modes):
+        ddirs = products.data_dirs(oid, spec_stem)
+        if len(ddirs) != 1:
+            print(f"Expected one USERPROD*/{spec_stem} directory for ObsID {oid} but found {ddirs}. Skipping")
+            continue
+        fn_rmf, fn_arf = (os.path.join(ddirs[0], f"Obs_{oid}{mode}.{ext}") for ext in ("rmf", "arf"))
+        cache.load(fn_rmf, fn_arf)
+        keys[oid] = cache.key(fn_rmf, fn_arf)
+    return keys
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Adds the response of every ObsID to the response cache.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    variables = utils.read_cfg(cfg_filename)
+    modes = variables["MODES"]
+    if isinstance(modes, str):
+        modes = [modes]
+
+    keys = build_cache(base_data_dir, oids, modes, spec_stem, variables.get("RESPONSE_CACHE_DIR") or None)
+    print(f"{len(keys)} ObsIDs share {len(set(keys.values()))} distinct response(s)")
@@ -0,0 +1,159 @@
+"""
+Consolidated store of the fit results, {BASE_DATA_DIR}/_results.sqlite, indexed by (ObsID, model).
+It holds what the XSpec fits write to {DDIR}/{model}/: the parameters with their bounds and error strings (param_tbl.dat),
+the fit statistics (stat_tbl.dat), and the spectral points (spec_default_bin.dat, spec_binned.dat) stored as one array per column.
+The error strings are also stored decoded, as error bitmasks (see read_output.error_bitmasks()): one per parameter, and one per fit
+with the errors of all its parameters, so that failed fits can be selected with one query (read_output.query_failed_fits()).
+fit_scheduler.py adds each ObsID as its fits finish; `python results_store.py` adds every fit already on disk.
+See read_output.py for the bulk queries, which read a column across all ObsIDs in one query.
+
+SQLite comes with Python, so this needs no extra dependency.
+"""
+
+
+import numpy as np
+import argparse
+import os
+import sqlite3
+
+import models
+import product_index
+import read_output
+import utils
+
+
+STORE_FN = "_results.sqlite"
+
+# Spectral point tables: binning name in the store is the key, file written by the fit is the value
+SPEC_TBLS = {"default": "spec_default_bin.dat", "binned": "spec_binned.dat"}
+
+# Columns of the spectral point tables, see read_output.read_tcloutr_spec_data()
+SPEC_COLUMNS = read_output.SPEC_COLUMNS
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS fits (
+    oid TEXT, model TEXT, mtime_ns INTEGER,
+    chi_sq REAL, dof INTEGER, null_hyp_probability REAL, err_mask INTEGER,
+    PRIMARY KEY (oid, model));
+CREATE TABLE IF NOT EXISTS params (
+    oid TEXT, model TEXT, name TEXT, row INTEGER,
+    value REAL, low REAL, high REAL, error_string TEXT, err_mask INTEGER,
+    PRIMARY KEY (oid, model, name));
+CREATE TABLE IF NOT EXISTS spectra (
+    oid TEXT, model TEXT, binning TEXT, n INTEGER,
+    {", ".join(f"{c} BLOB" for c in SPEC_COLUMNS)},
+    PRIMARY KEY (oid, model, binning));
+CREATE INDEX IF NOT EXISTS params_by_name ON params (model, name);
+"""
+
+
+def store_fn(base_data_dir):
+    return os.path.join(base_data_dir, STORE_FN)
+
+
+def connect(fn):
+    """Open (and create, if needed) the store `fn`."""
+    con = sqlite3.connect(fn)
+    con.executescript(_SCHEMA)
+    _add_err_masks(con)
+    return con
+
+
+def _add_err_masks(con):
+    """Add the error bitmasks to a store written before they were stored, from its error strings"""
+    if "err_mask" in [row[1] for row in con.execute("PRAGMA table_info(fits)")]:
+        return
+    rows = con.execute("SELECT rowid, oid, model, error_string FROM params").fetchall()
+    masks = read_output.error_bitmasks([r[3] for r in rows]) if rows else []
+    fit_masks = {}
+    for (_, oid, model, _), mask in zip(rows, masks):
+        fit_masks[oid, model] = fit_masks.get((oid, model), 0) | int(mask)
+    with con:
+        con.execute("ALTER TABLE fits ADD COLUMN err_mask INTEGER")
+        con.execute("ALTER TABLE params ADD COLUMN err_mask INTEGER")
+        con.executemany("UPDATE params SET err_mask=? WHERE rowid=?", [(int(mask), r[0]) for r, mask in zip(rows, masks)])
+        con.executemany("UPDATE fits SET err_mask=? WHERE oid=? AND model=?", [(mask, *key) for key, mask in fit_masks.items()])
+
+
+def _to_blob(a):
+    return np.ascontiguousarray(a, dtype='<f8').tobytes()
+
+
+def ingest_fit(con, oid, model, outdir, clobber=False):
+    """Add the results of fitting `model` to ObsID `oid`, written to `outdir`, to the store. Results already in the store are replaced.
+    Unless `clobber`, nothing is read if param_tbl.dat has not changed since it was added.
+
+    Returns
+    -------
+    ingested : bool
+        False if there was no param_tbl.dat and stat_tbl.dat in `outdir`, or they were already in the store
+    """
+
+    fn_param, fn_stat = os.path.join(outdir, "param_tbl.dat"), os.path.join(outdir, "stat_tbl.dat")
+    if not (os.path.exists(fn_param) and os.path.exists(fn_stat)):
+        return False
+    mtime_ns = os.stat(fn_param).st_mtime_ns
+    if not clobber:
+        row = con.execute("SELECT mtime_ns FROM fits WHERE oid=? AND model=?", (oid, model)).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            return False
+
+    param_names, params, params_low, params_high, err_strs = read_output.read_param_tbl(fn_param)
+    chi_sq, dof, null_hyp_probability = read_output.read_stat_tbl(fn_stat)
+    err_masks = read_output.error_bitmasks(err_strs)
+
+    with con:
+        for table in ("fits", "params", "spectra"):
+            con.execute(f"DELETE FROM {table} WHERE oid=? AND model=?", (oid, model))
+        con.execute("INSERT INTO fits VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (oid, model, mtime_ns, float(chi_sq), int(dof), float(null_hyp_probability), int(np.bitwise_or.reduce(err_masks))))
+        con.executemany("INSERT INTO params VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(oid, model, str(name), i, float(p), float(lo), float(hi), str(e), int(mask))
+                         for i, (name, p, lo, hi, e, mask) in enumerate(zip(param_names, params, params_low, params_high, err_strs, err_masks))])
+        for binning, fn in SPEC_TBLS.items():
+            fn = os.path.join(outdir, fn)
+            if not os.path.exists(fn) or os.path.getsize(fn) == 0:
+                continue
+            cols = read_output.read_tcloutr_spec_data(fn)
+            con.execute(f"INSERT INTO spectra VALUES (?, ?, ?, ?, {', '.join('?' * len(SPEC_COLUMNS))})",
+                        (oid, model, binning, len(cols[0]), *[_to_blob(c) for c in cols]))
+
+    return True
+
+
+def ingest_oid(con, base_data_dir, oid, spec_stem, model_names=models.MODELS, clobber=False, products=None):
+    """`ingest_fit()` for every model in `model_names` fitted to ObsID `oid`. Returns the models that were added.
+    The data directory of `oid` is looked up in `products` (a product_index.ProductIndex); by default, the directories of `oid` are listed."""
+    if products is None:
+        products = product_index.for_oid(base_data_dir, oid)
+    ddir = products.data_dir(oid, spec_stem)
+    if ddir is None:
+        return []
+    return [m for m in model_names if ingest_fit(con, oid, m, os.path.join(ddir, m), clobber)]
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Adds the fit results of every ObsID to the results store.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--clobber", action="store_true", help="Read every table again, even if it did not change")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    con = connect(store_fn(base_data_dir))
+    products = product_index.load(base_data_dir, oids)
+    n = 0
+    for oid in oids:
+        n += len(ingest_oid(con, base_data_dir, oid, spec_stem, clobber=args.clobber, products=products))
+    con.close()
+    print(f"Added {n} fit(s) to {store_fn(base_data_dir)}")
+
+    # Fits with an error in any parameter, as check_fit_success_using_error_string() in analyse_output.py reports them
+    failed_oids, failed_models, masks = read_output.query_failed_fits(store_fn(base_data_dir))
+    for oid, model, mask in zip(failed_oids, failed_models, masks):
+        print(f"\t{oid} {model}: {', '.join(read_output.error_messages(mask))}")
+    print(f"{len(failed_oids)} fit(s) with errors in the store")
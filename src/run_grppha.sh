@@ -8,6 +8,12 @@ CFG_FN=$1
 
 source ${CFG_FN}
 
+# Data directory of each ObsID, DDIR_${oid}, if the product index was exported (python3 product_index.py --cfg_fn ${CFG_FN})
+PRODUCT_INDEX_SH=${BASE_DATA_DIR}/_product_index.sh
+if [ -f ${PRODUCT_INDEX_SH} ]; then
+  source ${PRODUCT_INDEX_SH}
+fi
+
 # Read as arrays, not string. OIDS and MODES defined in CFG_FN.
 read -a OID_ARRAY <<< "$OIDS"
 read -a MODE_ARRAY <<< "$MODES"
@@ -16,10 +22,15 @@ length=${#OID_ARRAY[@]}
 for ((i=0; i<length; i++)); do
         oid=${OID_ARRAY[$i]}
         mode=${MODE_ARRAY[$i]}
-        # Isolate USERPROD* and the numbers that follow in the directory name. I don't know how these numbers are determined.
-        base_ddir=`basename ${BASE_DATA_DIR}/${oid}/USERPROD*`
         # Directory with downloaded data products
-        DDIR=${BASE_DATA_DIR}/${oid}/${base_ddir}/${SPEC_STEM}
+        ddir_var=DDIR_${oid}
+        if [ -n "${!ddir_var}" ]; then
+          DDIR=${!ddir_var}
+        else
+          # Isolate USERPROD* and the numbers that follow in the directory name. I don't know how these numbers are determined.
+          base_ddir=`basename ${BASE_DATA_DIR}/${oid}/USERPROD*`
+          DDIR=${BASE_DATA_DIR}/${oid}/${base_ddir}/${SPEC_STEM}
+        fi
         ARF=${DDIR}/Obs_${oid}${mode}.arf
         BKG_SPEC=${DDIR}/Obs_${oid}${mode}back.pi
         # Grouped for C-stats: $"{DDIR}/Obs_${oid}${mode}.pi"
@@ -6,14 +6,18 @@ import swifttools.ukssdc.xrt_prods as ux
 import time
 import os
 import argparse
+import concurrent.futures
+import logging
 
 import utils
+import download_manifest
+import tracing
 
 
-def submit_request_for_oid(oid, email, base_data_dir, spec_stem, targ_name, clobber=False):
-    """Query data products for ObsID `oid`.
+def create_request_for_oid(oid, email, spec_stem, targ_name):
+    """Create (but do not submit) the product request for ObsID `oid`.
     See here for the data product options: https://www.swift.ac.uk/user_objects/API/RequestJob.md#global-parameters
-    As is, this downloads a spectrum for `oid` only.
+    As is, this requests a spectrum for `oid` only.
 
     Parameters
     ----------
@@ -21,22 +25,16 @@ def submit_request_for_oid(oid, email, base_data_dir, spec_stem, targ_name, clob
         One ObsID. Cannot be a float due to how Python 3.6 handles numbers that start with 00...
     email : str
         Updates regarding the product download will be sent to this email
-    base_data_dir : str
-        Data will be downloaded in a folder with name {base_data_dir}/{oid}/{spec_stem}.zip
+    spec_stem : str
+        Controls names of output files and directories
     targ_name : str
         Name of the source observed in `oid`
-    clobber : bool
-        If True, overwrites any already existing downloaded products
 
     Returns
     -------
-    None. But data products are downloaded in `base_data_dir`.
+    myReq : swifttools.ukssdc.xrt_prods.XRTProductRequest
     """
 
-    # Make directories (including subdirectories if necessary) for downloaded data if it does not exist already
-    data_dir = f'{base_data_dir}/{oid}'
-    os.makedirs(data_dir, exist_ok=True)
-
     # Create an XRTProductRequest object
     myReq = ux.XRTProductRequest(email, silent=False)
 
@@ -51,8 +49,21 @@ def submit_request_for_oid(oid, email, base_data_dir, spec_stem, targ_name, clob
     # Get SED per ObsID
     myReq.addSpectrum(hasRedshift=False, whichData='user', specStem=spec_stem, useObs=oid, timeslice='obsid',
                       doNotFit=True)
+
+    return myReq
+
+
+def submit_request(myReq):
+    """Submit `myReq` and print the reason if the submission failed.
+
+    Returns
+    -------
+    submitted : bool
+        True if the request was accepted by the server
+    """
+
     # Submit the job - note, this can fail so we ought to check the return code in real life
-    myReq.submit()
+    submitted = myReq.submit()
     # Check for errors
     try:
         print(myReq.submitError)
@@ -60,28 +71,253 @@ def submit_request_for_oid(oid, email, base_data_dir, spec_stem, targ_name, clob
         # RuntimeError: There is no submitError unless request submission failed, which it didn't:
         pass
 
+    # Older versions of xrt_prods do not return anything from submit()
+    return submitted is not False
+
+
+def reattach_request(email, job_id):
+    """Recreate the request object of job `job_id`, which was submitted in an earlier run, so its progress can be checked again.
+
+    Returns
+    -------
+    myReq : swifttools.ukssdc.xrt_prods.XRTProductRequest or None
+        None if this version of xrt_prods does not let the job ID be set, or does not recognise the job; the ObsID then needs to be resubmitted.
+    """
+
+    myReq = ux.XRTProductRequest(email, silent=False)
+    try:
+        myReq.JobID = job_id
+        # Raises if the request does not consider itself submitted
+        myReq.complete
+    except (AttributeError, RuntimeError, ValueError) as err:
+        msg = f"Could not reattach to job {job_id} ({err}). It will be resubmitted"
+        print(msg)
+        logging.warning(msg)
+        return None
+
+    return myReq
+
+
+def _submit_new_request(oid, email, spec_stem, targ_name, manifest):
+    """Create and submit the request for `oid`, recording the job in `manifest` (if not None).
+    Return the request, or None if the submission failed."""
+
+    myReq = create_request_for_oid(oid, email, spec_stem, targ_name)
+    if not submit_request(myReq):
+        msg = f"Submission failed for ObsID {oid}"
+        print(msg)
+        logging.error(msg)
+        if manifest is not None:
+            manifest.record(oid, state="failed", job_id=None)
+        return None
+    if manifest is not None:
+        manifest.record(oid, state="submitted", job_id=getattr(myReq, "JobID", None))
+
+    return myReq
+
+
+def submit_request_for_oid(oid, email, base_data_dir, spec_stem, targ_name, clobber=False, manifest=None, job_id=None):
+    """Query data products for ObsID `oid`.
+    See here for the data product options: https://www.swift.ac.uk/user_objects/API/RequestJob.md#global-parameters
+    As is, this downloads a spectrum for `oid` only.
+
+    Parameters
+    ----------
+    oid : str
+        One ObsID. Cannot be a float due to how Python 3.6 handles numbers that start with 00...
+    email : str
+        Updates regarding the product download will be sent to this email
+    base_data_dir : str
+        Data will be downloaded in a folder with name {base_data_dir}/{oid}/{spec_stem}.zip
+    targ_name : str
+        Name of the source observed in `oid`
+    clobber : bool
+        If True, overwrites any already existing downloaded products
+    manifest : download_manifest.DownloadManifest or None
+        If given, the job ID, state and downloaded zip file are recorded in it
+    job_id : str or None
+        ID of a job for `oid` submitted in an earlier run. Wait for that job instead of submitting a new one, if possible
+
+    Returns
+    -------
+    None. But data products are downloaded in `base_data_dir`.
+    """
+
+    # Make directories (including subdirectories if necessary) for downloaded data if it does not exist already
+    data_dir = f'{base_data_dir}/{oid}'
+    os.makedirs(data_dir, exist_ok=True)
+
+    myReq = reattach_request(email, job_id) if job_id is not None else None
+    if myReq is None:
+        myReq = _submit_new_request(oid, email, spec_stem, targ_name, manifest)
+        if myReq is None:
+            return None
+
     # Now wait until it's complete
-    done = myReq.complete
-    while not done:
-        time.sleep(60)
+    with tracing.span("server", "download", oid=oid):
         done = myReq.complete
+        while not done:
+            time.sleep(60)
+            done = myReq.complete
 
     # And download the products
-    myReq.downloadProducts(data_dir, format='zip', clobber=clobber)
+    with tracing.span("transfer", "download", oid=oid):
+        myReq.downloadProducts(data_dir, format='zip', clobber=clobber)
+    if manifest is not None:
+        manifest.record_download(oid)
 
     return None
 
 
+def submit_requests_concurrently(oids, email, base_data_dir, spec_stem, targ_name, clobber=False,
+                                 max_jobs=20, poll_interval=60, max_poll_interval=600, backoff=2, job_timeout=None,
+                                 max_downloads=4, manifest=None, job_ids=None):
+    """Query data products for every ObsID in `oids` at once, rather than one after another as in `submit_request_for_oid()`.
+    Up to `max_jobs` requests are submitted up front. All outstanding jobs are then polled from this one loop;
+    each job is checked every `poll_interval` seconds at first and the wait grows by a factor `backoff` (up to `max_poll_interval`)
+    every time the job is found to still be building, or its status could not be checked (e.g. a network error). The download of a job starts (in a thread) as soon as it is complete,
+    and its place is given to the next ObsID still waiting to be submitted.
+
+    Parameters
+    ----------
+    oids : list[str]
+        ObsIDs
+    email, base_data_dir, spec_stem, targ_name, clobber
+        See `submit_request_for_oid()`
+    max_jobs : int
+        Maximum number of requests that are submitted (and not yet downloaded) at any one time
+    poll_interval : float
+        Seconds to wait before the first status check of a job
+    max_poll_interval : float
+        Upper limit on the seconds between two status checks of a job
+    backoff : float
+        Factor by which the wait between two status checks of a job grows
+    job_timeout : float or None
+        Give up on a job that is not complete this many seconds after it was submitted. None means wait forever
+    max_downloads : int
+        Maximum number of downloads running at once
+    manifest : download_manifest.DownloadManifest or None
+        If given, the job ID, state and downloaded zip file of each ObsID are recorded in it
+    job_ids : dict or None
+        ObsID is the key, ID of a job submitted in an earlier run is the value. These jobs are waited for instead of being resubmitted, if possible
+
+    Returns
+    -------
+    status : dict
+        ObsID is the key, the value is one of "downloaded", "submit_failed", "timeout", "download_failed"
+    """
+
+    job_ids = job_ids or {}
+    waiting = list(oids)
+    # ObsID is the key; value is [request, time of submission, time of next status check, current wait between checks]
+    in_flight = {}
+    downloads = {}
+    status = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_downloads) as pool:
+        while waiting or in_flight or downloads:
+            # Fill the free slots. Jobs being downloaded still count towards `max_jobs`
+            while waiting and len(in_flight) + len(downloads) < max_jobs:
+                oid = waiting.pop(0)
+                os.makedirs(f'{base_data_dir}/{oid}', exist_ok=True)
+                myReq = reattach_request(email, job_ids[oid]) if oid in job_ids else None
+                if myReq is None:
+                    myReq = _submit_new_request(oid, email, spec_stem, targ_name, manifest)
+                    if myReq is None:
+                        status[oid] = "submit_failed"
+                        continue
+                now = time.monotonic()
+                in_flight[oid] = [myReq, now, now + poll_interval, poll_interval]
+
+            # Poll only the jobs whose next check is due
+            now = time.monotonic()
+            for oid in [o for o, v in in_flight.items() if v[2] <= now]:
+                myReq, t_submit, _, wait = in_flight[oid]
+                try:
+                    complete = myReq.complete
+                except Exception as err:
+                    # A transient error of the API or the network: the job is checked again later, like one still building
+                    msg = f"Could not check the status of the job of ObsID {oid} ({err!r}). Checking again later"
+                    print(msg)
+                    logging.warning(msg)
+                    complete = False
+                if complete:
+                    del in_flight[oid]
+                    # Time on the server, from submission to the status check that found the job complete
+                    tracing.add_span("server", "download", time.time() - (now - t_submit), time.time(), oid=oid)
+                    downloads[oid] = pool.submit(tracing.run_traced, "transfer", "download", {"oid": oid},
+                                                 myReq.downloadProducts, f'{base_data_dir}/{oid}', format='zip', clobber=clobber)
+                elif job_timeout is not None and now - t_submit > job_timeout:
+                    del in_flight[oid]
+                    msg = f"ObsID {oid} was not complete after {job_timeout} seconds. Giving up on it"
+                    print(msg)
+                    logging.error(msg)
+                    status[oid] = "timeout"
+                    # The job may still finish on the server; keep it as submitted so a rerun reattaches to it
+                else:
+                    wait = min(wait * backoff, max_poll_interval)
+                    in_flight[oid][2:] = [now + wait, wait]
+
+            # Collect finished downloads
+            for oid in [o for o, f in downloads.items() if f.done()]:
+                try:
+                    downloads.pop(oid).result()
+                    status[oid] = "downloaded"
+                    msg = f"Downloaded products for ObsID {oid}"
+                    logging.info(msg)
+                except Exception as err:
+                    status[oid] = "download_failed"
+                    msg = f"Download failed for ObsID {oid}: {err}"
+                    logging.error(msg)
+                print(msg)
+                if manifest is not None and status[oid] == "downloaded" and not manifest.record_download(oid):
+                    status[oid] = "download_failed"
+                elif manifest is not None and status[oid] == "download_failed":
+                    manifest.record(oid, state="failed")
+
+            # Sleep until the next status check is due, or a download finishes
+            if in_flight or downloads:
+                next_check = min([v[2] for v in in_flight.values()], default=time.monotonic() + max_poll_interval)
+                timeout = max(0, next_check - time.monotonic())
+                if downloads:
+                    concurrent.futures.wait(list(downloads.values()), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                else:
+                    time.sleep(timeout)
+
+    return status
+
+
 if __name__ == "__main__":
     # There is one command line argument: the name of the config file
     parser = argparse.ArgumentParser(description="Downloads XRT data products by querying the online tool, and reading user-made config file.")
     # *Optional* argument with default
     parser.add_argument(
         "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--concurrent", action="store_true", help="Submit all requests up front and poll them together, instead of one ObsID at a time.")
     args = parser.parse_args()
     cfg_filename = args.cfg_fn
 
     oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename) 
+    tracing.configure(cfg_filename)
+    with tracing.span("download", tracing.STAGE):
+        # Only request ObsIDs that were not (completely) downloaded in a previous run, and reattach to jobs still building on the server
+        manifest = download_manifest.DownloadManifest(base_data_dir, spec_stem)
+        to_submit, in_flight = manifest.resume_plan(oids)
+        # Any zip file left for these ObsIDs is missing or truncated, so it has to be overwritten
+        clobber = True
 
-    for obsid in oids:
-        submit_request_for_oid(obsid, email, base_data_dir, spec_stem, targ_name)
+        if args.concurrent:
+            variables = utils.read_cfg(cfg_filename)
+            job_timeout = variables.get("JOB_TIMEOUT")
+            status = submit_requests_concurrently(list(in_flight) + to_submit, email, base_data_dir, spec_stem, targ_name, clobber=clobber,
+                                                  max_jobs=int(variables.get("MAX_CONCURRENT_JOBS", 20)),
+                                                  poll_interval=float(variables.get("POLL_INTERVAL", 60)),
+                                                  max_poll_interval=float(variables.get("MAX_POLL_INTERVAL", 600)),
+                                                  backoff=float(variables.get("POLL_BACKOFF", 2)),
+                                                  job_timeout=float(job_timeout) if job_timeout else None,
+                                                  manifest=manifest, job_ids=in_flight)
+            print(f"Status of each ObsID: {status}")
+        else:
+            for obsid in list(in_flight) + to_submit:
+                submit_request_for_oid(obsid, email, base_data_dir, spec_stem, targ_name, clobber=clobber, manifest=manifest, job_id=in_flight.get(obsid))
@@ -0,0 +1,193 @@
+"""
+Synthetic BASE_DATA_DIR of N ObsIDs, laid out as a real one after the fits, for timing the workflow at scale (see
+tests/test_benchmark_stages.py):
+
+    {BASE_DATA_DIR}/{OID}/USERPROD_{n}/{SPEC_STEM}/Obs_{OID}{mode}source.pi
+    {BASE_DATA_DIR}/{OID}/USERPROD_{n}/{SPEC_STEM}/{model}/param_tbl.dat, stat_tbl.dat, spec_default_bin.dat, spec_binned.dat
+
+The spectra have the primary header keywords the workflow reads (see header_index.HEADER_KEYS) and a SPECTRUM table; the tables of each
+model in the registry are formatted as the XSpec fits write them. Some ObsIDs also have a short observation in the other mode, as real
+ones sometimes do. A config file listing the ObsIDs, synthetic.cfg, is written to BASE_DATA_DIR so every script can be run on the dataset.
+Values are random but plausible (powerlaw-like spectra with photon index around 2); they are not for science.
+
+    python synthetic.py --n_oids 1000 [--base_data_dir DIR]
+
+By default the dataset is written to {SYNTHETIC_DIR}/synthetic_{N}, in the temporary directory of the system, so it is kept out of the
+repository and reused by the next benchmark run.
+"""
+
+
+import numpy as np
+import argparse
+import os
+import tempfile
+
+import models
+
+
+CFG_FN = "synthetic.cfg"
+
+# The datasets are written to {SYNTHETIC_DIR}/synthetic_{N} by default
+SYNTHETIC_DIR = os.path.join(tempfile.gettempdir(), "xrt_workflow_synthetic")
+
+# First synthetic ObsID; real ObsIDs are 11 digits
+FIRST_OID = 90000000001
+
+# Mean and standard deviation of each parameter in param_tbl.dat
+PARAM_DISTRIBUTIONS = {
+    "PhoIndex": (2.2, 0.2),
+    "alpha": (2.2, 0.2),
+    "beta": (0., 0.1),
+    "pivotE": (1., 0.),
+    "norm": (0.02, 0.005),
+    "ztbabs_nh": (0.01, 0.01),
+    }
+
+# DATAMODE keyword of the spectra of each mode
+DATAMODES = {"pc": "PHOTON", "wt": "WINDOWED"}
+
+# Number of points in spec_default_bin.dat and spec_binned.dat
+N_DEFAULT_BIN, N_BINNED = 130, 27
+
+# Fraction of ObsIDs that also have a short observation in the other mode
+TWO_MODE_FRACTION = 0.1
+
+
+def synthetic_oids(n_oids):
+    return [f"{i:011d}" for i in range(FIRST_OID, FIRST_OID + n_oids)]
+
+
+def _source_spectrum(n_chan=1024):
+    """Spectrum whose header values and counts are set for each ObsID"""
+    from astropy.io import fits
+
+    primary = fits.PrimaryHDU()
+    for key, value in (("TELESCOP", "SWIFT"), ("INSTRUME", "XRT"), ("OBJECT", "SYNTHETIC"), ("LIVETIME", 0.), ("EXPOSURE", 0.),
+                       ("DATE-OBS", "2000-01-01T00:00:00"), ("DATAMODE", "PHOTON"), ("OBS_ID", "")):
+        primary.header[key] = value
+    spectrum = fits.BinTableHDU.from_columns(
+        [fits.Column(name="CHANNEL", format="J", array=np.arange(n_chan)),
+         fits.Column(name="COUNTS", format="J", unit="count", array=np.zeros(n_chan, dtype=np.int32))],
+        name="SPECTRUM")
+    spectrum.header["TLMIN1"], spectrum.header["TLMAX1"], spectrum.header["DETCHANS"] = 0, n_chan - 1, n_chan
+    return fits.HDUList([primary, spectrum])
+
+
+def _param_lines(model, rng, flux, count_rate):
+    """Lines of param_tbl.dat of `model`: the tabulated parameters, then the flux and count rate"""
+    lines = ["name param param_low param_high error_string"]
+    for p in model.params:
+        if not p.tabulate:
+            continue
+        mean, sigma = PARAM_DISTRIBUTIONS.get(p.name, (1., 0.1))
+        value = abs(rng.normal(mean, sigma)) if p.name.endswith("nh") else rng.normal(mean, sigma)
+        if p.frozen:
+            lines.append(f"{p.name} {value:g} 0 0 0")
+        else:
+            err = abs(value) * rng.uniform(0.01, 0.05) + 1e-6
+            lines.append(f"{p.name} {value:g} {value - err:.10g} {value + err:.10g} FFFFFFFFF")
+    lines.append(f"flux {flux:.10g} {flux * 0.97:.10g} {flux * 1.04:.10g} 0")
+    lines.append(f"{model.rate_name} {count_rate:.10g} {count_rate * 0.98:.10g} {count_rate * 1.02:.10g} 0")
+    return lines
+
+
+def _spec_lines(rng, n_points, pho_index, norm):
+    """Lines of an eeufspec table: energy (keV), energy half bin width, eflux (keV/cm^2/s), eflux_error, model_eflux"""
+    edges = np.geomspace(models.E_NOTICE[0], models.E_NOTICE[1], n_points + 1)
+    energy, half_width = (edges[1:] + edges[:-1]) / 2, (edges[1:] - edges[:-1]) / 2
+    model_eflux = norm * energy ** (2 - pho_index)
+    eflux_err = model_eflux * rng.uniform(0.1, 0.3, n_points)
+    eflux = model_eflux + eflux_err * rng.standard_normal(n_points)
+    return [f"{e:.10g} {w:.10g} {y:.10g} {yerr:.10g} {m:.10g}" for e, w, y, yerr, m in zip(energy, half_width, eflux, eflux_err, model_eflux)]
+
+
+def _write(fn, lines):
+    with open(fn, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_cfg(fn, oids, modes, base_data_dir, spec_stem):
+    """Config file for the synthetic dataset, with the variables that utils.load_cfg() needs"""
+    _write(fn, [
+        "# Synthetic dataset written by synthetic.py",
+        f'OIDS="{" ".join(oids)}"',
+        f'MODES="{" ".join(modes)}"',
+        'EMAIL="synthetic@example.com"',
+        f'BASE_DATA_DIR="{base_data_dir}"',
+        'SOURCE_NAME="SYNTHETIC"',
+        f'SPEC_STEM="{spec_stem}"',
+        ])
+
+
+def dataset_dir(n_oids, synthetic_dir=SYNTHETIC_DIR):
+    """{synthetic_dir}/synthetic_{n_oids}"""
+    return os.path.join(synthetic_dir, f"synthetic_{n_oids}")
+
+
+def make_dataset(base_data_dir, n_oids, spec_stem="spec", model_names=models.MODELS, seed=0, mjd_start=53000.):
+    """Write a synthetic dataset of `n_oids` ObsIDs, about two per day from `mjd_start` (early 2004), to `base_data_dir`.
+    10000 ObsIDs end in 2020, within astropy's leap second table.
+
+    Returns
+    -------
+    fn_cfg : str
+        Config file of the dataset, {base_data_dir}/synthetic.cfg
+    """
+
+    from astropy.time import Time
+
+    rng = np.random.default_rng(seed)
+    oids = synthetic_oids(n_oids)
+    modes = rng.choice(["pc", "wt"], n_oids).tolist()
+    mjds = mjd_start + np.cumsum(rng.uniform(0.2, 1., n_oids))
+    dates = Time(mjds, format='mjd').isot
+    hdul = _source_spectrum()
+    primary, spectrum = hdul[0].header, hdul["SPECTRUM"]
+    channels = spectrum.data["CHANNEL"]
+
+    for i, (oid, mode, date) in enumerate(zip(oids, modes, dates)):
+        ddir = os.path.join(base_data_dir, oid, f"USERPROD_{i + 1}", spec_stem)
+        os.makedirs(ddir, exist_ok=True)
+
+        livetime = rng.uniform(300., 3000.)
+        other_mode = {"pc": "wt", "wt": "pc"}[mode]
+        spectra = [(mode, livetime)] + ([(other_mode, rng.uniform(1., 20.))] if rng.uniform() < TWO_MODE_FRACTION else [])
+        for m, t in spectra:
+            primary["LIVETIME"], primary["EXPOSURE"], primary["DATE-OBS"] = t, t, date[:19]
+            primary["DATAMODE"], primary["OBS_ID"] = DATAMODES[m], oid
+            spectrum.data["COUNTS"] = rng.poisson(t * 0.05 * np.exp(-channels / 150.))
+            hdul.writeto(os.path.join(ddir, f"Obs_{oid}{m}source.pi"), overwrite=True)
+
+        # Shared by the models, so the fluxes of one ObsID agree roughly as they do in real fits
+        pho_index, norm = rng.normal(2.2, 0.2), rng.lognormal(np.log(0.02), 0.5)
+        flux, count_rate = norm * 0.3, norm * 100.
+        for model_name in model_names:
+            model = models.REGISTRY[model_name]
+            outdir = os.path.join(ddir, model_name)
+            os.makedirs(outdir, exist_ok=True)
+            _write(os.path.join(outdir, "param_tbl.dat"), _param_lines(model, rng, flux * rng.uniform(0.95, 1.05), count_rate))
+            dof = N_DEFAULT_BIN - len(model.free_indices())
+            chi_sq = dof * rng.uniform(0.8, 1.3)
+            _write(os.path.join(outdir, "stat_tbl.dat"), ["chi_squared deg_freedom null_hyp_probability", f"{chi_sq:.7g} {dof} {rng.uniform():.7g}"])
+            _write(os.path.join(outdir, "spec_default_bin.dat"), _spec_lines(rng, N_DEFAULT_BIN, pho_index, norm))
+            _write(os.path.join(outdir, "spec_binned.dat"), _spec_lines(rng, N_BINNED, pho_index, norm))
+
+    fn_cfg = os.path.join(base_data_dir, CFG_FN)
+    write_cfg(fn_cfg, oids, modes, base_data_dir, spec_stem)
+
+    return fn_cfg
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a synthetic BASE_DATA_DIR to time the workflow on many ObsIDs.")
+    parser.add_argument(
+        "--n_oids", type=int, default=1000, help="Number of ObsIDs")
+    parser.add_argument(
+        "--base_data_dir", type=str, default=None, help=f"Directory to write to (default: {SYNTHETIC_DIR}/synthetic_{{n_oids}})")
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the random values")
+    args = parser.parse_args()
+
+    base_data_dir = args.base_data_dir or dataset_dir(args.n_oids)
+    fn_cfg = make_dataset(base_data_dir, args.n_oids, seed=args.seed)
+    print(f"Wrote {args.n_oids} ObsIDs to {base_data_dir}. Config file: {fn_cfg}")
@@ -0,0 +1,194 @@
+"""
+Tracing of the workflow: a span around every stage and every ObsID (and model) task, appended as one JSON object per line to
+{BASE_DATA_DIR}/_trace.jsonl (TRACE_FN in the config file). Each span is a Chrome trace "complete" event; `python tracing.py --cfg_fn CFG_FN`
+prints a summary (the time spent in each stage, and the slowest ObsIDs and models of each, i.e. the stragglers) and writes _trace.json,
+which can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+Each span carries its wall time, the CPU time of the process and of its subprocesses that finished during the span (e.g. XSpec, the workers
+of a process pool), and the peak RSS of the process and of its largest finished subprocess. CPU time and RSS are counted per process, so the
+spans of tasks running at the same time in threads of one process share them; the wall time is always the task's own.
+
+Tracing is on once `configure()` has been called. The trace file is passed on in the environment variable XRT_TRACE_FN, so the spans of
+subprocesses (e.g. process pools) go to the same file.
+"""
+
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+
+import utils
+
+
+TRACE_FN = "_trace.jsonl"
+
+# Chrome trace of the spans in TRACE_FN, written by the summary
+CHROME_TRACE_FN = "_trace.json"
+
+ENV_VAR = "XRT_TRACE_FN"
+
+# Category of the span around a whole stage; the spans of its tasks have the name of the stage as category
+STAGE = "stage"
+
+# ru_maxrss is in kilobytes, except on macOS where it is in bytes
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+_lock = threading.Lock()
+
+
+def configure(cfg_filename):
+    """Turn on tracing to {BASE_DATA_DIR}/{TRACE_FN} as set in config file `cfg_filename`, unless TRACE_FN is empty there.
+
+    Returns
+    -------
+    fn : str or None
+        Trace file, or None if tracing is off
+    """
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    fn = utils.read_cfg(cfg_filename).get("TRACE_FN", TRACE_FN)
+    if fn:
+        os.environ[ENV_VAR] = os.path.join(base_data_dir, fn)
+    else:
+        os.environ.pop(ENV_VAR, None)
+    return os.environ.get(ENV_VAR)
+
+
+def _usage():
+    """CPU time (s) of this process and of its finished subprocesses, and the peak RSS (bytes) of each"""
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.process_time(), children.ru_utime + children.ru_stime,
+            own.ru_maxrss * _RSS_UNIT, children.ru_maxrss * _RSS_UNIT)
+
+
+def _write(name, cat, t_start, t_end, args):
+    fn = os.environ.get(ENV_VAR)
+    if not fn:
+        return
+    event = {"name": name, "cat": cat, "ph": "X", "ts": round(t_start * 1e6), "dur": round((t_end - t_start) * 1e6),
+             "pid": os.getpid(), "tid": threading.get_ident(), "args": {"wall_s": round(t_end - t_start, 6), **args}}
+    line = json.dumps(event) + "\n"
+    # One write per line, in append mode, so lines of processes writing at once do not interleave
+    with _lock, open(fn, 'a') as f:
+        f.write(line)
+
+
+@contextlib.contextmanager
+def span(name, cat, **args):
+    """Trace the code in the `with` block as a span called `name` in category `cat`; `args` (e.g. oid, model) are saved with it.
+    The dict of args is yielded, so the outcome of the block can be added to it, e.g. `with span(...) as s: ...; s["status"] = "done"`."""
+
+    if not os.environ.get(ENV_VAR):
+        yield args
+        return
+    t_start, (cpu, children_cpu, _, _) = time.time(), _usage()
+    try:
+        yield args
+    finally:
+        t_end, (cpu_end, children_cpu_end, rss, children_rss) = time.time(), _usage()
+        _write(name, cat, t_start, t_end, {**args,
+                                           "cpu_s": round(cpu_end - cpu, 6), "children_cpu_s": round(children_cpu_end - children_cpu, 6),
+                                           "max_rss_mb": round(rss / 2**20, 1), "children_max_rss_mb": round(children_rss / 2**20, 1)})
+
+
+def add_span(name, cat, t_start, t_end, **args):
+    """Add a span that was timed elsewhere (e.g. by XSpec), from `t_start` to `t_end` (seconds since the epoch)"""
+    _write(name, cat, t_start, t_end, args)
+
+
+def run_traced(name, cat, args, func, *func_args, **func_kwargs):
+    """`func(*func_args, **func_kwargs)` in a span; for submitting traced tasks to a pool"""
+    with span(name, cat, **args):
+        return func(*func_args, **func_kwargs)
+
+
+def read_trace(fn):
+    """Spans in trace file `fn`. A line cut short (e.g. by a killed process) is skipped."""
+    events = []
+    with open(fn, 'r') as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return events
+
+
+def _task_label(event):
+    args = event["args"]
+    return " ".join(str(args[k]) for k in ("target", "oid", "model") if k in args) or event["name"]
+
+
+def summary(events, top=5):
+    """Lines of a summary of `events`: one row per stage span, then the number of tasks of each kind in each stage,
+    their median and longest wall time, and the `top` slowest of them"""
+
+    lines = [f"{'Stage':<12}{'wall (s)':>10}{'CPU (s)':>10}{'subproc. CPU (s)':>18}{'peak RSS (MB)':>15}"]
+    for e in sorted((e for e in events if e["cat"] == STAGE), key=lambda e: e["ts"]):
+        a = e["args"]
+        lines.append(f"{e['name']:<12}{a['wall_s']:>10.1f}{a.get('cpu_s', 0):>10.1f}{a.get('children_cpu_s', 0):>18.1f}"
+                     f"{max(a.get('max_rss_mb', 0), a.get('children_max_rss_mb', 0)):>15.0f}")
+
+    kinds = {}
+    for e in events:
+        if e["cat"] != STAGE:
+            kinds.setdefault((e["cat"], e["name"]), []).append(e)
+    for (cat, name), tasks in kinds.items():
+        walls = sorted((e["args"]["wall_s"] for e in tasks), reverse=True)
+        lines.append("")
+        lines.append(f"{cat} / {name}: {len(tasks)} task(s), median {statistics.median(walls):.1f} s, longest {walls[0]:.1f} s. Slowest:")
+        for e in sorted(tasks, key=lambda e: e["args"]["wall_s"], reverse=True)[:top]:
+            status = f" ({e['args']['status']})" if "status" in e["args"] else ""
+            lines.append(f"\t{_task_label(e)}: {e['args']['wall_s']:.1f} s{status}")
+
+    return lines
+
+
+def write_chrome_trace(events, fn):
+    with open(fn, 'w') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Summarises the trace of the workflow, and writes it as a Chrome trace.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--trace_fn", type=str, default=None, help="Trace file to use instead of the one set in the config file, e.g. a campaign's (campaign.py)")
+    parser.add_argument(
+        "--clear", action="store_true", help="Delete the trace instead, to start a new one")
+    parser.add_argument(
+        "--top", type=int, default=5, help="Number of slowest tasks listed for each kind of task")
+    args = parser.parse_args()
+
+    fn = args.trace_fn or configure(args.cfg_fn)
+    if fn is None:
+        sys.exit("TRACE_FN is empty in the config file, so there is no trace")
+    if args.clear:
+        if os.path.exists(fn):
+            os.remove(fn)
+        print(f"Deleted {fn}")
+        sys.exit()
+    if not os.path.exists(fn):
+        sys.exit(f"No trace in {fn}")
+
+    events = read_trace(fn)
+    fn_chrome = os.path.join(os.path.dirname(fn), CHROME_TRACE_FN)
+    write_chrome_trace(events, fn_chrome)
+    try:
+        print("\n".join(summary(events, args.top)))
+        print(f"\nWrote {fn_chrome}")
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The summary was piped to a command that stopped reading it, e.g. `head`. Python would report the error again when it flushes
+        # stdout at exit, so the rest goes to /dev/null
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -0,0 +1,146 @@
+"""
+Unpack the output of the swifttools product generator: {BASE_DATA_DIR}/{OID}/{SPEC_STEM}.zip contains USERPROD_*/{SPEC_STEM}/Obs_{OID}.tar.gz.
+Only the members of the tar file needed later in the workflow are extracted, into {BASE_DATA_DIR}/{OID}/USERPROD_*/{SPEC_STEM}/.
+The tar file is read straight out of the zip file, so it is never written to disk. ObsIDs are unpacked in parallel.
+"""
+
+
+import argparse
+import concurrent.futures
+import fnmatch
+import logging
+import os
+import shutil
+import tarfile
+import zipfile
+
+import tracing
+import utils
+
+
+# Spectra, background spectra and responses; this is all that is read by grppha/XSpec and the rest of the workflow
+DEFAULT_MEMBERS = ("*source.pi", "*back.pi", "*.arf", "*.rmf")
+
+
+def _wanted(name, members):
+    """True if the basename of `name` matches any of the glob patterns in `members`."""
+    return any(fnmatch.fnmatch(os.path.basename(name), pattern) for pattern in members)
+
+
+def _write_member(fileobj, out_fn):
+    """Copy file-like `fileobj` to `out_fn`. Write to a temporary file first, so an interrupted unpack never leaves a partial file
+    that would be skipped as 'already extracted' next time."""
+    tmp = f"{out_fn}.part"
+    with open(tmp, 'wb') as out:
+        shutil.copyfileobj(fileobj, out, 1 << 20)
+    os.replace(tmp, out_fn)
+
+
+def unpack_oid(base_data_dir, oid, spec_stem, members=DEFAULT_MEMBERS, clobber=False):
+    """Extract the files matching `members` from {base_data_dir}/{oid}/{spec_stem}.zip and the tar file(s) within it.
+    Files are extracted into the same directory as they are in the zip file, e.g. {base_data_dir}/{oid}/USERPROD_224850/{spec_stem}/
+
+    Parameters
+    ----------
+    base_data_dir, spec_stem : str
+        As set in the config file
+    oid : str
+        One ObsID
+    members : iterable[str]
+        Glob patterns matched against the basename of each file, e.g. '*source.pi'
+    clobber : bool
+        If False, files that already exist are skipped (as `unzip -n` and `tar --skip-old-files` did)
+
+    Returns
+    -------
+    extracted : list[str]
+        Paths of the files written
+    """
+
+    extracted = []
+    fn_zip = os.path.join(base_data_dir, oid, f"{spec_stem}.zip")
+    with zipfile.ZipFile(fn_zip) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            # Never write outside of the ObsID directory
+            rel_dir = os.path.normpath(os.path.dirname(info.filename))
+            if rel_dir.startswith("..") or os.path.isabs(rel_dir):
+                continue
+            out_dir = os.path.join(base_data_dir, oid, rel_dir)
+
+            if info.filename.endswith((".tar.gz", ".tgz")):
+                # Stream (mode 'r|gz') so the tar file is decompressed on the fly from the zip file
+                with zf.open(info) as fileobj, tarfile.open(fileobj=fileobj, mode='r|gz') as tf:
+                    for member in tf:
+                        if not member.isfile() or not _wanted(member.name, members):
+                            continue
+                        out_fn = os.path.join(out_dir, os.path.basename(member.name))
+                        if os.path.exists(out_fn) and not clobber:
+                            continue
+                        os.makedirs(out_dir, exist_ok=True)
+                        _write_member(tf.extractfile(member), out_fn)
+                        extracted.append(out_fn)
+            elif _wanted(info.filename, members):
+                out_fn = os.path.join(out_dir, os.path.basename(info.filename))
+                if os.path.exists(out_fn) and not clobber:
+                    continue
+                os.makedirs(out_dir, exist_ok=True)
+                with zf.open(info) as fileobj:
+                    _write_member(fileobj, out_fn)
+                extracted.append(out_fn)
+
+    return extracted
+
+
+def unpack_all(base_data_dir, oids, spec_stem, members=DEFAULT_MEMBERS, clobber=False, max_workers=None):
+    """Run `unpack_oid()` for every ObsID in `oids` across a pool of `max_workers` processes (default: number of CPUs).
+
+    Returns
+    -------
+    extracted : dict
+        ObsID is the key, list of files written is the value. ObsIDs that could not be unpacked are not included.
+    """
+
+    extracted = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(tracing.run_traced, "ObsID", "unpack", {"oid": oid},
+                               unpack_oid, base_data_dir, oid, spec_stem, members, clobber): oid for oid in oids}
+        for future in concurrent.futures.as_completed(futures):
+            oid = futures[future]
+            try:
+                extracted[oid] = future.result()
+            except (OSError, zipfile.BadZipFile, tarfile.TarError) as err:
+                msg = f"Could not unpack ObsID {oid}: {err}"
+                print(msg)
+                logging.error(msg)
+                continue
+            msg = f"ObsID {oid}: extracted {len(extracted[oid])} file(s)"
+            print(msg)
+            logging.info(msg)
+
+    return extracted
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Unpacks the data products downloaded by swifttools_ana.py.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--clobber", action="store_true", help="Overwrite files that were already extracted.")
+    parser.add_argument(
+        "--max_workers", type=int, default=None, help="Number of ObsIDs unpacked at once. Default is the number of CPUs.")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    members = utils.read_cfg(cfg_filename).get("UNPACK_MEMBERS", DEFAULT_MEMBERS)
+    # One pattern is read from the config as a string
+    if isinstance(members, str):
+        members = [members]
+
+    tracing.configure(cfg_filename)
+    with tracing.span("unpack", tracing.STAGE):
+        unpack_all(base_data_dir, oids, spec_stem, members=members, clobber=args.clobber, max_workers=args.max_workers)
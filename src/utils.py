@@ -5,13 +5,14 @@ TODO this script is a random assortment of things.. organize better
 """
 
 
-from astropy.io import fits
-import glob
 import argparse
 import os
-from astropy.time import Time
 import logging
 
+import header_index
+import product_index
+import tracing
+
 
 def get_livetime_from_spec(fn_pi):
     """Get deadtime corrected livetime in seconds.
@@ -28,14 +29,14 @@ def get_livetime_from_spec(fn_pi):
     Deadtime corrected livetime in seconds
     """
 
-    hdul = fits.open(fn_pi)
-    livetime_sec = hdul[0].header["LIVETIME"]
+    livetime_sec = header_index.read_primary_header(fn_pi)["LIVETIME"]
 
     return float(livetime_sec)
 
 
 def get_observation_start_date(fn_pi):
-    """Get deadtime corrected livetime in seconds.
+    """Get observation start date (DATE-OBS) as MJD.
+    To get the dates of many spectra, use `header_index.HeaderIndex.mjds()` instead, which converts them all at once.
 
     Parameters
     ----------
@@ -46,26 +47,26 @@ def get_observation_start_date(fn_pi):
 
     Returns
     -------
-    Deadtime corrected livetime in seconds
+    Observation start date in MJD
     """
 
-    hdul = fits.open(fn_pi)
+    from astropy.time import Time
+
     # YYYY-MM-DDThh:mm:ss
-    date_isot = hdul[0].header["DATE-OBS"]
+    date_isot = header_index.read_primary_header(fn_pi)["DATE-OBS"]
     t = Time(date_isot, format='isot')
 
     return t.mjd
 
 
-def load_cfg(filename):
-    """Read config file `filename` formatted as e.g. src/config_example.cfg
-    Return config file contents.
-    
+def read_cfg(filename):
+    """Read every variable declared in config file `filename` formatted as e.g. src/config_example.cfg
+    Values that contain spaces are split into lists; Bash variable expansion (e.g. ${BASE_DATA_DIR}) is NOT done.
+
     Returns
     -------
-    oid : list[str]
-    email, base_data_dir, spec_stem, targ_name : str
-        Define in config_example.cfg 
+    variables : dict
+        Variable name is the key, its (unquoted) value is the value
     """
 
     variables = {}
@@ -87,6 +88,22 @@ def load_cfg(filename):
                     value = value.split()
                 variables[key] = value
 
+    return variables
+
+
+def load_cfg(filename):
+    """Read config file `filename` formatted as e.g. src/config_example.cfg
+    Return config file contents.
+    
+    Returns
+    -------
+    oid : list[str]
+    email, base_data_dir, spec_stem, targ_name : str
+        Define in config_example.cfg 
+    """
+
+    variables = read_cfg(filename)
+
     oids = variables["OIDS"]
     # Make this a one-element list if there is only one ObsID, because `oids` is looped over later
     if type(oids) is str:
@@ -99,16 +116,33 @@ def load_cfg(filename):
     return oids, email, base_data_dir, spec_stem, targ_name
 
 
-def get_mode(base_data_dir, obsid, spec_stem, modes=("pc", "wt")):
+def get_trash_dir(variables, base_data_dir):
+    """TRASH_DIR of the config, where old output tables are moved, with ${BASE_DATA_DIR} expanded as Bash does when the config is sourced.
+    {base_data_dir}/trash if it is not set."""
+
+    trash_dir = variables.get("TRASH_DIR")
+    if not trash_dir:
+        return os.path.join(base_data_dir, "trash")
+    return trash_dir.replace("${BASE_DATA_DIR}", base_data_dir).replace("$BASE_DATA_DIR", base_data_dir)
+
+
+def get_mode(base_data_dir, obsid, spec_stem, modes=("pc", "wt"), index=None, products=None):
     """Determine which mode to use, PC or WT, if there are observations for both for one ObsID `oid`.
     If there are both PC and WT observations, typically XRT started in one mode and switched to the other due to the count rate.
     So, use the longer observation. In my experience the shorter observation is VERY short, < 20 seconds.
+    Livetimes are read from `index` (a header_index.HeaderIndex), and the spectra are found in `products` (a product_index.ProductIndex);
+    by default, the header index cached in `base_data_dir`, and a listing of the directories of `obsid`.
     """
 
+    if index is None:
+        index = header_index.HeaderIndex.for_base_data_dir(base_data_dir)
+    if products is None:
+        products = product_index.for_oid(base_data_dir, obsid)
+
     livetimes = {}
     for m in modes:
         pi_dir = os.path.join(base_data_dir, obsid, "USERPROD*", spec_stem, f"*{m}source.pi")
-        pi_fn = glob.glob(pi_dir)
+        pi_fn = products.glob(obsid, spec_stem, None, f"*{m}source.pi")
         # Check if list is empty
         if len(pi_fn) == 0:
             msg = f"ObsID {obsid} does not have a {m} observation, looking in directory {pi_dir}"
@@ -116,7 +150,7 @@ def get_mode(base_data_dir, obsid, spec_stem, modes=("pc", "wt")):
             # TODO add logger
         else:
             # This is expected to be a one element list
-            livetimes[m] = get_livetime_from_spec(pi_fn[0])
+            livetimes[m] = index.livetimes(pi_fn[:1])[0]
 
     msg = f"Mode and livetime (sec): {livetimes}. If observations were conducted in both modes, use the larger livetime.\n"
     print(msg)
@@ -145,5 +179,12 @@ if __name__ == "__main__":
                     datefmt='%Y-%m-%d %H:%M:%S'
                     )
     
-    for obsid in oids:
-        get_mode(base_data_dir, obsid, spec_stem)
+    tracing.configure(cfg_filename)
+    with tracing.span("mode", tracing.STAGE):
+        # Find the spectra and read their headers in one go, so `get_mode` only looks them up
+        products = product_index.load(base_data_dir, oids)
+        index = header_index.HeaderIndex.for_base_data_dir(base_data_dir)
+        index.scan([fn for obsid in oids for fn in products.glob(obsid, spec_stem, None, "*source.pi")])
+
+        for obsid in oids:
+            get_mode(base_data_dir, obsid, spec_stem, index=index, products=products)
@@ -0,0 +1,358 @@
+"""
+Watch mode: process every ObsID as soon as its data products arrive, for a lightcurve point minutes after the data lands.
+
+    python watch.py --cfg_fn default_config.cfg [--drop_dir DROP_DIR]
+
+BASE_DATA_DIR is polled every WATCH_INTERVAL seconds for new or changed {OID}/{SPEC_STEM}.zip files (and DROP_DIR, if given, for {OID}.zip
+files, which are moved to {BASE_DATA_DIR}/{OID}/{SPEC_STEM}.zip). A zip file is only taken once its size and modification time have not
+changed for WATCH_SETTLE seconds, so a file still being downloaded or copied is not read, and a burst of arrivals is taken in one go.
+For just that ObsID, `process_oid()` then
+    1. unpacks the products (unpack.py),
+    2. picks the mode with the longest livetime, as `utils.get_mode()` reports it,
+    3. groups its spectrum (grouping.py),
+    4. fits every model in one XSpec session (fit_scheduler.py; unless its inputs did not change, see fit_cache.py), and adds the results
+       to the results store,
+    5. adds its points to the lightcurve (`analyse_output.lightcurve_plt(..., incremental=True)`), after making the plots of its fits if
+       FIT_PLOTS="python" (xspec_plots.py).
+
+The ObsIDs are queued in a bounded queue of WATCH_QUEUE_SIZE ObsIDs, processed by WATCH_WORKERS threads (each runs one XSpec session at a
+time), so a burst of arrivals never runs more fits at once than the node has room for; while the queue is full, new arrivals wait on disk.
+The size and modification time of every zip file processed is saved in {BASE_DATA_DIR}/_watch_state.json, so a restarted watcher does not
+process them again. Stop it with Ctrl-C: the ObsIDs being processed are finished first.
+"""
+
+
+import argparse
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+import analyse_output
+import fit_cache
+import fit_scheduler
+import grouping
+import product_index
+import results_store
+import tracing
+import unpack
+import utils
+import xspec_plots
+from models import MODELS
+
+
+STATE_FN = "_watch_state.json"
+
+# Seconds between polls
+INTERVAL = 30.
+
+# Seconds that the size and modification time of a zip file must stay the same before it is processed
+SETTLE = 60.
+
+# Number of ObsIDs waiting to be processed at most; the others wait on disk
+QUEUE_SIZE = 8
+
+# Modes looked for in the products of each ObsID
+WATCH_MODES = ("pc", "wt")
+
+
+def _signature(path):
+    """(size, modification time) of `path`, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class Watcher:
+    """Finds the zip files in `base_data_dir` (and `drop_dir`) that are new or changed and have settled, and queues their ObsIDs.
+
+    Parameters
+    ----------
+    settle : float
+        Seconds that a zip file must stay unchanged before it is queued
+    queue_size : int
+        Maximum number of ObsIDs queued and not yet processed
+    """
+
+    def __init__(self, base_data_dir, spec_stem, drop_dir=None, settle=SETTLE, queue_size=QUEUE_SIZE):
+        self.base_data_dir, self.spec_stem, self.drop_dir, self.settle = base_data_dir, spec_stem, drop_dir, settle
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.state_fn = os.path.join(base_data_dir, STATE_FN)
+        # Signature of the zip file of each ObsID when it was processed
+        self.done = {}
+        if os.path.exists(self.state_fn):
+            try:
+                with open(self.state_fn, 'r') as f:
+                    self.done = {oid: tuple(sig) for oid, sig in json.load(f).items()}
+            except (OSError, ValueError) as e:
+                # Every ObsID is processed again rather than none
+                msg = f"Unreadable watch state {self.state_fn} ({e}); starting from an empty state."
+                print(msg)
+                logging.warning(msg)
+        # ObsIDs seen but not yet settled: signature of their zip file, and when it was first seen with that signature
+        self.pending = {}
+        # ObsIDs queued or being processed
+        self.active = set()
+        self._lock = threading.Lock()
+
+    def _fn_zip(self, oid):
+        return os.path.join(self.base_data_dir, oid, f"{self.spec_stem}.zip")
+
+    def _save(self):
+        # Called with self._lock held; a temporary file of its own per process, as in header_index.py
+        tmp = f"{self.state_fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.done, f)
+        os.replace(tmp, self.state_fn)
+
+    def mark_done(self, oid, signature):
+        """Record that the zip file of `oid`, with `signature`, was processed"""
+        with self._lock:
+            self.done[oid] = signature
+            self.active.discard(oid)
+            self._save()
+
+    def mark_existing(self):
+        """Record every zip file already in `base_data_dir` as processed, e.g. when the batch workflow was run on them"""
+        with self._lock:
+            for oid in self._oids():
+                self.done[oid] = _signature(self._fn_zip(oid))
+            self._save()
+
+    def _move_drops(self):
+        """Move the settled {OID}.zip files of `drop_dir` to {base_data_dir}/{OID}/{spec_stem}.zip"""
+        with os.scandir(self.drop_dir) as it:
+            drops = [entry.name for entry in it if entry.is_file() and entry.name.endswith(".zip")]
+        now = time.monotonic()
+        for name in drops:
+            oid = name[:-len(".zip")]
+            if not oid.isdigit():
+                continue
+            path = os.path.join(self.drop_dir, name)
+            if not self._settled(("drop", oid), _signature(path), now):
+                continue
+            os.makedirs(os.path.join(self.base_data_dir, oid), exist_ok=True)
+            # Across filesystems this copies, so the zip file is first written next to its destination, and only appears complete
+            tmp = f"{self._fn_zip(oid)}.tmp"
+            shutil.move(path, tmp)
+            os.replace(tmp, self._fn_zip(oid))
+            msg = f"Moved {path} to {self._fn_zip(oid)}"
+            print(msg)
+            logging.info(msg)
+
+    def _oids(self):
+        """ObsIDs in `base_data_dir` that have a zip file"""
+        with os.scandir(self.base_data_dir) as it:
+            oid_dirs = [entry.name for entry in it if entry.name.isdigit() and entry.is_dir()]
+        return [oid for oid in oid_dirs if os.path.isfile(self._fn_zip(oid))]
+
+    def _settled(self, key, signature, now):
+        """Whether `signature` of `key` has not changed for `self.settle` seconds"""
+        if signature is None:
+            self.pending.pop(key, None)
+            return False
+        if key not in self.pending or self.pending[key][0] != signature:
+            self.pending[key] = (signature, now)
+        if now - self.pending[key][1] < self.settle:
+            return False
+        del self.pending[key]
+        return True
+
+    def poll(self):
+        """Queue the ObsIDs whose zip file is new or changed since it was processed, and has settled.
+        ObsIDs that do not fit in the queue are left for the next poll.
+
+        Returns
+        -------
+        queued : list[str]
+            ObsIDs queued by this poll
+        """
+
+        if self.drop_dir is not None:
+            self._move_drops()
+        now = time.monotonic()
+        queued = []
+        for oid in self._oids():
+            signature = _signature(self._fn_zip(oid))
+            with self._lock:
+                if oid in self.active or self.done.get(oid) == signature:
+                    continue
+            if not self._settled(oid, signature, now):
+                continue
+            # Active before it is queued, since a worker may be done with it before put_nowait() returns
+            with self._lock:
+                self.active.add(oid)
+            try:
+                self.queue.put_nowait((oid, signature))
+            except queue.Full:
+                # Seen again, and settled straight away, at the next poll
+                with self._lock:
+                    self.active.discard(oid)
+                self.pending[oid] = (signature, now - self.settle)
+                continue
+            queued.append(oid)
+
+        return queued
+
+
+def process_oid(oid, variables, base_data_dir, spec_stem, model_names=MODELS, members=unpack.DEFAULT_MEMBERS, variants=grouping.DEFAULT_VARIANTS,
+                timeout=None, retries=1, cache=None):
+    """Unpack, group, fit and store ObsID `oid`, whose products are in {base_data_dir}/{oid}/{spec_stem}.zip.
+    The lightcurve is not made here, since the workers share it; see `worker()`. Models whose inputs did not change are taken from `cache`
+    (a fit_cache.FitCache), if given, rather than fitted.
+
+    Returns
+    -------
+    task : fit_scheduler.FitTask or None
+        Outcome of the fits, or None if there was no spectrum to fit
+    """
+
+    with tracing.span("unpack", "watch", oid=oid):
+        unpack.unpack_oid(base_data_dir, oid, spec_stem, members=members)
+    products = product_index.for_oid(base_data_dir, oid)
+    ddir = products.data_dir(oid, spec_stem)
+    if ddir is None:
+        msg = f"ObsID {oid}: expected one USERPROD*/{spec_stem} directory after unpacking"
+        print(msg)
+        logging.error(msg)
+        return None
+
+    livetimes = utils.get_mode(base_data_dir, oid, spec_stem, WATCH_MODES, products=products)
+    if not livetimes:
+        msg = f"ObsID {oid}: no spectrum in {ddir}"
+        print(msg)
+        logging.error(msg)
+        return None
+    # The longer observation, as get_mode() advises
+    mode = max(livetimes, key=livetimes.get)
+
+    with tracing.span("group", "watch", oid=oid):
+        grouping.group_spectrum(ddir, oid, mode, variants)
+    # The grouped spectra were added to the data directory
+    products.refresh([oid])
+
+    log_dir = os.path.join(base_data_dir, "_fit_logs")
+    os.makedirs(log_dir, exist_ok=True)
+    os.makedirs(utils.get_trash_dir(variables, base_data_dir), exist_ok=True)
+    task = fit_scheduler.FitTask(oid, mode, list(model_names))
+    tracing.run_traced("ObsID", "fit", {"oid": oid},
+                       fit_scheduler.run_task, task, variables, base_data_dir, spec_stem, log_dir, timeout, retries, products, cache)
+    products.refresh([oid])
+    con = results_store.connect(results_store.store_fn(base_data_dir))
+    try:
+        results_store.ingest_oid(con, base_data_dir, oid, spec_stem, task.models, clobber=True, products=products)
+    finally:
+        con.close()
+
+    return task
+
+
+def worker(watcher, lightcurve_lock, process_kwargs):
+    """Process the ObsIDs of `watcher.queue` until None is taken from it. The lightcurve is updated after each ObsID, one worker at a time."""
+    while True:
+        item = watcher.queue.get()
+        if item is None:
+            break
+        oid, signature = item
+        t_start = time.monotonic()
+        try:
+            with tracing.span("ObsID", "watch", oid=oid):
+                task = process_oid(oid, **process_kwargs)
+                with lightcurve_lock, tracing.span("lightcurve", "watch", oid=oid):
+                    if task is not None and process_kwargs["variables"].get("FIT_PLOTS") == "python":
+                        # Plots of the fits that XSpec did not make. pyplot is not thread safe, so this is done under the lock too
+                        xspec_plots.render_obsid(watcher.base_data_dir, oid, watcher.spec_stem, task.models, process_kwargs["variables"])
+                    analyse_output.lightcurve_plt(watcher.base_data_dir, incremental=True)
+                    # The watcher runs for days, so no figure is kept open
+                    analyse_output.plt.close("all")
+            status = "no spectrum" if task is None else task.status
+            msg = f"ObsID {oid}: {status} in {time.monotonic() - t_start:.1f} s"
+            print(msg)
+            logging.info(msg)
+        except Exception as err:
+            # One bad ObsID must not stop the worker. Its zip file is only tried again if it changes
+            msg = f"ObsID {oid} could not be processed: {err!r}"
+            print(msg)
+            logging.error(msg)
+        watcher.mark_done(oid, signature)
+
+
+def watch(watcher, process_kwargs, n_workers=1, interval=INTERVAL, once=False):
+    """Poll `watcher` every `interval` seconds and process the ObsIDs it queues with `n_workers` threads.
+    If `once`, stop when every ObsID found by the first poll is processed (after waiting for it to settle); otherwise run until interrupted."""
+
+    lightcurve_lock = threading.Lock()
+    threads = [threading.Thread(target=worker, args=(watcher, lightcurve_lock, process_kwargs), daemon=True) for _ in range(n_workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            queued = watcher.poll()
+            if queued:
+                msg = f"Queued ObsID(s) {', '.join(queued)}"
+                print(msg)
+                logging.info(msg)
+            if once and not watcher.pending and not queued:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopping: finishing the ObsIDs being processed")
+    finally:
+        # Workers stop at the first None, after the ObsIDs queued before it
+        for _ in threads:
+            watcher.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Watches for new data products and unpacks, groups, fits and adds each new ObsID to the lightcurve.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--drop_dir", type=str, default=None, help="Directory also watched for {OID}.zip files, which are moved into BASE_DATA_DIR")
+    parser.add_argument(
+        "--once", action="store_true", help="Process the zip files there now and stop, instead of watching")
+    parser.add_argument(
+        "--skip_existing", action="store_true", help="Do not process the zip files already there, e.g. when the batch workflow was run on them")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    variables = utils.read_cfg(cfg_filename)
+    members = variables.get("UNPACK_MEMBERS", unpack.DEFAULT_MEMBERS)
+    if isinstance(members, str):
+        members = [members]
+    variants = grouping.parse_variants(variables["GROUPING_VARIANTS"]) if "GROUPING_VARIANTS" in variables else grouping.DEFAULT_VARIANTS
+    timeout = variables.get("FIT_TIMEOUT")
+    # Each worker runs one XSpec session at a time
+    n_workers = variables.get("WATCH_WORKERS") or variables.get("FIT_WORKERS") or os.cpu_count()
+
+    logging.basicConfig(filename=os.path.join(base_data_dir, "_watch.log"),
+                        level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S'
+                        )
+    # Plots are only written to file
+    analyse_output.plt.switch_backend("Agg")
+    tracing.configure(cfg_filename)
+
+    watcher = Watcher(base_data_dir, spec_stem, args.drop_dir,
+                      settle=float(variables.get("WATCH_SETTLE") or SETTLE), queue_size=int(variables.get("WATCH_QUEUE_SIZE") or QUEUE_SIZE))
+    if args.skip_existing:
+        watcher.mark_existing()
+    process_kwargs = {"variables": variables, "base_data_dir": base_data_dir, "spec_stem": spec_stem, "members": members, "variants": variants,
+                      "timeout": float(timeout) if timeout else None, "retries": int(variables.get("FIT_RETRIES", 1)),
+                      "cache": fit_cache.FitCache.for_base_data_dir(base_data_dir, variables)}
+    msg = f"Watching {base_data_dir}{f' and {args.drop_dir}' if args.drop_dir else ''} with {n_workers} worker(s)"
+    print(msg)
+    logging.info(msg)
+    watch(watcher, process_kwargs, int(n_workers), float(variables.get("WATCH_INTERVAL") or INTERVAL), args.once)
@@ -0,0 +1,49 @@
+"""
+One command line entry point for every stage of the workflow:
+
+    xrt-workflow {download,unpack,index,mode,group,fit,plots,contours,analyse,flux,watch,campaign,trace} --cfg_fn CFG_FN
+
+(or `python xrt_workflow.py ...` from src/). Each subcommand runs the script of its stage exactly as `python {script}.py` would, with the
+same options; see e.g. `xrt-workflow fit --help`. A stage's script, and the libraries it needs (swifttools, astropy, matplotlib), are only
+imported when that stage is run, so the stages that do not plot start quickly.
+"""
+
+
+import argparse
+import runpy
+import sys
+
+
+# Subcommand is the key; the module run for it, and its help, are the value
+STAGES = {
+    "download": ("swifttools_ana", "Get the data products of every ObsID from the XRT product generator"),
+    "unpack": ("unpack", "Unzip and untar the data products"),
+    "index": ("product_index", "Index the products of every ObsID, and export their directories for the shell scripts"),
+    "mode": ("utils", "Livetime of each mode (PC/WT) of every ObsID, to choose the mode"),
+    "group": ("grouping", "Group the spectra for chi-squared statistics"),
+    "fit": ("fit_scheduler", "Fit every ObsID with every XSpec model"),
+    "plots": ("xspec_plots", "Plots of every fit made from its tables, when XSpec does not make them (FIT_PLOTS)"),
+    "contours": ("contours", "Confidence contours of pairs of parameters of every fit, from XSpec's steppar run in parallel chunks"),
+    "analyse": ("analyse_output", "Plot the SEDs and lightcurve to compare the models"),
+    "flux": ("flux_engine", "Fluxes of every fit in another energy band, without fitting again"),
+    "watch": ("watch", "Unpack, group, fit and add to the lightcurve every new ObsID as its data arrives"),
+    "campaign": ("campaign", "Fit the ObsIDs of many targets, one config file each, through one pool of workers"),
+    "trace": ("tracing", "Time spent in each stage, and the slowest ObsIDs and models"),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="xrt-workflow", description="Swift-XRT workflow. Every stage reads the config file given by --cfg_fn.")
+    subparsers = parser.add_subparsers(dest="stage", required=True, metavar="STAGE")
+    for name, (module, help) in STAGES.items():
+        # --help is left to the stage's own parser
+        subparsers.add_parser(name, help=help, add_help=False)
+    args, rest = parser.parse_known_args(argv)
+
+    # The stage's parser reads the rest of the command line
+    sys.argv = [sys.argv[0], *rest]
+    runpy.run_module(STAGES[args.stage][0], run_name="__main__", alter_sys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+The plots of each fit that XSpec makes (resid.png, eflux.png, phflux.png), made in Python from the tables of the fit instead.
+
+With FIT_PLOTS="python" in the config file, the XSpec session only fits and writes the tables (spec_default_bin.dat, the unfolded spectrum
+and model, and resid_tbl.dat, the residuals, each extracted once), on the null plot device, so it is shorter and needs no X display.
+Then
+
+    python xspec_plots.py --cfg_fn default_config.cfg
+
+makes the plots of every ObsID and model, across a pool of processes, in the same files:
+    * resid.png: data - model with the default binning
+    * eflux.png: E^2 dN/dE of the model (top), and of the unfolded spectrum with REBIN bins combined into one (bottom)
+    * phflux.png: dN/dE of the unfolded spectrum and the model, with REBIN bins combined into one
+Only the plots that are missing or older than their tables are made (all of them with --clobber), so this does nothing after sessions that
+made the plots in XSpec. With FIT_PLOTS="none", no plots are made.
+
+XSpec's `setplot rebin 100000 5` combines channels before unfolding; here the unfolded bins are combined, weighted by their width,
+so the rebinned points are close to but not exactly XSpec's.
+"""
+
+
+import matplotlib.pyplot as plt
+import numpy as np
+import argparse
+import concurrent.futures
+import logging
+import os
+
+import analyse_output
+import models
+import product_index
+import read_output
+import tracing
+import utils
+
+
+# Number of bins combined into one in eflux.png and phflux.png, as `setplot rebin 100000 5` does in XSpec
+REBIN = 5
+
+# Figure that a rendering worker draws every one of its plots on, and the product index it finds the fits in, see `_init_worker()`
+_FIG = None
+_PRODUCTS = None
+
+
+def rebin(energy, energy_half_bin_width, y, y_err, n=REBIN):
+    """Combine every `n` adjacent bins into one (the last one may have fewer): the width-weighted mean of `y`, and its error.
+
+    Returns
+    -------
+    energy, energy_half_bin_width, y, y_err : np.ndarray
+        Of the combined bins
+    """
+
+    starts = np.arange(0, len(energy), n)
+    lo, hi = energy - energy_half_bin_width, energy + energy_half_bin_width
+    width = 2 * energy_half_bin_width
+    sum_width = np.add.reduceat(width, starts)
+    new_lo, new_hi = np.minimum.reduceat(lo, starts), np.maximum.reduceat(hi, starts)
+    new_y = np.add.reduceat(width * y, starts) / sum_width
+    new_err = np.sqrt(np.add.reduceat((width * y_err) ** 2, starts)) / sum_width
+
+    return 0.5 * (new_lo + new_hi), 0.5 * (new_hi - new_lo), new_y, new_err
+
+
+def _new_figure(fig, nrows=1):
+    if fig is None:
+        fig = plt.figure()
+    fig.clf()
+    axes = fig.subplots(nrows, 1, sharex=True, squeeze=False)[:, 0]
+    for ax in axes:
+        ax.set_xscale("log")
+        ax.set_xlim(*models.E_NOTICE)
+    axes[-1].set_xlabel("Energy [keV]")
+    return fig, axes
+
+
+def plot_resid(fn_resid, fn_png, title="", fig=None):
+    """resid.png: data - model (counts/s/keV) with the default binning, from `fn_resid` (resid_tbl.dat)"""
+    energy, energy_half_bin_width, resid, resid_err = read_output.read_resid_tbl(fn_resid)
+    fig, (ax,) = _new_figure(fig)
+    ax.errorbar(energy, resid, xerr=energy_half_bin_width, yerr=resid_err, ls=" ", marker=".", capsize=0)
+    ax.axhline(0., color="k", lw=1)
+    ax.set_ylabel("Data - model [counts/s/keV]")
+    ax.set_title(title)
+    fig.savefig(fn_png, bbox_inches="tight")
+
+
+def plot_eflux(fn_sed, fn_png, title="", fig=None):
+    """eflux.png: E^2 dN/dE (keV/cm^2/s) of the model, and of the unfolded spectrum rebinned, from `fn_sed` (spec_default_bin.dat)"""
+    energy, energy_half_bin_width, eflux, eflux_err, mdl_eflux = read_output.read_tcloutr_spec_data(fn_sed)
+    fig, (ax_model, ax_data) = _new_figure(fig, 2)
+    ax_model.step(energy, mdl_eflux, where="mid")
+    ax_model.set_yscale("log")
+    ax_model.set_ylabel(r"Model E$^2$dN/dE" + "\n" + r"[keV/cm$^2$/s]")
+    ax_model.set_title(title)
+    e, e_half, y, y_err = rebin(energy, energy_half_bin_width, eflux, eflux_err)
+    ax_data.errorbar(e, y, xerr=e_half, yerr=y_err, ls=" ", marker=".", capsize=0)
+    ax_data.step(energy, mdl_eflux, where="mid", alpha=0.5)
+    ax_data.set_yscale("log")
+    ax_data.set_ylabel(r"E$^2$dN/dE" + "\n" + r"[keV/cm$^2$/s]")
+    fig.savefig(fn_png, bbox_inches="tight")
+
+
+def plot_phflux(fn_sed, fn_png, title="", fig=None):
+    """phflux.png: dN/dE (ph/cm^2/s/keV) of the unfolded spectrum rebinned, and of the model, from `fn_sed` (spec_default_bin.dat)"""
+    energy, energy_half_bin_width, eflux, eflux_err, mdl_eflux = read_output.read_tcloutr_spec_data(fn_sed)
+    # E^2 dN/dE to dN/dE
+    e2 = energy ** 2
+    fig, (ax,) = _new_figure(fig)
+    e, e_half, y, y_err = rebin(energy, energy_half_bin_width, eflux / e2, eflux_err / e2)
+    ax.errorbar(e, y, xerr=e_half, yerr=y_err, ls=" ", marker=".", capsize=0)
+    ax.step(energy, mdl_eflux / e2, where="mid", alpha=0.5)
+    ax.set_yscale("log")
+    ax.set_ylabel(r"dN/dE [ph/cm$^2$/s/keV]")
+    ax.set_title(title)
+    fig.savefig(fn_png, bbox_inches="tight")
+
+
+def render_model(outdir, model_name, variables=None, clobber=False, title="", fig=None):
+    """Make the plots of the fit of `model_name` in `outdir` that are missing or older than their table (all of them if `clobber`).
+
+    Returns
+    -------
+    written : list[str]
+        Plots written
+    """
+
+    out = models.output_paths(os.path.dirname(outdir), model_name, variables)
+    title = f"{title}{models.REGISTRY[model_name].description}"
+    written = []
+    for plot, fn_tbl, func in ((out["PLT_RESID"], out["RESID_TBL"], plot_resid),
+                               (out["PLT_EFLUX"], out["UNBINNED_DATA_TBL"], plot_eflux),
+                               (out["PLT_PHFLUX"], out["UNBINNED_DATA_TBL"], plot_phflux)):
+        # quickfit.py writes no spectral tables
+        if not os.path.exists(fn_tbl) or os.path.getsize(fn_tbl) == 0:
+            continue
+        if clobber or analyse_output.plot_is_stale(plot, [fn_tbl]):
+            func(fn_tbl, plot, title, fig)
+            written.append(plot)
+    return written
+
+
+def render_obsid(base_data_dir, oid, spec_stem, model_list=models.MODELS, variables=None, clobber=False, products=None, fig=None):
+    """`render_model()` for every model in `model_list` fitted to ObsID `oid`, in this process. The fits are found in `products`
+    (a product_index.ProductIndex); by default, the directories of `oid` are listed. The plots are drawn on `fig` if given, otherwise
+    on a new figure that is closed at the end.
+
+    Returns
+    -------
+    written : list[str]
+        Plots written
+    """
+
+    if products is None:
+        products = product_index.for_oid(base_data_dir, oid)
+    new_fig = fig is None
+    if new_fig:
+        fig = plt.figure(figsize=(10, 8))
+    written = []
+    try:
+        for model_name in model_list:
+            for outdir in products.data_dirs(oid, spec_stem, model_name):
+                written += render_model(outdir, model_name, variables, clobber, f"ObsID {oid}: ", fig)
+    finally:
+        if new_fig:
+            plt.close(fig)
+    return written
+
+
+def _init_worker(log_fn=None, products=None):
+    """Set up a rendering process once: the headless Agg backend, the figure reused for all its plots, and the product index"""
+    global _FIG, _PRODUCTS
+    _PRODUCTS = products
+    if log_fn is not None and not logging.getLogger().handlers:
+        logging.basicConfig(filename=log_fn, level=logging.INFO, format='%(levelname)s - %(funcName)s - %(message)s')
+    plt.switch_backend("Agg")
+    plt.style.use('tableau-colorblind10')
+    _FIG = plt.figure(figsize=(10, 8))
+
+
+def _render_obsid(base_data_dir, oid, spec_stem, model_list, variables, clobber):
+    return render_obsid(base_data_dir, oid, spec_stem, model_list, variables, clobber, _PRODUCTS, _FIG)
+
+
+def render_all(base_data_dir, oids, spec_stem, model_list=models.MODELS, variables=None, clobber=False, max_workers=None, log_fn=None,
+               products=None):
+    """`render_model()` for every model in `model_list` fitted to every ObsID in `oids`, across a pool of `max_workers` processes
+    (default: number of CPUs). The fits are found in `products` (a product_index.ProductIndex); by default, the index cached in
+    `base_data_dir`, refreshed for `oids`.
+
+    Returns
+    -------
+    written : list[str]
+        Plots written
+    """
+
+    if products is None:
+        products = product_index.load(base_data_dir, oids)
+
+    written = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_init_worker,
+                                                initargs=(log_fn, products)) as pool:
+        futures = {pool.submit(tracing.run_traced, "plot", "plots", {"oid": oid}, _render_obsid, base_data_dir, oid, spec_stem, model_list, variables,
+                               clobber): oid
+                   for oid in oids}
+        for future in concurrent.futures.as_completed(futures):
+            # One bad ObsID should not stop the plots of the others
+            try:
+                written += future.result()
+            except Exception as err:
+                msg = f"Could not plot the fits of ObsID {futures[future]}: {err!r}"
+                print(msg)
+                logging.error(msg)
+
+    return written
+
+
+if __name__ == "__main__":
+    # There is one command line argument: the name of the config file
+    parser = argparse.ArgumentParser(description="Makes the plots of every fit from its tables, when FIT_PLOTS='python' in the config file.")
+    # *Optional* argument with default
+    parser.add_argument(
+        "--cfg_fn", type=str, default="default_config.cfg", help="Config filename formatted as in the default; see that file for example.")
+    parser.add_argument(
+        "--models", nargs="+", default=models.MODELS, help="Models whose plots are made, from the registry in models.py")
+    parser.add_argument(
+        "--clobber", action="store_true", help="Make every plot again, even if it is newer than its table")
+    parser.add_argument(
+        "--max_workers", type=int, default=None, help="Number of processes making plots (default: number of CPUs)")
+    args = parser.parse_args()
+    cfg_filename = args.cfg_fn
+
+    oids, email, base_data_dir, spec_stem, targ_name = utils.load_cfg(cfg_filename)
+    variables = utils.read_cfg(cfg_filename)
+    if (variables.get("FIT_PLOTS") or models.FIT_PLOTS[0]) == "none":
+        print("FIT_PLOTS is 'none' in the config file: no plots are made")
+        raise SystemExit
+
+    log_fn = os.path.join(base_data_dir, "_xspec_plots.log")
+    logging.basicConfig(filename=log_fn,
+                        level=logging.INFO,
+                        format='%(levelname)s - %(funcName)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S'
+                        )
+
+    tracing.configure(cfg_filename)
+    with tracing.span("plots", tracing.STAGE):
+        written = render_all(base_data_dir, oids, spec_stem, args.models, variables, args.clobber, args.max_workers, log_fn)
+    msg = f"Wrote {len(written)} plot(s)"
+    print(msg)
+    logging.info(msg)
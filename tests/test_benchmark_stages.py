@@ -0,0 +1,198 @@
+"""
+Timings of each analysis stage on synthetic datasets (synthetic.py) of many ObsIDs, with pytest-benchmark.
+The sizes are the numbers of ObsIDs in $XRT_BENCHMARK_N_OIDS (default: 10, so that the test suite stays quick), e.g.
+
+    XRT_BENCHMARK_N_OIDS="10 1000 10000" python -m pytest tests/test_benchmark_stages.py --benchmark-only --benchmark-autosave
+
+Each dataset is written to synthetic.SYNTHETIC_DIR the first time, and reused. To catch regressions, compare with the last saved run:
+
+    python -m pytest tests/test_benchmark_stages.py --benchmark-only --benchmark-compare --benchmark-compare-fail=min:50%
+
+Stages that start from nothing cached ("cold") have their caches removed before each round.
+"""
+
+
+import glob
+import os
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import analyse_output
+import fit_cache
+import header_index
+import models
+import product_index
+import read_output
+import results_store
+import synthetic
+import utils
+
+
+N_OIDS = [int(n) for n in os.environ.get("XRT_BENCHMARK_N_OIDS", "10").split()]
+
+# Rounds of the stages that are set up before each round
+COLD_ROUNDS = 3
+
+
+class Dataset:
+    """Synthetic dataset of `n_oids` ObsIDs, written if it does not exist yet"""
+
+    def __init__(self, n_oids):
+        fn_cfg = os.path.join(synthetic.dataset_dir(n_oids), synthetic.CFG_FN)
+        if not os.path.exists(fn_cfg):
+            synthetic.make_dataset(os.path.dirname(fn_cfg), n_oids)
+        self.oids, email, self.base_data_dir, self.spec_stem, targ_name = utils.load_cfg(fn_cfg)
+        # The synthetic config file has none of the XSpec variables that the fit commands use
+        self.variables = {"NH_TBABS": "0.157", "REDSHIFT": "0.45", **utils.read_cfg(fn_cfg)}
+        modes = self.variables["MODES"]
+        self.modes = modes if isinstance(modes, list) else [modes]
+        self.pattern = os.path.join(self.base_data_dir, "*", "USERPROD*", self.spec_stem, "*", "{}")
+        self.fn_store = os.path.join(self.base_data_dir, "_benchmark.sqlite")
+
+    def path(self, fn):
+        return os.path.join(self.base_data_dir, fn)
+
+    def remove(self, *fns):
+        for fn in fns:
+            if os.path.exists(self.path(fn)):
+                os.remove(self.path(fn))
+
+
+@pytest.fixture(scope="module", params=N_OIDS, ids=lambda n: f"{n}_oids")
+def dataset(request):
+    return Dataset(request.param)
+
+
+def _cold(benchmark, func, setup):
+    benchmark.pedantic(func, setup=setup, rounds=COLD_ROUNDS)
+
+
+def test_glob_param_tbl(benchmark, dataset):
+    benchmark(glob.glob, dataset.pattern.format("param_tbl.dat"))
+
+
+def test_product_index_cold(benchmark, dataset):
+    _cold(benchmark, lambda: product_index.load(dataset.base_data_dir), lambda: dataset.remove(product_index.INDEX_FN))
+
+
+def test_product_index_refresh(benchmark, dataset):
+    product_index.load(dataset.base_data_dir)
+    benchmark(product_index.load, dataset.base_data_dir)
+
+
+def test_product_index_param_tbl(benchmark, dataset):
+    benchmark(lambda: product_index.load(dataset.base_data_dir).glob("*", dataset.spec_stem, "*", "param_tbl.dat"))
+
+
+def _get_modes(dataset):
+    """As `python utils.py` does: all the spectra are found, and their headers indexed, first"""
+    products = product_index.load(dataset.base_data_dir, dataset.oids)
+    index = header_index.HeaderIndex.for_base_data_dir(dataset.base_data_dir)
+    index.scan([fn for oid in dataset.oids for fn in products.glob(oid, dataset.spec_stem, None, "*source.pi")])
+    for oid in dataset.oids:
+        utils.get_mode(dataset.base_data_dir, oid, dataset.spec_stem, index=index, products=products)
+
+
+def test_get_mode_cold(benchmark, dataset):
+    _cold(benchmark, lambda: _get_modes(dataset), lambda: dataset.remove(header_index.INDEX_FN))
+
+
+def test_get_mode(benchmark, dataset):
+    benchmark(_get_modes, dataset)
+
+
+def test_lightcurve_tbl(benchmark, dataset):
+    _cold(benchmark, lambda: analyse_output.lightcurve_tbl(dataset.base_data_dir, "lightcurve.csv"),
+          lambda: dataset.remove(f"lightcurve.csv{analyse_output.LIGHTCURVE_STATE_SUFFIX}"))
+
+
+def test_lightcurve_tbl_incremental_cold(benchmark, dataset):
+    _cold(benchmark, lambda: analyse_output.lightcurve_tbl(dataset.base_data_dir, "lightcurve.csv", True),
+          lambda: dataset.remove(f"lightcurve.csv{analyse_output.LIGHTCURVE_STATE_SUFFIX}"))
+
+
+def test_lightcurve_tbl_incremental(benchmark, dataset):
+    analyse_output.lightcurve_tbl(dataset.base_data_dir, "lightcurve.csv", True)
+    benchmark(analyse_output.lightcurve_tbl, dataset.base_data_dir, "lightcurve.csv", True)
+
+
+def test_read_param_tbl(benchmark, dataset):
+    fns = glob.glob(dataset.pattern.format("param_tbl.dat"))
+    benchmark(lambda: [read_output.read_param_tbl(fn) for fn in fns])
+
+
+def test_read_stat_tbl(benchmark, dataset):
+    fns = glob.glob(dataset.pattern.format("stat_tbl.dat"))
+    benchmark(lambda: [read_output.read_stat_tbl(fn) for fn in fns])
+
+
+def test_load_model_spectra(benchmark, dataset):
+    benchmark(lambda: [read_output.load_model_spectra(dataset.base_data_dir, m, dataset.spec_stem) for m in models.MODELS])
+
+
+@pytest.mark.parametrize("view", analyse_output.SED_VIEWS[1:])
+def test_sed_aggregate(benchmark, dataset, view):
+    # Plotted to a file, with as many artists whatever the number of ObsIDs
+    analyse_output.plt.switch_backend("Agg")
+    benchmark(analyse_output.plot_sed_aggregate, dataset.base_data_dir, dataset.oids, dataset.spec_stem, "powlaw_tbabs", view)
+    analyse_output.plt.close("all")
+
+
+def _ingest(dataset):
+    con = results_store.connect(dataset.fn_store)
+    products = product_index.load(dataset.base_data_dir, dataset.oids)
+    for oid in dataset.oids:
+        results_store.ingest_oid(con, dataset.base_data_dir, oid, dataset.spec_stem, products=products)
+    con.close()
+
+
+@pytest.fixture(scope="module")
+def results(dataset):
+    """Results store of `dataset`"""
+    dataset.remove(dataset.fn_store)
+    _ingest(dataset)
+    yield dataset.fn_store
+    dataset.remove(dataset.fn_store)
+
+
+def test_results_store_ingest(benchmark, dataset):
+    _cold(benchmark, lambda: _ingest(dataset), lambda: dataset.remove(dataset.fn_store))
+
+
+def test_query_params(benchmark, results):
+    benchmark(lambda: [read_output.query_params(results, m, "norm") for m in models.MODELS])
+
+
+def test_query_failed_fits(benchmark, results):
+    benchmark(read_output.query_failed_fits, results, read_output.ERR_HARD_LIMIT)
+
+
+@pytest.fixture
+def cache(dataset, tmp_path):
+    """Empty fit cache for the fits of `dataset`; the keys written next to the fits are removed afterwards"""
+    yield fit_cache.FitCache(str(tmp_path / "fit_cache"), dataset.variables)
+    for fn in glob.glob(dataset.pattern.format(fit_cache.KEY_FN)):
+        os.remove(fn)
+
+
+def _fit_cache_store(dataset, cache):
+    products = product_index.load(dataset.base_data_dir, dataset.oids)
+    for oid, mode in zip(dataset.oids, dataset.modes):
+        ddir = products.data_dir(oid, dataset.spec_stem)
+        for model, key in cache.keys(ddir, oid, mode, models.MODELS).items():
+            cache.store(os.path.join(ddir, model), model, key)
+    cache.save_hashes()
+
+
+def test_fit_cache_store(benchmark, dataset, cache):
+    benchmark.pedantic(_fit_cache_store, args=(dataset, cache), rounds=1)
+
+
+def test_fit_cache_lookup(benchmark, dataset, cache):
+    # As a rerun of fit_scheduler.py with nothing changed: the key of every fit, and no fit run
+    _fit_cache_store(dataset, cache)
+    products = product_index.load(dataset.base_data_dir, dataset.oids)
+    benchmark(lambda: [cache.lookup(products.data_dir(oid, dataset.spec_stem), oid, mode, models.MODELS)
+                       for oid, mode in zip(dataset.oids, dataset.modes)])
@@ -0,0 +1,56 @@
+"""
+campaign.run_campaign() on a copy of default_output, with fit_scheduler.run_task() replaced so that no XSpec is needed.
+"""
+
+
+import os
+import shutil
+
+import pytest
+
+import campaign
+import fit_scheduler
+
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "..", "default_output")
+
+CFG_FN = os.path.join(os.path.dirname(__file__), "..", "src", "default_config.cfg")
+
+OIDS = ("00032646038", "00032646039")
+
+
+@pytest.fixture
+def cfg_fn(tmp_path, monkeypatch):
+    """Config file of default_output copied to tmp_path, without its lightcurve or any cached index"""
+    base_data_dir = tmp_path / "data"
+    shutil.copytree(DEFAULT_OUTPUT, base_data_dir)
+    for fn in base_data_dir.glob("lightcurve*"):
+        os.remove(fn)
+    monkeypatch.delenv("XRT_TRACE_FN", raising=False)
+    fn = tmp_path / "campaign.cfg"
+    with open(CFG_FN) as f:
+        cfg = f.read()
+    # read_cfg() keeps the last declaration of a variable
+    fn.write_text(cfg + f'\nBASE_DATA_DIR="{base_data_dir}"\n')
+    return str(fn)
+
+
+def _run_task(task, *args, **kwargs):
+    # As if XSpec could not be found for the first ObsID; the other keeps its fits in default_output
+    if task.oid == OIDS[0]:
+        raise FileNotFoundError(2, "No such file or directory", "xspec")
+    task.status = "done"
+    return task
+
+
+def test_failed_task_does_not_stop_campaign(cfg_fn, monkeypatch):
+    monkeypatch.setattr(fit_scheduler, "run_task", _run_task)
+    targets = campaign.load_targets([cfg_fn], use_cache=False)
+    campaign.run_campaign(targets, max_workers=2, lightcurve=True)
+    tasks = {t.oid: t for t in targets[0].tasks}
+    assert (tasks[OIDS[0]].status, tasks[OIDS[0]].failed_models) == ("failed", tasks[OIDS[0]].models)
+    assert tasks[OIDS[1]].status == "done"
+    # The lightcurve has the fits of every ObsID in BASE_DATA_DIR, though there was no cached index of its products
+    with open(os.path.join(targets[0].base_data_dir, "lightcurve.csv")) as f:
+        mjds = {line.split(",")[0] for line in f.read().splitlines()[1:]}
+    assert len(mjds) == len(OIDS)
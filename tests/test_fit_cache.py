@@ -0,0 +1,74 @@
+"""
+Keys of fit_cache.FitCache for the grouped spectra in default_output, copied to other directories.
+"""
+
+
+import hashlib
+import os
+import shutil
+import time
+
+from astropy.io import fits
+import pytest
+
+import fit_cache
+import utils
+
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "..", "default_output")
+
+CFG_FN = os.path.join(os.path.dirname(__file__), "..", "src", "default_config.cfg")
+
+OID, MODE, USERPROD = "00032646038", "wt", "USERPROD_224850"
+
+MODEL_NAMES = ["powlaw_tbabs", "logpar_tbabs"]
+
+
+def _copy(base_data_dir):
+    """Data directory of OID copied to `base_data_dir`, with the paths in its grouped spectrum pointing there, as grouping.py writes them"""
+    ddir = os.path.join(base_data_dir, OID, USERPROD, "spec")
+    shutil.copytree(os.path.join(DEFAULT_OUTPUT, OID, USERPROD, "spec"), ddir)
+    fn_grp = fit_cache.input_files(ddir, OID, MODE)[0]
+    with fits.open(fn_grp, mode="update") as hdul:
+        for k, fn in zip(fit_cache.PATH_KEYWORDS, fit_cache.input_files(ddir, OID, MODE)[1:]):
+            hdul["SPECTRUM"].header[k] = fn
+    return ddir
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return fit_cache.FitCache(str(tmp_path / "fit_cache"), utils.read_cfg(CFG_FN))
+
+
+def test_key_independent_of_location(cache, tmp_path):
+    ddir_1 = _copy(str(tmp_path / "data_1"))
+    # astropy stamps the time in the comments of the checksums that it updates, so the copies are written in different seconds
+    time.sleep(1.1)
+    ddir_2 = _copy(str(tmp_path / "a" / "much" / "longer" / "data_2"))
+    fn_grp_1, fn_grp_2 = fit_cache.input_files(ddir_1, OID, MODE)[0], fit_cache.input_files(ddir_2, OID, MODE)[0]
+    # The files differ by the paths that they hold, and by the times of their checksums
+    with open(fn_grp_1, 'rb') as f1, open(fn_grp_2, 'rb') as f2:
+        assert hashlib.sha256(f1.read()).digest() != hashlib.sha256(f2.read()).digest()
+    assert cache.keys(ddir_1, OID, MODE, MODEL_NAMES) == cache.keys(ddir_2, OID, MODE, MODEL_NAMES)
+
+
+def test_key_changes_with_data(cache, tmp_path):
+    ddir_1, ddir_2 = _copy(str(tmp_path / "data_1")), _copy(str(tmp_path / "data_2"))
+    keys = cache.keys(ddir_1, OID, MODE, MODEL_NAMES)
+    with fits.open(fit_cache.input_files(ddir_2, OID, MODE)[0], mode="update") as hdul:
+        hdul["SPECTRUM"].data["COUNTS"][100] += 1
+    assert cache.keys(ddir_2, OID, MODE, MODEL_NAMES)["powlaw_tbabs"] != keys["powlaw_tbabs"]
+    with fits.open(fit_cache.input_files(ddir_1, OID, MODE)[0], mode="update") as hdul:
+        hdul["SPECTRUM"].header["EXPOSURE"] *= 2
+    assert cache.keys(ddir_1, OID, MODE, MODEL_NAMES)["powlaw_tbabs"] != keys["powlaw_tbabs"]
+    # The background spectrum is hashed as it is
+    with fits.open(fit_cache.input_files(ddir_1, OID, MODE)[1], mode="update") as hdul:
+        hdul["SPECTRUM"].header["BACKSCAL"] *= 2
+    assert len({cache.keys(d, OID, MODE, MODEL_NAMES)["powlaw_tbabs"] for d in (ddir_1, ddir_2)} | {keys["powlaw_tbabs"]}) == 3
+
+
+def test_not_fits(cache, tmp_path):
+    fn = tmp_path / "Obs_00000000001pc_chi2_grp.pi"
+    fn.write_text("not a FITS file")
+    with pytest.raises(ValueError):
+        fit_cache._fits_hash(str(fn), fit_cache.PATH_KEYWORDS)
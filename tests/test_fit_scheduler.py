@@ -0,0 +1,151 @@
+"""
+fit_scheduler.run_task() with a stub `xspec` on PATH, which reads the session script from its standard input like XSpec and writes the
+output tables that it opens, except those of the models listed in $STUB_XSPEC_FAIL (in its first $STUB_XSPEC_FAIL_SESSIONS sessions).
+With $STUB_XSPEC_HANG set, it hangs instead. The models of every session are appended to $STUB_XSPEC_CALLS, one line per session.
+"""
+
+
+import os
+import stat
+import sys
+
+import pytest
+
+import fit_scheduler
+import models
+import utils
+
+
+CFG_FN = os.path.join(os.path.dirname(__file__), "..", "src", "default_config.cfg")
+
+OID, MODE, SPEC_STEM = "00032646038", "wt", "spec"
+
+STUB_XSPEC = f"""#!{sys.executable}
+import os, re, sys, time
+calls_fn = os.environ["STUB_XSPEC_CALLS"]
+n_session = len(open(calls_fn).readlines()) if os.path.exists(calls_fn) else 0
+fail = os.environ.get("STUB_XSPEC_FAIL", "").split(",") if n_session < int(os.environ.get("STUB_XSPEC_FAIL_SESSIONS", 1)) else []
+if os.environ.get("STUB_XSPEC_HANG"):
+    time.sleep(60)
+model, started = None, []
+for line in sys.stdin:
+    m = re.match(r'puts "{models.TIMESTAMP_TAG} (\\S+) (\\S+) \\[clock milliseconds\\]"', line)
+    if m:
+        model = m.group(2)
+        if m.group(1) == "start":
+            started.append(model)
+        print("{models.TIMESTAMP_TAG}", m.group(1), model, int(time.time() * 1000))
+    for path in re.findall(r"\\[open (\\S+) w\\+\\]", line):
+        if model not in fail:
+            open(path, "w").write("stub\\n")
+with open(calls_fn, "a") as f:
+    f.write(" ".join(started) + "\\n")
+"""
+
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    """Base data directory with one ObsID, its log directory, the config variables, and the stub xspec on PATH"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fn_xspec = bin_dir / "xspec"
+    fn_xspec.write_text(STUB_XSPEC)
+    fn_xspec.chmod(fn_xspec.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    calls_fn = tmp_path / "calls.txt"
+    monkeypatch.setenv("STUB_XSPEC_CALLS", str(calls_fn))
+    for var in ("STUB_XSPEC_FAIL", "STUB_XSPEC_FAIL_SESSIONS", "STUB_XSPEC_HANG"):
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.delenv("XRT_TRACE_FN", raising=False)
+
+    base_data_dir = tmp_path / "data"
+    data_dir = base_data_dir / OID / "USERPROD_1" / SPEC_STEM
+    data_dir.mkdir(parents=True)
+    log_dir = base_data_dir / "_fit_logs"
+    log_dir.mkdir()
+    variables = utils.read_cfg(CFG_FN)
+    variables["TRASH_DIR"] = "${BASE_DATA_DIR}/trash"
+    os.makedirs(utils.get_trash_dir(variables, str(base_data_dir)))
+
+    def run(model_names=("powlaw_tbabs", "logpar_tbabs"), **kwargs):
+        task = fit_scheduler.FitTask(OID, MODE, list(model_names))
+        return fit_scheduler.run_task(task, variables, str(base_data_dir), SPEC_STEM, str(log_dir), **kwargs)
+
+    def calls():
+        return [line.split() for line in calls_fn.read_text().splitlines()] if calls_fn.exists() else []
+
+    return run, calls, data_dir
+
+
+def test_done(setup):
+    run, calls, data_dir = setup
+    task = run()
+    assert (task.status, task.attempts, task.failed_models) == ("done", 1, [])
+    assert calls() == [["powlaw_tbabs", "logpar_tbabs"]]
+    for model in task.models:
+        for fn in fit_scheduler.EXPECTED_OUTPUTS:
+            assert (data_dir / model / fn).exists()
+
+
+def test_retry_only_failed_models(setup, monkeypatch):
+    run, calls, data_dir = setup
+    monkeypatch.setenv("STUB_XSPEC_FAIL", "logpar_tbabs")
+    task = run(retries=1)
+    assert (task.status, task.attempts, task.failed_models) == ("done", 2, [])
+    assert calls() == [["powlaw_tbabs", "logpar_tbabs"], ["logpar_tbabs"]]
+    # The XSpec log of the first attempt is kept, with the second appended to it
+    with open(data_dir / "_xspec.log") as f:
+        log = f.read()
+    assert log.count(f"{models.TIMESTAMP_TAG} start logpar_tbabs") == 2
+    assert "# Attempt 2" in log
+
+
+def test_failed(setup, monkeypatch):
+    run, calls, data_dir = setup
+    monkeypatch.setenv("STUB_XSPEC_FAIL", "logpar_tbabs")
+    monkeypatch.setenv("STUB_XSPEC_FAIL_SESSIONS", "3")
+    task = run(retries=1)
+    assert (task.status, task.attempts, task.failed_models) == ("failed", 2, ["logpar_tbabs"])
+    assert calls() == [["powlaw_tbabs", "logpar_tbabs"], ["logpar_tbabs"]]
+
+
+def test_timeout(setup, monkeypatch):
+    run, calls, data_dir = setup
+    monkeypatch.setenv("STUB_XSPEC_HANG", "1")
+    task = run(timeout=0.5, retries=0)
+    assert (task.status, task.attempts, task.failed_models) == ("timeout", 1, task.models)
+    with open(task.log_fn) as f:
+        assert "Timed out after 0.5 seconds" in f.read()
+
+
+def test_xspec_not_found(setup, monkeypatch, tmp_path):
+    run, calls, data_dir = setup
+    # The outputs of an earlier fit are kept if XSpec cannot be started
+    (data_dir / "powlaw_tbabs").mkdir()
+    (data_dir / "powlaw_tbabs" / "param_tbl.dat").write_text("earlier fit\n")
+    monkeypatch.setenv("PATH", str(tmp_path / "empty"))
+    task = run(retries=2)
+    assert (task.status, task.attempts, task.failed_models) == ("failed", 1, task.models)
+    assert (data_dir / "powlaw_tbabs" / "param_tbl.dat").read_text() == "earlier fit\n"
+    with open(task.log_fn) as f:
+        assert "Could not start XSpec" in f.read()
+
+
+# The stub's tables are not real XSpec tables, which the results store reports
+@pytest.mark.filterwarnings("ignore:loadtxt")
+def test_run_all_task_raises(setup, monkeypatch):
+    run, calls, data_dir = setup
+    run_task = fit_scheduler.run_task
+
+    def raise_for_other(task, *args, **kwargs):
+        if task.oid != OID:
+            raise FileNotFoundError(2, "No such file or directory", "xspec")
+        return run_task(task, *args, **kwargs)
+
+    monkeypatch.setattr(fit_scheduler, "run_task", raise_for_other)
+    tasks = fit_scheduler.expand_tasks(["00000000001", OID], ["pc", MODE], ["powlaw_tbabs"])
+    variables = utils.read_cfg(CFG_FN)
+    variables["TRASH_DIR"] = "${BASE_DATA_DIR}/trash"
+    fit_scheduler.run_all(tasks, variables, str(data_dir.parents[2]), SPEC_STEM, max_workers=2)
+    # The task that raised is failed, and the other one still fitted
+    assert [(t.status, t.failed_models) for t in tasks] == [("failed", ["powlaw_tbabs"]), ("done", [])]
@@ -0,0 +1,41 @@
+"""
+flux_engine.FluxEngine on the XSpec fits in default_output, which were written before covar_tbl.dat was.
+"""
+
+
+import glob
+import logging
+import os
+import shutil
+
+import numpy as np
+
+import flux_engine
+import read_output
+
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "..", "default_output")
+
+FNS_PARAM = sorted(glob.glob(os.path.join(DEFAULT_OUTPUT, "*", "USERPROD_*", "spec", "powlaw_tbabs", "param_tbl.dat")))
+
+
+def test_default_band_is_xspec_flux(caplog):
+    engine = flux_engine.FluxEngine(nh_tbabs=0.157)
+    with caplog.at_level(logging.WARNING):
+        flux, flux_errn, flux_errp = engine.fluxes("powlaw_tbabs", FNS_PARAM)
+    # The 2-10 keV photon flux of the best fit, as XSpec's `flux 2 10`, but for the absorption (wabs rather than tbabs)
+    xspec = [read_output.get_integral_phflux(fn)[0] for fn in FNS_PARAM]
+    np.testing.assert_allclose(flux, xspec, rtol=0.02)
+    assert np.all(flux_errn > 0) and np.all(flux_errp > 0)
+    # No covar_tbl.dat: the parameters are drawn independently, which is reported
+    assert f"{len(FNS_PARAM)} of {len(FNS_PARAM)} fit(s) of powlaw_tbabs have no covar_tbl.dat" in caplog.text
+
+
+def test_no_warning_with_covar(caplog, tmp_path):
+    fn_param = tmp_path / "param_tbl.dat"
+    shutil.copy(FNS_PARAM[0], fn_param)
+    with open(tmp_path / "covar_tbl.dat", 'w') as f:
+        f.write("PhoIndex norm\n1e-3 1e-6 1e-8\n")
+    with caplog.at_level(logging.WARNING):
+        flux_engine.FluxEngine(nh_tbabs=0.157).fluxes("powlaw_tbabs", [str(fn_param)])
+    assert "covar_tbl.dat" not in caplog.text
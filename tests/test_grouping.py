@@ -0,0 +1,73 @@
+"""
+grouping.py against the spectra grouped by grppha in default_output (bad 0-29, group min 20).
+"""
+
+
+import glob
+import os
+import shutil
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+import grouping
+
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "..", "default_output")
+
+# Grouped by grppha: {DDIR}/Obs_{OID}{mode}_chi2_grp.pi
+GRPPHA_FNS = sorted(glob.glob(os.path.join(DEFAULT_OUTPUT, "*", "USERPROD_*", "spec", "Obs_*_chi2_grp.pi")))
+
+# Keywords that record when and by which program the file was written
+PROVENANCE_KEYS = ("DATE", "CREATOR", "HISTORY", "COMMENT", "CHECKSUM", "DATASUM")
+
+# Paths to the other products, which depend on where the spectrum was grouped
+PATH_KEYS = ("BACKFILE", "RESPFILE", "ANCRFILE")
+
+
+def _header(hdu):
+    return {k: v for k, v in hdu.header.items() if k not in PROVENANCE_KEYS}
+
+
+# Any warning of astropy, e.g. a card truncated to 80 characters, would be written for every grouped spectrum
+@pytest.mark.filterwarnings("error")
+@pytest.mark.parametrize("fn_grppha", GRPPHA_FNS, ids=os.path.basename)
+def test_same_as_grppha(fn_grppha, tmp_path):
+    ddir = os.path.dirname(fn_grppha)
+    stem = os.path.basename(fn_grppha)[:-len("_chi2_grp.pi")]
+    oid, mode = stem[len("Obs_"):-2], stem[-2:]
+    shutil.copy(os.path.join(ddir, f"{stem}source.pi"), tmp_path)
+
+    fn, = grouping.group_spectrum(str(tmp_path), oid, mode)
+
+    with fits.open(fn_grppha) as expected, fits.open(fn) as written:
+        assert len(written) == len(expected)
+        for hdu_expected, hdu in zip(expected, written):
+            header_expected, header = _header(hdu_expected), _header(hdu)
+            for k in PATH_KEYS:
+                if k in header_expected:
+                    assert os.path.basename(header.pop(k)) == os.path.basename(header_expected.pop(k))
+            assert header == header_expected
+            # The checksums are those of the grouped file
+            if "CHECKSUM" in hdu_expected.header:
+                assert hdu.verify_checksum() == 1 and hdu.verify_datasum() == 1
+        for col in ("CHANNEL", "COUNTS", "QUALITY", "GROUPING"):
+            np.testing.assert_array_equal(written["SPECTRUM"].data[col], expected["SPECTRUM"].data[col])
+
+
+def test_group_min_counts():
+    channels = np.arange(40)
+    counts = np.full(40, 3)
+    grouping_col, quality = grouping.group_min_counts(channels, counts, 5)
+    # Channels 30-39 in groups of 2 channels (6 counts), all full
+    assert list(quality) == [grouping.QUALITY_BAD] * 30 + [grouping.QUALITY_GOOD] * 10
+    assert list(grouping_col[30:]) == [1, -1] * 5
+
+
+@pytest.mark.parametrize("min_counts", [0, -1])
+def test_min_counts_below_one(min_counts):
+    with pytest.raises(ValueError):
+        grouping.group_min_counts(np.arange(40), np.ones(40), min_counts)
+    with pytest.raises(ValueError):
+        grouping.parse_variants([f"chi2={min_counts}"])
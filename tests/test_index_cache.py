@@ -0,0 +1,85 @@
+"""
+The on-disk caches of header_index.py, product_index.py and watch.py: saved by many threads at once, and read back when corrupt.
+"""
+
+
+import json
+import os
+import threading
+
+import header_index
+import product_index
+import watch
+
+
+N_THREADS = 4
+
+
+def _save_concurrently(make):
+    """Save `N_THREADS` indexes made by `make(i)` at once, many times each; returns the exceptions raised"""
+    errors = []
+    start = threading.Barrier(N_THREADS)
+
+    def work(i):
+        index = make(i)
+        start.wait()
+        try:
+            for _ in range(50):
+                index.save()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(N_THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def _tmp_files(path):
+    return [name for name in os.listdir(path) if name.endswith(".tmp")]
+
+
+def test_header_index_concurrent_save(tmp_path):
+    def make(i):
+        index = header_index.HeaderIndex.for_base_data_dir(str(tmp_path))
+        index.entries = {f"/data/{i}_{j}.pi": {"LIVETIME": j} for j in range(200)}
+        return index
+
+    assert _save_concurrently(make) == []
+    assert len(header_index.HeaderIndex.for_base_data_dir(str(tmp_path)).entries) == 200
+    assert _tmp_files(tmp_path) == []
+
+
+def test_product_index_concurrent_save(tmp_path):
+    def make(i):
+        index = product_index.ProductIndex.for_base_data_dir(str(tmp_path))
+        index.dirs = {f"{i}_{j}": {"mtime_ns": j, "dirs": [], "files": []} for j in range(200)}
+        return index
+
+    assert _save_concurrently(make) == []
+    assert len(product_index.ProductIndex.for_base_data_dir(str(tmp_path)).dirs) == 200
+    assert _tmp_files(tmp_path) == []
+
+
+def test_watch_state_concurrent_mark_done(tmp_path):
+    watcher = watch.Watcher(str(tmp_path), "spec")
+    threads = [threading.Thread(target=lambda i=i: [watcher.mark_done(f"{i}_{j}", (j, j)) for j in range(50)]) for i in range(N_THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(watch.Watcher(str(tmp_path), "spec").done) == N_THREADS * 50
+    assert _tmp_files(tmp_path) == []
+
+
+def test_corrupt_caches_are_empty(tmp_path):
+    # e.g. truncated by a crash while being written
+    for fn in (header_index.INDEX_FN, product_index.INDEX_FN, watch.STATE_FN):
+        with open(tmp_path / fn, 'w') as f:
+            f.write(json.dumps({"a": [1, 2]})[:-3])
+
+    assert header_index.HeaderIndex.for_base_data_dir(str(tmp_path)).entries == {}
+    assert product_index.ProductIndex.for_base_data_dir(str(tmp_path)).dirs == {}
+    assert watch.Watcher(str(tmp_path), "spec").done == {}
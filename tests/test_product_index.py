@@ -0,0 +1,58 @@
+"""
+product_index.ProductIndex on a copy of default_output.
+"""
+
+
+import os
+import pickle
+import shutil
+
+import pytest
+
+import product_index
+
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "..", "default_output")
+
+OIDS = ("00032646038", "00032646039")
+
+
+@pytest.fixture
+def base_data_dir(tmp_path):
+    shutil.copytree(DEFAULT_OUTPUT, tmp_path / "data")
+    return str(tmp_path / "data")
+
+
+def _sed_oids(products):
+    return [os.path.relpath(fn, products.base_data_dir).split(os.sep)[0]
+            for fn in products.glob("*", "spec", "powlaw_tbabs", "spec_default_bin.dat")]
+
+
+def test_full_refresh(base_data_dir):
+    products = product_index.load(base_data_dir)
+    assert _sed_oids(products) == list(OIDS)
+    assert products.data_dir(OIDS[0], "spec") == os.path.join(base_data_dir, OIDS[0], "USERPROD_224850", "spec")
+    assert products.products(OIDS[1], "spec")["modes"] == ["pc"]
+
+
+def test_wildcard_oid_without_full_refresh(base_data_dir):
+    # Only these ObsIDs were refreshed, so the entry of BASE_DATA_DIR itself was never listed
+    assert _sed_oids(product_index.load(base_data_dir, OIDS)) == list(OIDS)
+    assert _sed_oids(product_index.for_oid(base_data_dir, OIDS[1])) == [OIDS[1]]
+
+
+def test_wildcard_oid_with_stale_root(base_data_dir):
+    shutil.rmtree(os.path.join(base_data_dir, OIDS[1]))
+    assert _sed_oids(product_index.load(base_data_dir)) == [OIDS[0]]
+    # A new ObsID arrives after the full refresh, and only it is refreshed
+    shutil.copytree(os.path.join(DEFAULT_OUTPUT, OIDS[1]), os.path.join(base_data_dir, OIDS[1]))
+    products = product_index.load(base_data_dir, [OIDS[1]])
+    assert _sed_oids(products) == list(OIDS)
+    assert products.glob("0003264603[9]", "spec", "powlaw_tbabs", "param_tbl.dat") != []
+
+
+def test_pickle(base_data_dir):
+    # As the index is sent to the workers of the render pools under the spawn and forkserver start methods
+    products = pickle.loads(pickle.dumps(product_index.load(base_data_dir)))
+    assert _sed_oids(products) == list(OIDS)
+    products.save()
@@ -0,0 +1,62 @@
+"""
+Startup of the stages of `xrt-workflow` that do not plot: each is imported in a new Python process, which must take less than
+STARTUP_BUDGET seconds on top of starting Python, and must not load any of HEAVY_MODULES.
+"""
+
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import xrt_workflow
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Seconds that importing the script of a stage that does not plot may take, on top of starting Python
+STARTUP_BUDGET = 1.0
+
+# Stages of xrt_workflow.py held to STARTUP_BUDGET. download needs swifttools, which is slow to import whatever this workflow does
+STARTUP_STAGES = ("unpack", "mode", "group", "fit")
+
+# Libraries that only the code paths that need them should import
+HEAVY_MODULES = ("astropy", "matplotlib", "swifttools")
+
+# Each time is the shortest of this many runs, which is less noisy than the mean
+REPEAT = 3
+
+
+def _python(code):
+    return subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True, cwd=SRC_DIR)
+
+
+def _python_time(code):
+    """Shortest wall time (s) of running `code` in a new Python process"""
+    best = float("inf")
+    for _ in range(REPEAT):
+        t_start = time.perf_counter()
+        _python(code)
+        best = min(best, time.perf_counter() - t_start)
+    return best
+
+
+@pytest.fixture(scope="module")
+def t_python():
+    return _python_time("pass")
+
+
+@pytest.mark.parametrize("stage", STARTUP_STAGES)
+def test_import_budget(stage, t_python):
+    module = xrt_workflow.STAGES[stage][0]
+    t = _python_time(f"import xrt_workflow, {module}") - t_python
+    assert t < STARTUP_BUDGET, f"xrt-workflow {stage} imports in {t * 1e3:.0f} ms"
+
+
+@pytest.mark.parametrize("stage", STARTUP_STAGES)
+def test_no_heavy_modules(stage):
+    module = xrt_workflow.STAGES[stage][0]
+    heavy = _python(f"import sys, xrt_workflow, {module}; print(*[m for m in {HEAVY_MODULES!r} if m in sys.modules])").stdout.split()
+    assert heavy == []
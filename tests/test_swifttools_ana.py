@@ -0,0 +1,119 @@
+"""
+swifttools_ana.submit_requests_concurrently() against a stub of swifttools.ukssdc.xrt_prods, whose jobs follow a script: the value of
+`complete` at each status check (an exception is raised), and whether the submission succeeds.
+"""
+
+
+import os
+import sys
+import types
+
+import pytest
+
+
+class StubRequest:
+    """Stands in for xrt_prods.XRTProductRequest. `SCRIPTS` holds the `complete` values (or exceptions) of the job of each ObsID, in order;
+    the last one is repeated. ObsIDs in `FAIL_SUBMIT` are not accepted."""
+
+    SCRIPTS = {}
+    FAIL_SUBMIT = set()
+    checks = {}
+
+    def __init__(self, email, silent=True):
+        self.oid = None
+
+    def setGlobalPars(self, targ=None, **kwargs):
+        self.oid = targ
+
+    def addSpectrum(self, **kwargs):
+        pass
+
+    def submit(self):
+        if self.oid in self.FAIL_SUBMIT:
+            return False
+        self.JobID = f"job_{self.oid}"
+        return True
+
+    @property
+    def submitError(self):
+        if self.oid in self.FAIL_SUBMIT:
+            return "Rejected"
+        raise RuntimeError("There is no submitError")
+
+    @property
+    def complete(self):
+        script = self.SCRIPTS.get(self.oid, [True])
+        n = self.checks.get(self.oid, 0)
+        self.checks[self.oid] = n + 1
+        value = script[min(n, len(script) - 1)]
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def downloadProducts(self, dest_dir, format="zip", clobber=False):
+        with open(os.path.join(dest_dir, "spec.zip"), 'wb') as f:
+            f.write(b"PK")
+
+
+@pytest.fixture
+def swifttools_ana(monkeypatch):
+    xrt_prods = types.ModuleType("swifttools.ukssdc.xrt_prods")
+    xrt_prods.XRTProductRequest = StubRequest
+    ukssdc = types.ModuleType("swifttools.ukssdc")
+    ukssdc.xrt_prods = xrt_prods
+    swifttools = types.ModuleType("swifttools")
+    swifttools.ukssdc = ukssdc
+    for name, module in (("swifttools", swifttools), ("swifttools.ukssdc", ukssdc), ("swifttools.ukssdc.xrt_prods", xrt_prods)):
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, "swifttools_ana", raising=False)
+    monkeypatch.delenv("XRT_TRACE_FN", raising=False)
+    StubRequest.SCRIPTS, StubRequest.FAIL_SUBMIT, StubRequest.checks = {}, set(), {}
+    import swifttools_ana
+    return swifttools_ana
+
+
+def _run(swifttools_ana, tmp_path, oids, **kwargs):
+    return swifttools_ana.submit_requests_concurrently(oids, "me@example.org", str(tmp_path), "spec", "Target", poll_interval=0.01,
+                                                       max_poll_interval=0.02, **kwargs)
+
+
+def test_all_downloaded(swifttools_ana, tmp_path):
+    StubRequest.SCRIPTS = {"001": [False, False, True], "002": [True]}
+    status = _run(swifttools_ana, tmp_path, ["001", "002", "003"], max_jobs=2)
+    assert status == {"001": "downloaded", "002": "downloaded", "003": "downloaded"}
+    for oid in status:
+        assert (tmp_path / oid / "spec.zip").exists()
+
+
+def test_poll_error_is_retried(swifttools_ana, tmp_path):
+    # One job's status check fails twice; it and the other jobs are still downloaded
+    StubRequest.SCRIPTS = {"001": [False, ConnectionError("reset by peer"), OSError("timed out"), True], "002": [False, True]}
+    status = _run(swifttools_ana, tmp_path, ["001", "002"])
+    assert status == {"001": "downloaded", "002": "downloaded"}
+    assert StubRequest.checks["001"] == 4
+
+
+def test_submit_failed_and_timeout(swifttools_ana, tmp_path):
+    StubRequest.FAIL_SUBMIT = {"001"}
+    StubRequest.SCRIPTS = {"002": [False], "003": [RuntimeError("server error")]}
+    status = _run(swifttools_ana, tmp_path, ["001", "002", "003", "004"], job_timeout=0.1)
+    assert status == {"001": "submit_failed", "002": "timeout", "003": "timeout", "004": "downloaded"}
+
+
+def test_backoff(swifttools_ana, tmp_path, monkeypatch):
+    # The wait between two checks grows by `backoff`, up to `max_poll_interval`
+    StubRequest.SCRIPTS = {"001": [False] * 5 + [True]}
+    # A clock that only moves when the loop sleeps
+    now, waits = [0.], []
+    monkeypatch.setattr(swifttools_ana.time, "monotonic", lambda: now[0])
+
+    def sleep(t):
+        waits.append(t)
+        now[0] += t
+
+    monkeypatch.setattr(swifttools_ana.time, "sleep", sleep)
+    status = swifttools_ana.submit_requests_concurrently(["001"], "me@example.org", str(tmp_path), "spec", "Target", poll_interval=10,
+                                                         max_poll_interval=50, backoff=3)
+    assert status == {"001": "downloaded"}
+    assert StubRequest.checks["001"] == 6
+    assert waits == [10, 30, 50, 50, 50, 50]
@@ -0,0 +1,42 @@
+"""
+The summary of a trace, `python tracing.py`.
+"""
+
+
+import json
+import os
+import subprocess
+import sys
+
+import tracing
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def _write_trace(fn, n_tasks):
+    with open(fn, 'w') as f:
+        for i in range(n_tasks):
+            f.write(json.dumps({"name": "ObsID", "cat": "fit", "ph": "X", "ts": i, "dur": 1, "pid": 1, "tid": 1,
+                                "args": {"wall_s": float(i), "oid": f"{i:011d}"}}) + "\n")
+
+
+def test_summary(tmp_path):
+    fn = tmp_path / tracing.TRACE_FN
+    _write_trace(fn, 10)
+    lines = tracing.summary(tracing.read_trace(fn), top=2)
+    assert "fit / ObsID: 10 task(s), median 4.5 s, longest 9.0 s. Slowest:" in lines
+    assert lines[-2:] == ["\t00000000009: 9.0 s", "\t00000000008: 8.0 s"]
+
+
+def test_summary_piped_to_head(tmp_path):
+    # The reader of the summary goes away before it is printed, as `head` does once it has its lines
+    fn = tmp_path / tracing.TRACE_FN
+    _write_trace(fn, 10000)
+    proc = subprocess.Popen([sys.executable, "tracing.py", "--trace_fn", str(fn), "--top", "10000"], cwd=SRC_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    proc.stdout.close()
+    stderr = proc.stderr.read().decode()
+    proc.wait()
+    assert "Traceback" not in stderr and "BrokenPipeError" not in stderr
+    assert (tmp_path / tracing.CHROME_TRACE_FN).exists()